@@ -1,33 +1,261 @@
 # arquivo: api_financeira.py
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import time
 import os
 from datetime import datetime, timedelta, timezone
 from flask_cors import CORS
 from app.services.extractor import extrair_informacoes_financeiras
 from audio_processor import audio_processor
-from app.services.database import get_db, salvar_transacao_cliente, firestore, ensure_cliente, build_ref_id, parse_ref_id, recompute_cliente_aggregates
+from app.services.database import get_db, salvar_transacao_cliente, firestore, ensure_cliente, build_ref_id, parse_ref_id, recompute_cliente_aggregates, get_dias_range, get_dias_mes, get_docs_many, day_keys_between, month_bounds, week_key, incrementar_agregados_superiores, saldo_anterior_mes, saldo_anterior_gravado, somar_intervalo, cliente_migrado, marcar_dias_sujos, recompute_cliente_incremental, listar_transacoes_dia, versao_dados, pagina_extrato_mes, totais_extrato_mes, indexar_extrato, dias_com_itens
+from app.services.repair_queue import agendar_reparo, status_reparos
+from app.services.cache import cache_get, cache_set, invalidar_cliente, cache_stats, cache_geracao
+from app.services.singleflight import executar_unico, singleflight_stats
+from app.services.consistency import verificar_todos
+from app.services import metrics as _metrics
+from app.services import profiler as _profiler
+from app.services import admission as _admission
+from app.services.group_commit import status_group_commit
+from app.services.batch_writer import status_batch_writer
+from app.services import idempotency as _idem
 from app.services.pdf_extractor import extrair_transacoes_de_pdf, extrair_totais_a_pagar_de_pdf
 
 app = Flask(__name__)
 CORS(app)  # Permitir requisições do bot
-_API_CACHE = {}
-def _cache_get_api(key):
-    try:
-        v = _API_CACHE.get(key)
-        if not v:
-            return None
-        exp, data = v
-        if time.time() > float(exp or 0):
-            return None
-        return data
+def _cache_get_api(key, cliente_id=None):
+    return cache_get(key, cliente_id=cliente_id)
+def _cache_set_api(key, data, ttl=12, cliente_id=None, geracao=None):
+    cache_set(key, data, ttl=ttl, cliente_id=cliente_id, geracao=geracao)
+def _chave_requisicao():
+    return request.path + "?" + "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True))) + "|" + _day_key_sp()
+def _etag_de(versao):
+    import hashlib
+    base = _chave_requisicao() + "|" + str(versao)
+    return "v" + str(versao) + "-" + hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+def _nao_modificado(versao):
+    # 304 se o If-None-Match é o ETag dessa versao; None caso contrário
+    try:
+        etag = _etag_de(versao)
+        if request.if_none_match.contains(etag):
+            r = app.response_class(status=304)
+            r.set_etag(etag)
+            return r
     except:
-        return None
-def _cache_set_api(key, data, ttl=12):
+        pass
+    return None
+def _cache_resposta(ttl=None):
+    # Cacheia respostas 200 com sucesso=True de GETs; a chave inclui rota, query string e o dia
+    # corrente (endpoints de "hoje"/"mês atual"), e a entrada morre quando o cliente escreve.
+    # A entrada guarda a `versao` lida antes do cálculo; o ETag sai dela, não da versao atual.
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            cliente_id = str(request.args.get("cliente_id") or "default")
+            key = _chave_requisicao()
+            c = _cache_get_api(key, cliente_id=cliente_id)
+            if isinstance(c, dict) and "corpo" in c:
+                g.versao_resposta = c.get("versao")
+                return _nao_modificado(c.get("versao")) or jsonify(c["corpo"])
+            # geração lida antes de calcular: escrita durante o cálculo deixa a entrada já inválida
+            ger = cache_geracao(cliente_id)
+            versao = versao_dados(cliente_id)
+            r = _nao_modificado(versao)
+            if r is not None:
+                return r
+            def calcular():
+                resp = fn(*args, **kwargs)
+                data = None
+                try:
+                    if getattr(resp, "status_code", None) == 200:
+                        data = resp.get_json(silent=True)
+                        if isinstance(data, dict) and data.get("sucesso"):
+                            _cache_set_api(key, {"versao": versao, "corpo": data}, ttl=ttl, cliente_id=cliente_id, geracao=ger)
+                        else:
+                            data = None
+                except:
+                    data = None
+                return resp, data, versao
+            # misses iguais e simultâneos esperam o primeiro; a geração do cliente entra na chave
+            # para quem chega depois de uma escrita não pegar carona num cálculo antigo
+            (resp, data, v), compartilhado = executar_unico(key + "|g" + str(ger), calcular)
+            g.versao_resposta = v
+            if not compartilhado:
+                return resp
+            if data is not None:
+                return jsonify(data)
+            g.versao_resposta = versao
+            return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper._versao_propria = True
+        return wrapper
+    return deco
+def _etag_versao(fn):
+    # ETag = rota + query + dia + `versao` do cliente (sobe a cada escrita) de quando o corpo foi
+    # calculado. Com _cache_resposta por baixo a versao vem da entrada do cache (hit não lê o doc do
+    # cliente); nas outras rotas é lida antes de montar o corpo e If-None-Match igual já responde 304.
+    def wrapper(*args, **kwargs):
+        g.versao_resposta = None
+        if not getattr(fn, "_versao_propria", False):
+            try:
+                g.versao_resposta = versao_dados(str(request.args.get("cliente_id") or "default"))
+            except:
+                return fn(*args, **kwargs)
+            r = _nao_modificado(g.versao_resposta)
+            if r is not None:
+                return r
+        resp = fn(*args, **kwargs)
+        versao = g.get("versao_resposta")
+        try:
+            if versao is not None and getattr(resp, "status_code", None) == 200:
+                resp.set_etag(_etag_de(versao))
+                resp.headers["Cache-Control"] = "no-cache"
+        except:
+            pass
+        return resp
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+def _admissao(classe):
+    # Rotas de extração: balde de tokens por cliente/classe (429) e teto global de extrações
+    # simultâneas com fila curta (503). classe pode ser uma função do payload.
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            body = request.get_json(silent=True) or {}
+            if not isinstance(body, dict):
+                body = {}
+            cliente_id = str(body.get("cliente_id") or request.form.get("cliente_id") or "default")
+            c = classe(body) if callable(classe) else classe
+            ok, espera = _admission.consumir(cliente_id, c)
+            if not ok:
+                r = jsonify({"sucesso": False, "erro": "Muitas requisições; tente novamente em instantes", "classe": c, "retry_after": int(espera) + 1})
+                r.status_code = 429
+                r.headers["Retry-After"] = str(int(espera) + 1)
+                return r
+            st = _admission.entrar()
+            if st != "ok":
+                r = jsonify({"sucesso": False, "erro": "Servidor ocupado; tente novamente em instantes", "fila": st})
+                r.status_code = 503
+                r.headers["Retry-After"] = "5"
+                return r
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _admission.sair()
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return deco
+def _erro_salvar(e):
+    # Mensagem de erro_salvar; commit ambíguo (pode ter gravado) fica marcado para _idempotente
+    if getattr(e, "escrita_incerta", False):
+        try:
+            g.escrita_incerta = True
+        except Exception:
+            pass
+        return "Falha ao salvar no Firestore (gravação incerta)"
+    return "Falha ao salvar no Firestore"
+def _idempotente(fn):
+    # Idempotency-Key (header) ou idempotency_key (body): repetição da mesma chave na mesma rota
+    # devolve a resposta original sem extrair nem gravar de novo. Sem chave, segue como antes.
+    def wrapper(*args, **kwargs):
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            body = {}
+        chave = str(request.headers.get("Idempotency-Key") or body.get("idempotency_key") or "").strip()
+        if not chave:
+            return fn(*args, **kwargs)
+        cliente_id = str(body.get("cliente_id") or "default")
+        try:
+            estado, anterior = _idem.reivindicar(cliente_id, request.path, chave)
+        except Exception:
+            return fn(*args, **kwargs)
+        if estado == "concluido":
+            r = jsonify(anterior)
+            r.headers["Idempotent-Replay"] = "true"
+            return r
+        if estado == "incerto":
+            r = jsonify({"sucesso": False, "erro": "Requisição anterior com esta chave pode ter sido gravada (commit incerto); confira o extrato antes de reenviar com outra chave"})
+            r.status_code = 409
+            return r
+        if estado == "em_andamento":
+            r = jsonify({"sucesso": False, "erro": "Requisição com esta chave ainda em andamento"})
+            r.status_code = 409
+            r.headers["Retry-After"] = "2"
+            return r
+        ok = False
+        g.escrita_incerta = False
+        try:
+            resp = fn(*args, **kwargs)
+            if getattr(resp, "status_code", None) == 200:
+                data = resp.get_json(silent=True)
+                if isinstance(data, dict) and data.get("sucesso") and not data.get("erro_salvar"):
+                    _idem.concluir(cliente_id, request.path, chave, data)
+                    ok = True
+            return resp
+        finally:
+            if not ok:
+                try:
+                    # só libera a chave se nada pode ter sido gravado
+                    if getattr(g, "escrita_incerta", False):
+                        _idem.incerto(cliente_id, request.path, chave)
+                    else:
+                        _idem.liberar(cliente_id, request.path, chave)
+                except:
+                    pass
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+@app.before_request
+def _metricas_inicio():
+    try:
+        _metrics.iniciar_requisicao()
+    except:
+        pass
+@app.after_request
+def _metricas_fim(resp):
+    # Contadores de Firestore da requisição vão para o endpoint (regra da rota) e para o header
+    try:
+        ep = request.url_rule.rule if request.url_rule is not None else "nao_encontrado"
+        c = _metrics.finalizar_requisicao(ep)
+        if c:
+            resp.headers["X-Firestore-RPC"] = f"reads={int(c['reads'])};writes={int(c['writes'])};queries={int(c['queries'])};docs={int(c['docs'])};ms={c['firestore_ms']:.1f}"
+    except:
+        pass
+    return resp
+@app.before_request
+def _perfil_inicio():
+    # Profiling opt-in: PROFILE_RATE sorteia requisições; o header X-Profile com o PROFILER_TOKEN força
     try:
-        _API_CACHE[key] = (time.time() + float(ttl or 0), data)
+        if _profiler.deve_perfilar(request.headers.get(_profiler.HEADER)):
+            g._perfil = (_profiler.iniciar(), time.time())
     except:
         pass
+@app.after_request
+def _perfil_fim(resp):
+    p = getattr(g, "_perfil", None)
+    if not p:
+        return resp
+    g._perfil = None
+    try:
+        pilhas = _profiler.parar(p[0])
+        body = request.get_json(silent=True) or {}
+        cid = request.args.get("cliente_id") or (body.get("cliente_id") if isinstance(body, dict) else None) or request.form.get("cliente_id")
+        ep = request.url_rule.rule if request.url_rule is not None else request.path
+        pid = _profiler.salvar(pilhas, ep, cliente_id=cid, duracao_ms=(time.time() - p[1]) * 1000.0, status=resp.status_code)
+        resp.headers["X-Profile-Id"] = pid
+    except:
+        pass
+    return resp
+@app.after_request
+def _invalidar_cache_escrita(resp):
+    # Toda escrita bem-sucedida de um cliente sobe a geração dele no cache
+    try:
+        if request.method in ("POST", "PUT", "PATCH", "DELETE") and int(resp.status_code) < 400 and resp.headers.get("Idempotent-Replay") != "true":
+            body = request.get_json(silent=True) or {}
+            cid = (body.get("cliente_id") if isinstance(body, dict) else None) or request.form.get("cliente_id") or request.args.get("cliente_id") or "default"
+            invalidar_cliente(str(cid))
+    except:
+        pass
+    return resp
 
 from app.config import API_HOST, API_PORT
 import re as _re
@@ -140,6 +368,29 @@ def _dd_totais(dd):
         "estorno": float(t.get("total_estorno", 0) or 0),
         "saldo": float(t.get("saldo_dia", 0) or 0),
     }
+def _dias_sem_doc_suspeitos(mm, dias_mes):
+    # Dias sem doc só valem a sondagem (um limit(1) por dia) quando o doc do mês não bate com a soma
+    # dos docs de dia: um dia com items e sem doc deixa o mês maior que a soma.
+    sem_doc = [k for k, dd in dias_mes.items() if not dd]
+    if not sem_doc:
+        return []
+    try:
+        mt = _mm_totais(mm or {})
+        soma = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+        qtd = 0
+        for dd in dias_mes.values():
+            if not dd:
+                continue
+            t = _dd_totais(dd)
+            for k in soma:
+                soma[k] += float(t[k])
+            qtd += int(dd.get("quantidade_transacoes_validas", dd.get("quantidade_transacoes", 0)) or 0)
+        qtd_mes = int((mm or {}).get("quantidade_transacoes_validas", (mm or {}).get("quantidade_transacoes", 0)) or 0)
+        if qtd_mes == qtd and all(abs(mt[k] - soma[k]) < 1e-6 for k in soma):
+            return []
+    except Exception:
+        pass
+    return sem_doc
 def _dd_categorias(dd):
     c = dict(dd.get("categorias", {}) or {})
     if not c:
@@ -156,6 +407,21 @@ def _dd_categorias(dd):
         "ajuste": dict(c.get("ajuste", {}) or {}),
     }
 
+def _agg_totais(doc, nivel):
+    t = dict((doc or {}).get(f"totais_{nivel}", {}) or {})
+    return {
+        "entrada": float(t.get("total_entrada", 0) or 0),
+        "saida": float(t.get("total_saida", 0) or 0),
+        "ajuste": float(t.get("total_ajuste", 0) or 0),
+        "estorno": float(t.get("total_estorno", 0) or 0),
+        "saldo": float(t.get(f"saldo_{nivel}", 0) or 0),
+    }
+def _agregados_ok(root_doc, versao=2):
+    try:
+        return int((root_doc or {}).get("agregados_versao", 0) or 0) >= int(versao)
+    except:
+        return False
+
 def _coerce_val(o):
     try:
         for k in ("valor_total", "valor", "pagamento", "valor_previsto"):
@@ -209,6 +475,8 @@ def _normalize_date_br(s: str):
 
 # ===== ENDPOINTS DA API =====
 @app.route('/processar', methods=['POST'])
+@_idempotente
+@_admissao(lambda b: "imagem" if isinstance(b.get('transacoes'), list) and b.get('transacoes') else "texto")
 def processar():
     """Processa uma mensagem do usuário."""
     data = request.json
@@ -250,10 +518,10 @@ def processar():
             salvas = []
             try:
                 salvas = salvar_transacao_cliente(transacoes, cliente_id=cliente_id, origem=origem)
-            except Exception:
-                erro_salvar = "Falha ao salvar no Firestore"
+            except Exception as e:
+                erro_salvar = _erro_salvar(e)
         except Exception as e:
-            erro_salvar = "Falha ao salvar no Firestore"
+            erro_salvar = _erro_salvar(e)
         try:
             SOURCE_STATS["json-transacoes"] = SOURCE_STATS.get("json-transacoes", 0) + 1
             total_stats = sum(SOURCE_STATS.values())
@@ -339,10 +607,10 @@ def processar():
             pass
         try:
             salvas = salvar_transacao_cliente(transacoes, cliente_id=cliente_id, origem=origem)
-        except Exception:
-            erro_salvar = "Falha ao salvar no Firestore"
-    except Exception:
-        erro_salvar = "Falha ao salvar no Firestore"
+        except Exception as e:
+            erro_salvar = _erro_salvar(e)
+    except Exception as e:
+        erro_salvar = _erro_salvar(e)
     transacoes = _norm_dedup(transacoes)
     try:
         print(f"[processar] normalized={normalized} final={transacoes}")
@@ -375,6 +643,8 @@ def processar():
     })
 
 @app.route('/processar_audio', methods=['POST'])
+@_idempotente
+@_admissao("audio")
 def processar_audio():
     data = request.json
     if not data:
@@ -391,75 +661,35 @@ def processar_audio():
         return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/health/consistency/all', methods=['GET'])
 def health_consistency_all():
+    # ?formato=ndjson (ou Accept: application/x-ndjson) transmite um cliente por linha e um resumo no fim;
+    # ?somente_inconsistentes=1 omite os consistentes; ?workers=N limita o paralelismo
+    dia = str(request.args.get("dia") or _day_key_sp())
+    mes = str(request.args.get("mes") or dia[:7])
+    somente = str(request.args.get("somente_inconsistentes", "")).strip().lower() in ("1", "true", "sim")
     try:
-        db = get_db()
-        clientes = []
-        try:
-            clientes = list(db.collection('clientes').stream())
-        except:
-            clientes = []
-        c = app.test_client()
-        out = []
-        for cl in clientes:
-            cid = cl.id
-            o = cl.to_dict() or {}
-            nome = o.get('cliente_display') or o.get('cliente_label') or cid
-            try:
-                h = c.get(f"/health/consistency?cliente_id={cid}").get_json() or {}
-            except:
-                h = {}
-            try:
-                extr = c.get(f"/extrato/hoje?cliente_id={cid}").get_json() or {}
-            except:
-                extr = {}
-            try:
-                tm = c.get(f"/total/mes?cliente_id={cid}").get_json() or {}
-            except:
-                tm = {}
-            try:
-                ts = c.get(f"/total/semana?cliente_id={cid}").get_json() or {}
-            except:
-                ts = {}
-            try:
-                sg = c.get(f"/saldo/atual?cliente_id={cid}").get_json() or {}
-            except:
-                sg = {}
-            try:
-                cg = c.get(f"/saldo/atual?cliente_id={cid}&mes={_month_key_sp()}&group_by=categoria").get_json() or {}
-            except:
-                cg = {}
+        workers = int(request.args.get("workers")) if request.args.get("workers") else None
+    except:
+        workers = None
+    ndjson = str(request.args.get("formato", "")).strip().lower() == "ndjson" or "application/x-ndjson" in str(request.headers.get("Accept", ""))
+    if ndjson:
+        import json as _json
+        def gerar():
+            t0 = time.time()
+            n = 0
+            inconsistentes = 0
             try:
-                categorias_map = dict(((cg.get('categorias') or {}).get('despesas')) or {})
-                estornos_map = dict(((cg.get('categorias') or {}).get('estornos')) or {})
-            except:
-                categorias_map = {}
-                estornos_map = {}
-            keys = set(list(categorias_map.keys()) + list(estornos_map.keys()))
-            net = {k: float(categorias_map.get(k, 0) or 0) - float(estornos_map.get(k, 0) or 0) for k in keys}
-            net = {k: v for k, v in net.items() if float(v or 0) > 0}
-            cats = sorted([(k, float(v or 0)) for k, v in net.items()], key=lambda x: x[1], reverse=True)
-            cats_est = sorted([(k, float(v or 0)) for k, v in estornos_map.items()], key=lambda x: x[1], reverse=True)
-            out.append({
-                "cliente_id": str(cid),
-                "nome": str(nome),
-                "dia": {"total": (extr.get("total") or {})},
-                "semana": {"total": (ts.get("total") or {})},
-                "mes": {"total": (tm.get("total") or {})},
-                "geral": {"total": (sg.get("total") or {})},
-                "consistencia": {
-                    "dia_consistente": ((h.get("dia") or {}).get("consistente")),
-                    "stream_count_validas": ((h.get("dia") or {}).get("stream_count_validas")),
-                    "mes_consistente_totais": ((h.get("mes") or {}).get("consistente_totais")),
-                    "mes_consistente_qtd": ((h.get("mes") or {}).get("consistente_qtd")),
-                },
-                "categorias_mes": {
-                    "top_despesas": cats[:5],
-                    "top_estornos": cats_est[:5],
-                    "total_despesas": float(sum(v for _, v in cats)),
-                    "total_estornos": float(sum(v for _, v in cats_est)),
-                }
-            })
-        return jsonify({"sucesso": True, "clientes": out})
+                for r in verificar_todos(dia, mes, workers=workers, somente_inconsistentes=somente):
+                    n += 1
+                    if not r.get("consistente"):
+                        inconsistentes += 1
+                    yield _json.dumps(r, ensure_ascii=False, default=str) + "\n"
+                yield _json.dumps({"resumo": {"dia": dia, "mes": mes, "clientes": n, "inconsistentes": inconsistentes, "tempo_ms": int((time.time() - t0) * 1000)}}) + "\n"
+            except Exception as e:
+                yield _json.dumps({"erro": str(e)}) + "\n"
+        return Response(stream_with_context(gerar()), mimetype="application/x-ndjson")
+    try:
+        out = list(verificar_todos(dia, mes, workers=workers, somente_inconsistentes=somente))
+        return jsonify({"sucesso": True, "dia": dia, "mes": mes, "clientes": out})
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
     if not texto:
@@ -503,10 +733,10 @@ def health_consistency_all():
             pass
         try:
             salvar_transacao_cliente(transacoes, cliente_id=cliente_id, origem=origem)
-        except Exception:
-            erro_salvar = "Falha ao salvar no Firestore"
-    except Exception:
-        erro_salvar = "Falha ao salvar no Firestore"
+        except Exception as e:
+            erro_salvar = _erro_salvar(e)
+    except Exception as e:
+        erro_salvar = _erro_salvar(e)
     return jsonify({"sucesso": True,
         "transacoes": transacoes,
         "total": len(transacoes),
@@ -519,6 +749,8 @@ def health_consistency_all():
         "erro_salvar": erro_salvar
     })
 @app.route('/processar_pdf', methods=['POST'])
+@_idempotente
+@_admissao("pdf")
 def processar_pdf():
     data = request.json
     if not data:
@@ -542,7 +774,7 @@ def processar_pdf():
             pass
         salvar_transacao_cliente(transacoes, cliente_id=cliente_id, origem=origem)
     except Exception as e:
-        erro_salvar = "Falha ao salvar no Firestore"
+        erro_salvar = _erro_salvar(e)
     return jsonify({
         "sucesso": True,
         "transacoes": transacoes,
@@ -555,6 +787,8 @@ def processar_pdf():
         "erro_salvar": erro_salvar
     })
 @app.route('/processar_pdf_totais', methods=['POST'])
+@_idempotente
+@_admissao("pdf")
 def processar_pdf_totais():
     data = request.json
     if not data:
@@ -650,7 +884,7 @@ def processar_pdf_totais():
         except:
             pass
     except Exception as e:
-        erro_salvar = "Falha ao salvar no Firestore"
+        erro_salvar = _erro_salvar(e)
     return jsonify({
         "sucesso": True,
         "totais": tot,
@@ -1047,6 +1281,7 @@ def ajustes_adicionar():
         item_ref = day_ref.collection('items').document()
         tdoc["ref_id"] = build_ref_id(dr, item_ref.id)
         batch.set(item_ref, tdoc)
+        indexar_extrato(batch, root, dr, item_ref.id, tdoc)
         inc_d = {"quantidade_transacoes": firestore.Increment(1), "quantidade_transacoes_validas": firestore.Increment(1), "atualizado_em": firestore.SERVER_TIMESTAMP}
         inc_m = {"quantidade_transacoes": firestore.Increment(1), "quantidade_transacoes_validas": firestore.Increment(1), "atualizado_em": firestore.SERVER_TIMESTAMP}
         inc_d.update({
@@ -1068,6 +1303,13 @@ def ajustes_adicionar():
             batch.set(dref, {"data": dr}, merge=True)
         batch.set(dref, inc_d, merge=True)
         batch.set(mref, inc_m, merge=True)
+        incrementar_agregados_superiores(batch, root, dr, "ajuste", dv, _canon_category(categoria))
+        try:
+            marcar_dias_sujos(batch, root, [dr])
+        except:
+            pass
+        # versao sobe com a escrita (ETag/cache das leituras)
+        batch.set(root, {"versao": firestore.Increment(1), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
         batch.commit()
         ddoc = dref.get().to_dict() or {}
         mdoc = mref.get().to_dict() or {}
@@ -1239,7 +1481,7 @@ def ajustes_buscar_por_valor():
             if ts_str:
                 safe["timestamp_criacao"] = ts_str
             matches.append(safe)
-        if not matches:
+        if not matches and not cliente_migrado(cliente_id):
             # Fallback to flat collection if nested empty
             tcoll = db.collection('clientes').document(cliente_id).collection('transacoes')
             q = tcoll.where('data_referencia', '==', dr)
@@ -1289,6 +1531,8 @@ def ajustes_buscar_por_valor():
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/extrato/hoje', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
 def extrato_hoje():
     """Retorna extrato do dia atual."""
     data_atual = _day_key_sp()
@@ -1311,14 +1555,18 @@ def extrato_hoje():
                 docs = root.collection('transacoes').document(data_atual).collection('items').stream()
             except:
                 docs = []
+            migrado = cliente_migrado(cliente_id)
             try:
-                tops = root.collection('transacoes').where('data_referencia', '==', data_atual).stream()
+                tops = root.collection('transacoes').where('data_referencia', '==', data_atual).stream() if not migrado else []
             except:
                 tops = []
             idx = {}
             tl = []
             for d in docs:
                 o = d.to_dict() or {}
+                if migrado:
+                    tl.append(o)
+                    continue
                 k = str(o.get('ref_id') or '') or (str(o.get('tipo', '')) + '|' + str(float(o.get('valor', 0) or 0)) + '|' + str(o.get('categoria', '')) + '|' + str(o.get('descricao', '')) + '|' + str(o.get('timestamp_criacao', '')))
                 if not idx.get(k):
                     idx[k] = 1
@@ -1371,17 +1619,7 @@ def extrato_hoje():
             estornos = float(tes or 0)
             saldo = receitas - despesas + estornos + ajustes
             try:
-                root.collection('dias').document(data_atual).set({
-                    "totais_dia": {
-                        "total_entrada": receitas,
-                        "total_saida": despesas,
-                        "total_ajuste": ajustes,
-                        "total_estorno": estornos,
-                        "saldo_dia": saldo,
-                    },
-                    "quantidade_transacoes_validas": int(cnt_tmp),
-                    "atualizado_em": firestore.SERVER_TIMESTAMP,
-                }, merge=True)
+                agendar_reparo(cliente_id, "dia", data_atual)
             except:
                 pass
         # Contagem válida: entradas/saídas (não considera 'estorno' como transação)
@@ -1414,6 +1652,7 @@ def extrato_hoje():
         return jsonify({"sucesso": False, "erro": str(e)}), 500
 
 @app.route('/extrato/mes', methods=['GET'])
+@_etag_versao
 def extrato_mes():
     start_time = time.time()
     mes_qs = request.args.get("mes")
@@ -1430,9 +1669,56 @@ def extrato_mes():
             ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
         except:
             pass
+        # Paginação por cursor (com `cursor` ou paginacao=cursor): lê o índice meses/{mes}/extrato ordenado
+        # por valor. Sem isso segue a varredura do mês com offset/limit.
+        cursor_qs = request.args.get("cursor")
+        if (cursor_qs or str(request.args.get("paginacao") or "").strip().lower() == "cursor") and limit_qs > 0:
+            try:
+                mdoc = db.collection('clientes').document(cliente_id).collection('meses').document(mes_atual).get().to_dict() or {}
+                res = pagina_extrato_mes(cliente_id, mes_atual, limit=min(limit_qs, 1000), cursor=cursor_qs, categoria=categoria_qs, mes_doc=mdoc)
+                if res is None:
+                    # índice do mês ainda não montado (montagem agendada)
+                    raise LookupError("índice do extrato em montagem")
+                itens, prox, lidos = res
+                page = [{
+                    "valor": float(o.get("valor", 0) or 0),
+                    "tipo": str(o.get("tipo", "")),
+                    "categoria": str(o.get("categoria", "")),
+                    "descricao": str(o.get("descricao", "")),
+                    "data_referencia": str(o.get("data_referencia", "")),
+                    "timestamp_criacao": str(o.get("timestamp_criacao") or ""),
+                    "ref_id": str(o.get("ref_id", "")),
+                } for o in itens]
+                # Totais somados no próprio índice (estornados já saíram dele), como na varredura
+                tot = totais_extrato_mes(cliente_id, mes_atual, categoria=categoria_qs)
+                tot_saida = tot["saida"]
+                tot_entrada = tot["entrada"]
+                return jsonify({
+                    "sucesso": True,
+                    "mes": mes_atual,
+                    "quantidade": len(page),
+                    "matches": page,
+                    "proximo_cursor": prox,
+                    "total_saida_categoria": float(tot_saida),
+                    "total_entrada_categoria": float(tot_entrada),
+                    "performance": {
+                        "response_time_ms": round((time.time() - start_time) * 1000, 2),
+                        "docs_lidos": int(lidos) + 1,
+                    }
+                })
+            except ValueError as e:
+                # cursor malformado ou de outro mês/categoria
+                return jsonify({"sucesso": False, "erro": str(e)}), 400
+            except Exception as e:
+                if cursor_qs:
+                    # a varredura pagina por offset e não sabe continuar um cursor
+                    return jsonify({"sucesso": False, "erro": f"índice do extrato indisponível: {e}"}), 503
+                # índice indisponível: segue pela varredura do mês com offset
         cache_key = f"extrato_mes:{cliente_id}:{mes_atual}:{str(categoria_qs or '-').strip().lower()}"
-        c = _cache_get_api(cache_key)
+        c = _cache_get_api(cache_key, cliente_id=cliente_id)
         if c is not None:
+            # ETag da versao de quando a entrada foi calculada
+            g.versao_resposta = c.get("versao")
             l = max(0, limit_qs)
             o = max(0, offset_qs)
             page = c["matches"][o:o+l] if l > 0 else c["matches"][o:]
@@ -1448,6 +1734,7 @@ def extrato_mes():
                     "response_time_ms": round(rt * 1000, 2)
                 }
             })
+        ger = cache_geracao(cliente_id)
         ano, m = mes_atual.split("-")
         dt_ini = f"{ano}-{m}-01"
         if m == "12":
@@ -1456,11 +1743,13 @@ def extrato_mes():
             dt_fim = f"{ano}-{int(m)+1:02d}-01"
         root = db.collection('clientes').document(cliente_id)
         matches = []
+        # Cliente migrado: tudo está nos items aninhados, sem consulta legada nem dedup
+        migrado = cliente_migrado(cliente_id)
         try:
             q = root.collection('transacoes').where('data_referencia', '>=', dt_ini).where('data_referencia', '<', dt_fim)
             if categoria_qs:
                 q = q.where('categoria', '==', str(categoria_qs).strip().lower())
-            tops = q.stream()
+            tops = q.stream() if not migrado else []
         except:
             tops = []
         idx = {}
@@ -1498,14 +1787,12 @@ def extrato_mes():
             matches.append(safe)
             tops_count += 1
         try:
-            cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-            end = datetime.strptime(dt_fim, "%Y-%m-%d")
-            while cur < end:
-                dkey = cur.strftime("%Y-%m-%d")
-                try:
-                    dd = root.collection('dias').document(dkey).get().to_dict() or {}
-                except:
-                    dd = {}
+            # Os docs de dia só servem para podar a busca por categoria; lidos todos de uma vez
+            if categoria_qs:
+                dias_mes = get_dias_range(cliente_id, dt_ini, dt_fim)
+            else:
+                dias_mes = {k: {} for k in day_keys_between(dt_ini, dt_fim)}
+            for dkey, dd in dias_mes.items():
                 need = True
                 if categoria_qs:
                     try:
@@ -1516,7 +1803,6 @@ def extrato_mes():
                     except:
                         need = True
                 if not need:
-                    cur = cur + timedelta(days=1)
                     continue
                 try:
                     items = root.collection('transacoes').document(dkey).collection('items')
@@ -1529,10 +1815,11 @@ def extrato_mes():
                     o = it.to_dict() or {}
                     if bool(o.get('estornado', False)):
                         continue
-                    k = str(o.get('ref_id') or '') or (str(o.get('tipo', '')) + '|' + str(float(o.get('valor', 0) or 0)) + '|' + str(o.get('categoria', '')) + '|' + str(o.get('descricao', '')) + '|' + str(o.get('timestamp_criacao', '')))
-                    if idx.get(k):
-                        continue
-                    idx[k] = 1
+                    if not migrado:
+                        k = str(o.get('ref_id') or '') or (str(o.get('tipo', '')) + '|' + str(float(o.get('valor', 0) or 0)) + '|' + str(o.get('categoria', '')) + '|' + str(o.get('descricao', '')) + '|' + str(o.get('timestamp_criacao', '')))
+                        if idx.get(k):
+                            continue
+                        idx[k] = 1
                     tp_raw = str(o.get('tipo', '')).strip().lower()
                     tp = ('entrada' if tp_raw in ('1','receita','entrada') else ('saida' if tp_raw in ('0','despesa','saida') else tp_raw))
                     cat = str(o.get('categoria','outros') or 'outros').strip().lower()
@@ -1556,7 +1843,6 @@ def extrato_mes():
                         "timestamp_criacao": ts_str,
                     }
                     matches.append(safe)
-                cur = cur + timedelta(days=1)
         except:
             pass
         try:
@@ -1581,10 +1867,11 @@ def extrato_mes():
         }
         try:
             _cache_set_api(cache_key, {
+                "versao": g.get("versao_resposta"),
                 "matches": matches,
                 "total_saida_categoria": float(total_saida_cat or 0),
                 "total_entrada_categoria": float(total_entrada_cat or 0),
-            }, ttl=15)
+            }, ttl=15, cliente_id=cliente_id, geracao=ger)
         except:
             pass
         return jsonify(resp)
@@ -1592,6 +1879,8 @@ def extrato_mes():
         rt = time.time() - start_time
         return jsonify({"sucesso": False, "erro": str(e), "performance": {"response_time_ms": round(rt * 1000, 2)}}), 500
 @app.route('/total/mes', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
 def total_mes():
     """Retorna totais do mês atual ou do mês fornecido."""
     mes_qs = request.args.get("mes")
@@ -1611,24 +1900,18 @@ def total_mes():
         except:
             pass
         root = db.collection('clientes').document(cliente_id)
-        mm_doc = root.collection('meses').document(mes_atual).get()
-        mm = mm_doc.to_dict() or {}
+        # Doc do mês + todos os dias numa única leitura em lote
+        dkeys = day_keys_between(*month_bounds(mes_atual))
+        docs_mes = get_docs_many([root.collection('meses').document(mes_atual)] + [root.collection('dias').document(k) for k in dkeys])
+        mm = (docs_mes[0] if docs_mes else {}) or {}
         try:
-            ano, mes = mes_atual.split("-")
-            dt_ini = f"{ano}-{mes}-01"
-            if mes == "12":
-                dt_fim = f"{int(ano)+1}-01-01"
-            else:
-                dt_fim = f"{ano}-{int(mes)+1:02d}-01"
-            cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-            end = datetime.strptime(dt_fim, "%Y-%m-%d")
-            while cur < end:
-                dkey = cur.strftime("%Y-%m-%d")
+            dias_mes = dict(zip(dkeys, docs_mes[1:]))
+            # Dia sem doc só entra no stream se tiver items (agregado nunca gravado); sondado só se o mês diverge
+            sem_doc = dias_com_itens(cliente_id, _dias_sem_doc_suspeitos(mm, dias_mes))
+            for dkey, dd in dias_mes.items():
                 try:
-                    ddoc = root.collection('dias').document(dkey).get()
-                    dd = ddoc.to_dict() or {}
                     _t = _dd_totais(dd)
-                    need_fix = (float(_t["entrada"] or 0.0) == 0.0 and float(_t["saida"] or 0.0) == 0.0 and float(_t["ajuste"] or 0.0) == 0.0 and float(_t["estorno"] or 0.0) == 0.0)
+                    need_fix = (dkey in sem_doc) or (bool(dd) and (float(_t["entrada"] or 0.0) == 0.0 and float(_t["saida"] or 0.0) == 0.0 and float(_t["ajuste"] or 0.0) == 0.0 and float(_t["estorno"] or 0.0) == 0.0))
                     if need_fix:
                         try:
                             td1 = tr1 = taj1 = tes1 = 0.0
@@ -1656,20 +1939,8 @@ def total_mes():
                                     tes1 += abs(val)
                             if (tr1 != 0.0 or td1 != 0.0 or taj1 != 0.0 or tes1 != 0.0):
                                 saldo_dia = float(tr1 - td1 + tes1 + taj1)
-                                try:
-                                    root.collection('dias').document(dkey).set({
-                                        "totais_dia": {
-                                            "total_entrada": float(tr1 or 0.0),
-                                            "total_saida": float(td1 or 0.0),
-                                            "total_ajuste": float(taj1 or 0.0),
-                                            "total_estorno": float(tes1 or 0.0),
-                                            "saldo_dia": float(saldo_dia or 0.0),
-                                        },
-                                        "quantidade_transacoes_validas": int(cnt_validas or 0),
-                                        "atualizado_em": firestore.SERVER_TIMESTAMP,
-                                    }, merge=True)
-                                except:
-                                    pass
+                                # GET só lê: o doc do dia é refeito pela fila de reparos
+                                agendar_reparo(cliente_id, "dia", dkey)
                                 _t = {
                                     "entrada": float(tr1 or 0.0),
                                     "saida": float(td1 or 0.0),
@@ -1689,12 +1960,11 @@ def total_mes():
                         pass
                 except:
                     pass
-                cur = cur + timedelta(days=1)
         except:
             pass
         saldo = total_receitas - total_despesas + total_estornos + total_ajustes
         try:
-            if (float(total_despesas or 0.0) == 0.0 and float(total_receitas or 0.0) == 0.0 and float(total_ajustes or 0.0) == 0.0 and float(total_estornos or 0.0) == 0.0):
+            if (float(total_despesas or 0.0) == 0.0 and float(total_receitas or 0.0) == 0.0 and float(total_ajustes or 0.0) == 0.0 and float(total_estornos or 0.0) == 0.0) and not cliente_migrado(cliente_id):
                 ano, mes = mes_atual.split("-")
                 dt_ini = f"{ano}-{mes}-01"
                 if mes == "12":
@@ -1707,6 +1977,8 @@ def total_mes():
                     q = root.collection('transacoes').where('data_referencia', '>=', dt_ini).where('data_referencia', '<', dt_fim)
                     for d in q.stream():
                         t = d.to_dict() or {}
+                        if t.get('data_referencia'):
+                            agendar_reparo(cliente_id, "dia", str(t.get('data_referencia'))[:10])
                         if t.get('estornado'):
                             continue
                         tp_raw = str(t.get('tipo', '')).strip().lower()
@@ -1733,18 +2005,10 @@ def total_mes():
         except:
             pass
         try:
-            mdoc = db.collection('clientes').document(cliente_id).collection('meses').document(mes_atual)
-            mdoc.set({
-                "totais_mes": {
-                    "total_entrada": float(total_receitas or 0.0),
-                    "total_saida": float(total_despesas or 0.0),
-                    "total_ajuste": float(total_ajustes or 0.0),
-                    "total_estorno": float(total_estornos or 0.0),
-                    "saldo_mes": float(saldo or 0.0),
-                },
-                "quantidade_transacoes_validas": int(quantidade_transacoes_validas or 0),
-                "atualizado_em": firestore.SERVER_TIMESTAMP,
-            }, merge=True)
+            # Doc do mês divergente da soma dos dias: reparo em segundo plano, sem escrita no GET
+            mt_doc = _mm_totais(mm)
+            if any(abs(float(mt_doc[k]) - float(v or 0.0)) > 1e-6 for k, v in (("entrada", total_receitas), ("saida", total_despesas), ("ajuste", total_ajustes), ("estorno", total_estornos))):
+                agendar_reparo(cliente_id, "mes", mes_atual)
         except:
             pass
         resp = {
@@ -1767,6 +2031,8 @@ def total_mes():
 
 
 @app.route('/total/semana', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
 def total_semana():
     hoje = _now_sp()
     inicio_semana = hoje - timedelta(days=hoje.weekday())
@@ -1783,18 +2049,24 @@ def total_semana():
             ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
         except:
             pass
-        # Itera pelos dias da semana somando agregados
-        dt_cur = inicio_semana
-        while dt_cur.date() <= hoje.date():
-            dkey = dt_cur.strftime("%Y-%m-%d")
-            ddoc = db.collection('clientes').document(cliente_id).collection('dias').document(dkey).get()
-            o = ddoc.to_dict() or {}
-            td = _dd_totais(o)
-            total_despesas += float(td["saida"])
-            total_receitas += float(td["entrada"])
-            total_estornos += float(td["estorno"])
-            total_ajustes += float(td["ajuste"])
-            dt_cur += timedelta(days=1)
+        root = db.collection('clientes').document(cliente_id)
+        wk = week_key(hoje.strftime("%Y-%m-%d"))
+        root_doc, sem_doc = get_docs_many([root, root.collection('semanas').document(wk)])
+        if _agregados_ok(root_doc):
+            # Doc semanal mantido a cada escrita: uma leitura em lote (cliente + semana)
+            st = _agg_totais(sem_doc, "semana")
+            total_despesas = float(st["saida"])
+            total_receitas = float(st["entrada"])
+            total_estornos = float(st["estorno"])
+            total_ajustes = float(st["ajuste"])
+        else:
+            # Cliente ainda sem recompute dos agregados semanais: somar os dias da semana
+            for dkey, o in get_dias_range(cliente_id, inicio_semana.strftime("%Y-%m-%d"), hoje.strftime("%Y-%m-%d"), incluir_fim=True).items():
+                td = _dd_totais(o)
+                total_despesas += float(td["saida"])
+                total_receitas += float(td["entrada"])
+                total_estornos += float(td["estorno"])
+                total_ajustes += float(td["ajuste"])
         saldo = total_receitas - total_despesas + total_estornos + total_ajustes
         return jsonify({
             "sucesso": True,
@@ -1810,7 +2082,171 @@ def total_semana():
         })
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
+def _totais_resposta(t):
+    return {
+        "despesas": float(t.get("saida", 0) or 0),
+        "receitas": float(t.get("entrada", 0) or 0),
+        "saldo": float(t.get("entrada", 0) or 0) - float(t.get("saida", 0) or 0) + float(t.get("estorno", 0) or 0) + float(t.get("ajuste", 0) or 0),
+        "estornos": float(t.get("estorno", 0) or 0),
+        "ajustes": float(t.get("ajuste", 0) or 0),
+    }
+@app.route('/dashboard', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
+def dashboard():
+    """Dia, semana, mês, categorias do mês, extrato de hoje e consistência numa resposta só."""
+    hoje_dt = _now_sp()
+    hoje = hoje_dt.strftime("%Y-%m-%d")
+    mes = hoje_dt.strftime("%Y-%m")
+    inicio_semana = (hoje_dt - timedelta(days=hoje_dt.weekday())).strftime("%Y-%m-%d")
+    try:
+        db = get_db()
+        cliente_id = str(request.args.get("cliente_id") or "default")
+        cliente_nome = request.args.get("cliente_nome")
+        cliente_username = request.args.get("username")
+        include_trans = str(request.args.get("include_transacoes", "true")).strip().lower() != "false"
+        try:
+            ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
+        except:
+            pass
+        root = db.collection('clientes').document(cliente_id)
+        # Uma leitura em lote: cliente, mês, semana e os dias do mês (mais os da semana que caem no mês anterior)
+        dt_ini, dt_fim = month_bounds(mes)
+        dias_keys = day_keys_between(min(inicio_semana, dt_ini), dt_fim)
+        wk = week_key(hoje)
+        refs = [root, root.collection('meses').document(mes), root.collection('semanas').document(wk)]
+        refs += [root.collection('dias').document(k) for k in dias_keys]
+        docs = get_docs_many(refs)
+        root_doc, mm, sem_doc = (docs + [{}, {}, {}])[:3]
+        dias = {k: (docs[3 + i] if 3 + i < len(docs) else {}) or {} for i, k in enumerate(dias_keys)}
+        transacoes = []
+        if include_trans:
+            try:
+                transacoes = listar_transacoes_dia(cliente_id, hoje)
+            except:
+                transacoes = []
+        # Dia
+        dd = dias.get(hoje, {}) or {}
+        t_dia = _dd_totais(dd)
+        qtd_dia_ag = int(dd.get("quantidade_transacoes_validas", dd.get("quantidade_transacoes", 0)) or 0)
+        qtd_dia = qtd_dia_ag
+        if include_trans:
+            acc = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+            qtd_dia = 0
+            for t in transacoes:
+                tp = str(t.get('tipo', '')).strip().lower()
+                val = float(t.get('valor', 0) or 0)
+                if tp in ('estorno',):
+                    acc["estorno"] += abs(val)
+                    continue
+                if bool(t.get('estornado', False)):
+                    continue
+                if tp in ('entrada', '1', 'receita'):
+                    acc["entrada"] += val
+                elif tp in ('saida', '0', 'despesa'):
+                    acc["saida"] += val
+                elif tp in ('ajuste',):
+                    acc["ajuste"] += val
+                else:
+                    continue
+                qtd_dia += 1
+            if qtd_dia != qtd_dia_ag or any(abs(float(acc[k]) - float(t_dia[k])) > 1e-6 for k in acc):
+                # agregado do dia atrasado: responder com o que está nos itens e deixar o reparo para a fila
+                t_dia = acc
+                try:
+                    agendar_reparo(cliente_id, "dia", hoje)
+                except:
+                    pass
+        # Semana
+        if _agregados_ok(root_doc):
+            t_sem = _agg_totais(sem_doc, "semana")
+        else:
+            t_sem = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+            for k in day_keys_between(inicio_semana, hoje, incluir_fim=True):
+                td = _dd_totais(dias.get(k, {}) or {})
+                for c in t_sem:
+                    t_sem[c] += float(td[c])
+        # Mês: doc do mês x soma dos dias
+        t_mes = _mm_totais(mm)
+        soma = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+        qtd_soma = 0
+        cats_dias = {"entrada": {}, "saida": {}}
+        for k in day_keys_between(dt_ini, dt_fim):
+            o = dias.get(k, {}) or {}
+            if not o:
+                continue
+            td = _dd_totais(o)
+            for c in soma:
+                soma[c] += float(td[c])
+            qtd_soma += int(o.get("quantidade_transacoes_validas", o.get("quantidade_transacoes", 0)) or 0)
+            cd = _dd_categorias(o)
+            for tp in cats_dias:
+                for cat, v in (cd.get(tp, {}) or {}).items():
+                    cats_dias[tp][cat] = float(cats_dias[tp].get(cat, 0.0) or 0.0) + float(v or 0)
+        consistente_mes = all(abs(float(soma[c]) - float(t_mes[c])) < 1e-6 for c in soma)
+        if consistente_mes:
+            cm = _mm_categorias(mm)
+            cats_mes = {"despesas": _normalize_catmap(cm.get("saida")), "receitas": _normalize_catmap(cm.get("entrada"))}
+            qtd_mes = int(mm.get("quantidade_transacoes_validas", mm.get("quantidade_transacoes", 0)) or 0) or qtd_soma
+        else:
+            t_mes = soma
+            cats_mes = {"despesas": _normalize_catmap(cats_dias["saida"]), "receitas": _normalize_catmap(cats_dias["entrada"])}
+            qtd_mes = qtd_soma
+            try:
+                agendar_reparo(cliente_id, "mes", mes)
+            except:
+                pass
+        # Saldos acumulados
+        if _agregados_ok(root_doc):
+            saldo_geral = float(_agg_totais(root_doc, "geral")["saldo"])
+        else:
+            saldo_geral = float((root_doc or {}).get("saldo_real", 0) or 0)
+        saldo_anterior = None
+        try:
+            if _agregados_ok(root_doc, 3):
+                saldo_anterior = saldo_anterior_gravado(root_doc, mes, mm, cliente_id=cliente_id)
+        except:
+            saldo_anterior = None
+        tot_mes = _totais_resposta(t_mes)
+        saldo_real_mes = (saldo_anterior + tot_mes["saldo"]) if saldo_anterior is not None else saldo_geral
+        return jsonify({
+            "sucesso": True,
+            "cliente_id": cliente_id,
+            "data": hoje,
+            "dia": {
+                "total": _totais_resposta(t_dia),
+                "quantidade_transacoes_validas": int(qtd_dia),
+            },
+            "semana": {
+                "inicio": inicio_semana,
+                "fim": hoje,
+                "total": _totais_resposta(t_sem),
+            },
+            "mes": {
+                "mes": mes,
+                "total": {**tot_mes, "saldo_real": float(saldo_real_mes)},
+                "quantidade_transacoes_validas": int(qtd_mes),
+                "saldo_anterior": saldo_anterior,
+                "categorias": cats_mes,
+            },
+            "geral": {"saldo_real": float(saldo_geral)},
+            "extrato": {
+                "data": hoje,
+                "transacoes": transacoes,
+            },
+            "consistencia": {
+                "mes": {
+                    "consistente_totais": bool(consistente_mes),
+                    "soma_dias": {**_totais_resposta(soma), "quantidade_transacoes_validas": int(qtd_soma)},
+                },
+            },
+            "plano": {"docs_lidos": len(refs)},
+        })
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/total/geral', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
 def total_geral():
     total_despesas = 0.0
     total_receitas = 0.0
@@ -1825,13 +2261,22 @@ def total_geral():
             ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
         except:
             pass
-        for m in db.collection('clientes').document(cliente_id).collection('meses').stream():
-            o = m.to_dict() or {}
-            mt = _mm_totais(o)
-            total_despesas += float(mt["saida"])
-            total_receitas += float(mt["entrada"])
-            total_estornos += float(mt["estorno"])
-            total_ajustes += float(mt["ajuste"])
+        root = db.collection('clientes').document(cliente_id)
+        root_doc = root.get().to_dict() or {}
+        if _agregados_ok(root_doc):
+            gt = _agg_totais(root_doc, "geral")
+            total_despesas = float(gt["saida"])
+            total_receitas = float(gt["entrada"])
+            total_estornos = float(gt["estorno"])
+            total_ajustes = float(gt["ajuste"])
+        else:
+            for m in root.collection('meses').stream():
+                o = m.to_dict() or {}
+                mt = _mm_totais(o)
+                total_despesas += float(mt["saida"])
+                total_receitas += float(mt["entrada"])
+                total_estornos += float(mt["estorno"])
+                total_ajustes += float(mt["ajuste"])
         saldo = total_receitas - total_despesas + total_estornos + total_ajustes
         return jsonify({
             "sucesso": True,
@@ -1845,6 +2290,46 @@ def total_geral():
         })
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
+@app.route('/total/ano', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
+def total_ano():
+    ano = str(request.args.get("ano") or _now_sp().strftime("%Y"))
+    try:
+        db = get_db()
+        cliente_id = str(request.args.get("cliente_id") or "default")
+        cliente_nome = request.args.get("cliente_nome")
+        cliente_username = request.args.get("username")
+        try:
+            ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
+        except:
+            pass
+        root = db.collection('clientes').document(cliente_id)
+        root_doc, ano_doc = get_docs_many([root, root.collection('anos').document(ano)])
+        if _agregados_ok(root_doc):
+            at = _agg_totais(ano_doc, "ano")
+        else:
+            at = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+            mkeys = [f"{ano}-{m:02d}" for m in range(1, 13)]
+            for mm in get_docs_many([root.collection('meses').document(k) for k in mkeys]):
+                mt = _mm_totais(mm or {})
+                for k in ("entrada", "saida", "ajuste", "estorno"):
+                    at[k] += float(mt[k])
+        saldo = at["entrada"] - at["saida"] + at["estorno"] + at["ajuste"]
+        return jsonify({
+            "sucesso": True,
+            "ano": ano,
+            "total": {
+                "despesas": float(at["saida"]),
+                "receitas": float(at["entrada"]),
+                "saldo": float(saldo),
+                "estornos": float(at["estorno"]),
+                "ajustes": float(at["ajuste"])
+            },
+            "categorias": (_mm_categorias(ano_doc or {}) if _agregados_ok(root_doc) else None)
+        })
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/migrar/transacoes', methods=['POST'])
 def migrar_transacoes():
     data = request.json
@@ -1876,12 +2361,32 @@ def migrar_todos():
     try:
         delete_original = bool(data.get("delete_original", False))
         recompute = bool(data.get("recompute", True))
+        workers = int(data.get("workers")) if data.get("workers") else None
+        job_id = str(data.get("job_id") or "").strip() or None
+        aguardar = bool(data.get("aguardar", False))
     except:
         return jsonify({"sucesso": False, "erro": "Campos inválidos"}), 400
     try:
-        from app.services.database import migrate_all_clientes
-        res = migrate_all_clientes(delete_original=delete_original, recompute=recompute)
-        return jsonify({"sucesso": True, "resultado": res})
+        from app.services.database import migrate_all_clientes, iniciar_migracao_em_segundo_plano
+        if aguardar:
+            res = migrate_all_clientes(delete_original=delete_original, recompute=recompute, workers=workers, job_id=job_id)
+            return jsonify({"sucesso": True, "resultado": res})
+        # Job em segundo plano com checkpoint por cliente; mesmo job_id retoma de onde parou
+        job_id, iniciado = iniciar_migracao_em_segundo_plano(delete_original=delete_original, recompute=recompute, workers=workers, job_id=job_id)
+        return jsonify({"sucesso": True, "job_id": job_id, "iniciado": iniciado, "status_url": f"/migrar/todos/status?job_id={job_id}"}), 202
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
+@app.route('/migrar/todos/status', methods=['GET'])
+def migrar_todos_status():
+    job_id = str(request.args.get("job_id") or "").strip()
+    if not job_id:
+        return jsonify({"sucesso": False, "erro": "job_id obrigatório"}), 400
+    try:
+        from app.services.database import status_job
+        st = status_job(job_id)
+        if st is None:
+            return jsonify({"sucesso": False, "erro": "job não encontrado"}), 404
+        return jsonify({"sucesso": True, "job_id": job_id, "job": st})
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/recompute/cliente', methods=['POST'])
@@ -1893,6 +2398,7 @@ def recompute_cliente():
         cliente_id = str(data.get("cliente_id") or request.args.get("cliente_id") or "default")
         cliente_nome = str(data.get("cliente_nome") or request.args.get("cliente_nome") or "")
         cliente_username = str(data.get("username") or request.args.get("username") or "")
+        modo = str(data.get("modo") or request.args.get("modo") or "incremental").strip().lower()
     except:
         return jsonify({"sucesso": False, "erro": "Campos inválidos"}), 400
     try:
@@ -1900,7 +2406,10 @@ def recompute_cliente():
             ensure_cliente(cliente_id, nome=cliente_nome, username=cliente_username)
         except:
             pass
-        res = recompute_cliente_aggregates(cliente_id)
+        if modo in ("completo", "full"):
+            res = recompute_cliente_aggregates(cliente_id)
+        else:
+            res = recompute_cliente_incremental(cliente_id)
         db = get_db()
         root = db.collection('clientes').document(cliente_id)
         mes_atual = _month_key_sp()
@@ -1926,6 +2435,7 @@ def rebuild_cliente():
         cliente_id = str(data.get("cliente_id") or request.args.get("cliente_id") or "default")
         purge_days = bool(data.get("purge_days", True))
         purge_months = bool(data.get("purge_months", True))
+        modo = str(data.get("modo") or request.args.get("modo") or "geracao").strip().lower()
         cliente_nome = str(data.get("cliente_nome") or request.args.get("cliente_nome") or "")
         cliente_username = str(data.get("username") or request.args.get("username") or "")
     except:
@@ -1936,8 +2446,14 @@ def rebuild_cliente():
         except:
             pass
         from app.services.database import purge_cliente_aggregates, recompute_cliente_aggregates
-        res_purge = purge_cliente_aggregates(cliente_id, purge_days=purge_days, purge_months=purge_months)
-        res_recompute = recompute_cliente_aggregates(cliente_id)
+        if modo == "purge":
+            # modo antigo: apaga tudo e recalcula (leitores veem totais zerados no meio)
+            res_purge = purge_cliente_aggregates(cliente_id, purge_days=purge_days, purge_months=purge_months)
+            res_recompute = recompute_cliente_aggregates(cliente_id)
+        else:
+            # geração nova gravada por cima da antiga; o que sobrar da antiga é apagado no fim
+            res_recompute = recompute_cliente_aggregates(cliente_id, substituir=True)
+            res_purge = {"cliente_id": cliente_id, "modo": "geracao", "docs_antigos_removidos": res_recompute.get("docs_antigos_removidos", 0)}
         db = get_db()
         root = db.collection('clientes').document(cliente_id)
         mes_atual = _month_key_sp()
@@ -1955,6 +2471,8 @@ def rebuild_cliente():
     except Exception as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/saldo/atual', methods=['GET'])
+@_etag_versao
+@_cache_resposta()
 def saldo_atual():
     inicio = request.args.get('inicio')
     fim = request.args.get('fim')
@@ -1997,6 +2515,7 @@ def saldo_atual():
         root = db.collection('clientes').document(cliente_id)
         # Caminho otimizado: sem agrupamento por categoria e sem filtros → usar agregados
         if not group_by and not cats and not tipo_filter:
+            plano = None
             if mes:
                 try:
                     ano, m = mes.split("-")
@@ -2005,13 +2524,9 @@ def saldo_atual():
                         dt_fim = f"{int(ano)+1}-01-01"
                     else:
                         dt_fim = f"{ano}-{int(m)+1:02d}-01"
-                    dt_cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-                    dt_end = datetime.strptime(dt_fim, "%Y-%m-%d")
                     td = tr = taj = tes = 0.0
-                    while dt_cur < dt_end:
-                        dkey = dt_cur.strftime("%Y-%m-%d")
+                    for dkey, dd in get_dias_range(cliente_id, dt_ini, dt_fim).items():
                         try:
-                            dd = root.collection('dias').document(dkey).get().to_dict() or {}
                             _t = _dd_totais(dd)
                             td += float(_t["saida"])
                             tr += float(_t["entrada"])
@@ -2019,30 +2534,23 @@ def saldo_atual():
                             tes += float(_t["estorno"])
                         except:
                             pass
-                        dt_cur = dt_cur + timedelta(days=1)
                     total_despesas = float(td or 0)
                     total_receitas = float(tr or 0)
                     total_ajustes = float(taj or 0)
                     total_estornos = float(tes or 0)
                     saldo = total_receitas - total_despesas + total_estornos + total_ajustes
-                    try:
-                        root.collection('meses').document(mes).set({
-                            "totais_mes": {
-                                "total_entrada": total_receitas,
-                                "total_saida": total_despesas,
-                                "total_ajuste": total_ajustes,
-                                "total_estorno": total_estornos,
-                                "saldo_mes": saldo,
-                            },
-                            "atualizado_em": firestore.SERVER_TIMESTAMP,
-                        }, merge=True)
-                    except:
-                        pass
                 except:
                     pass
                 try:
-                    sr = 0.0
-                    for mdoc2 in root.collection('meses').stream():
+                    # Índice de saldo acumulado: saldo_anterior do mês + saldo do mês, sem varrer os meses
+                    anterior, _mm, _lidos = saldo_anterior_mes(cliente_id, mes)
+                    if abs(float(_mm_totais(_mm)["saldo"]) - float(saldo)) > 1e-6:
+                        agendar_reparo(cliente_id, "mes", mes)
+                except:
+                    anterior = None
+                try:
+                    sr = (float(anterior) + float(saldo)) if anterior is not None else 0.0
+                    for mdoc2 in (root.collection('meses').stream() if anterior is None else []):
                         mid = str(mdoc2.id or "")
                         if mid and mid <= mes:
                             mo = mdoc2.to_dict() or {}
@@ -2061,59 +2569,62 @@ def saldo_atual():
                                     + float((mo.get("totais_mes", {}) or {}).get("total_ajuste", mo.get("total_ajuste", 0)) or 0)
                                 )
                             sr += float(v or 0)
-                    saldo_real = float(sr or saldo)
+                    saldo_real = float(sr or saldo) if anterior is None else float(sr)
                 except:
                     saldo_real = saldo
             elif dt_ini and dt_fim:
-                # Somar agregados de 'dias' iterando pelo intervalo
-                dt_cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-                dt_end = datetime.strptime(dt_fim, "%Y-%m-%d")
-                # Inclusivo em dt_end
-                while dt_cur <= dt_end:
-                    dkey = dt_cur.strftime("%Y-%m-%d")
-                    ddoc = root.collection('dias').document(dkey).get()
-                    dd = ddoc.to_dict() or {}
-                    td = _dd_totais(dd)
-                    total_despesas += float(td["saida"])
-                    total_receitas += float(td["entrada"])
-                    total_ajustes += float(td["ajuste"])
-                    total_estornos += float(td["estorno"])
-                    dt_cur += timedelta(days=1)
+                # Planejador: anos/meses inteiros vêm dos docs de agregado, só as bordas leem 'dias'
+                dtf = datetime.strptime(dt_fim, "%Y-%m-%d")
+                mes_f = dtf.strftime("%Y-%m")
+                try:
+                    base_root = root.get().to_dict() or {}
+                except:
+                    base_root = {}
+                r = somar_intervalo(cliente_id, dt_ini, dt_fim, incluir_fim=True, root_doc=base_root)
+                plano = dict(r["plano"])
+                plano["docs_lidos"] = int(plano["docs_lidos"]) + 1
+                total_despesas = float(r["totais"]["saida"])
+                total_receitas = float(r["totais"]["entrada"])
+                total_ajustes = float(r["totais"]["ajuste"])
+                total_estornos = float(r["totais"]["estorno"])
                 saldo_real = None
                 try:
-                    dtf = datetime.strptime(dt_fim, "%Y-%m-%d")
-                    mes_f = dtf.strftime("%Y-%m")
-                    sr = 0.0
-                    for mdoc3 in root.collection('meses').stream():
+                    # saldo_real = acumulado antes do mês final + parte do mês final até 'fim'
+                    r_f = r if dt_ini == f"{mes_f}-01" else somar_intervalo(cliente_id, f"{mes_f}-01", dt_fim, incluir_fim=True, root_doc=base_root)
+                    if r_f is not r:
+                        plano["docs_lidos"] += int(r_f["plano"]["docs_lidos"])
+                    anterior, _mm, _lidos = saldo_anterior_mes(cliente_id, mes_f, root_doc=base_root)
+                    plano["docs_lidos"] += int(_lidos)
+                    sr = float(anterior) if anterior is not None else 0.0
+                    for mdoc3 in (root.collection('meses').stream() if anterior is None else []):
                         mid = str(mdoc3.id or "")
                         if mid and mid < mes_f:
                             mo = mdoc3.to_dict() or {}
-                            try:
-                                v = float(mo.get("saldo_mes")) if mo.get("saldo_mes") is not None else (
-                                    float(mo.get("total_entrada", 0) or 0) - float(mo.get("total_saida", 0) or 0) + float(mo.get("total_estorno", 0) or 0) + float(mo.get("total_ajuste", 0) or 0)
-                                )
-                            except:
-                                v = (float(mo.get("total_entrada", 0) or 0) - float(mo.get("total_saida", 0) or 0) + float(mo.get("total_estorno", 0) or 0) + float(mo.get("total_ajuste", 0) or 0))
-                            sr += float(v or 0)
-                    base = datetime.strptime(f"{mes_f}-01", "%Y-%m-%d")
-                    cur2 = base
-                    while cur2 <= dtf:
-                        k = cur2.strftime("%Y-%m-%d")
-                        try:
-                            dd2 = root.collection('dias').document(k).get().to_dict() or {}
-                            td2 = _dd_totais(dd2)
-                            sr += float(td2["entrada"]) - float(td2["saida"]) + float(td2["estorno"]) + float(td2["ajuste"])
-                        except:
-                            pass
-                        cur2 = cur2 + timedelta(days=1)
+                            sr += float(_mm_totais(mo)["entrada"]) - float(_mm_totais(mo)["saida"]) + float(_mm_totais(mo)["estorno"]) + float(_mm_totais(mo)["ajuste"])
+                    sr += float(r_f["totais"]["saldo"])
                     saldo_real = float(sr or 0)
                 except:
                     saldo_real = None
             else:
-                # Sem intervalo: somar todos os meses do cliente
+                # Sem intervalo: totais gerais mantidos no doc do cliente; sem eles, somar todos os meses
                 sr = 0.0
                 sr_count = 0
-                for m in root.collection('meses').stream():
+                try:
+                    base_root = root.get().to_dict() or {}
+                except:
+                    base_root = {}
+                meses_iter = []
+                if _agregados_ok(base_root):
+                    gt = _agg_totais(base_root, "geral")
+                    total_despesas = float(gt["saida"])
+                    total_receitas = float(gt["entrada"])
+                    total_ajustes = float(gt["ajuste"])
+                    total_estornos = float(gt["estorno"])
+                    sr = float(gt["saldo"])
+                    sr_count = 1
+                else:
+                    meses_iter = root.collection('meses').stream()
+                for m in meses_iter:
                     mm = m.to_dict() or {}
                     mt2 = _mm_totais(mm)
                     total_despesas += float(mt2["saida"])
@@ -2129,7 +2640,6 @@ def saldo_atual():
                     sr += float(v or 0)
                     sr_count += 1
                 try:
-                    base_root = root.get().to_dict() or {}
                     saldo_real_root = float(base_root.get("saldo_real")) if base_root.get("saldo_real") is not None else None
                 except:
                     saldo_real_root = None
@@ -2148,7 +2658,7 @@ def saldo_atual():
             if not mes and not dt_ini and not dt_fim:
                 if saldo_real is None:
                     saldo_real = saldo
-            return jsonify({
+            resp = {
                 "sucesso": True,
                 "filtros": {
                     "inicio": dt_ini,
@@ -2166,7 +2676,10 @@ def saldo_atual():
                     "estornos": total_estornos,
                     "ajustes": total_ajustes
                 }
-            })
+            }
+            if plano:
+                resp["plano"] = plano
+            return jsonify(resp)
         if group_by == 'categoria' and mes:
             mdoc = root.collection('meses').document(mes).get()
             mm = mdoc.to_dict() or {}
@@ -2174,6 +2687,7 @@ def saldo_atual():
             cat_exp = _normalize_catmap(cats_mm.get("saida", {}) or {})
             cat_inc = _normalize_catmap(cats_mm.get("entrada", {}) or {})
             cat_est = _normalize_catmap(cats_mm.get("estorno", {}) or {})
+            dias_mes = None
             recalc = False
             try:
                 mt = _mm_totais(mm)
@@ -2193,15 +2707,9 @@ def saldo_atual():
                         dt_fim = f"{int(ano)+1}-01-01"
                     else:
                         dt_fim = f"{ano}-{int(m)+1:02d}-01"
-                    dt_cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-                    dt_end = datetime.strptime(dt_fim, "%Y-%m-%d")
-                    while dt_cur < dt_end:
-                        dkey = dt_cur.strftime("%Y-%m-%d")
-                        try:
-                            ddoc = root.collection('dias').document(dkey).get()
-                            dd = ddoc.to_dict() or {}
-                        except:
-                            dd = {}
+                    if dias_mes is None:
+                        dias_mes = get_dias_mes(cliente_id, mes)
+                    for dkey, dd in dias_mes.items():
                         try:
                             dc = _dd_categorias(dd)
                             for k, v in dict(dc.get("saida", {}) or {}).items():
@@ -2212,36 +2720,13 @@ def saldo_atual():
                                 cat_est[k] = float(cat_est.get(k, 0) or 0) + float(v or 0)
                         except:
                             pass
-                        dt_cur = dt_cur + timedelta(days=1)
                     try:
-                        mdoc_set = root.collection('meses').document(mes)
-                        mdoc_set.set({
-                            "categorias": {
-                                "saida": {k: float(v or 0) for k, v in _normalize_catmap(cat_exp).items()},
-                                "entrada": {k: float(v or 0) for k, v in _normalize_catmap(cat_inc).items()},
-                                "estorno": {k: float(v or 0) for k, v in _normalize_catmap(cat_est).items()},
-                                "ajuste": dict((mm.get("categorias", {}) or {}).get("ajuste", {}) or {}),
-                            },
-                            "totais_por_tipo": {
-                                "saida": float(sum(_normalize_catmap(cat_exp).values()) or 0.0),
-                                "entrada": float(sum(_normalize_catmap(cat_inc).values()) or 0.0),
-                                "estorno": float(sum(_normalize_catmap(cat_est).values()) or 0.0),
-                                "ajuste": float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or float((mm.get("totais_por_tipo", {}) or {}).get("ajuste", 0.0))),
-                            },
-                            "totais_mes": {
-                                "total_saida": float(sum(_normalize_catmap(cat_exp).values()) or mm_total_saida),
-                                "total_entrada": float(sum(_normalize_catmap(cat_inc).values()) or mm_total_entrada),
-                                "total_estorno": float(sum(_normalize_catmap(cat_est).values()) or float((mm.get("totais_mes", {}) or {}).get("total_estorno", 0.0))),
-                                "total_ajuste": float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or float((mm.get("totais_mes", {}) or {}).get("total_ajuste", 0.0))),
-                                "saldo_mes": float((float(sum(_normalize_catmap(cat_inc).values()) or mm_total_entrada) - float(sum(_normalize_catmap(cat_exp).values()) or mm_total_saida) + float(sum(_normalize_catmap(cat_est).values()) or 0.0) + float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or 0.0))),
-                            },
-                            "atualizado_em": firestore.SERVER_TIMESTAMP,
-                        }, merge=True)
+                        agendar_reparo(cliente_id, "mes", mes)
                     except:
                         pass
                 except:
                     pass
-            if not cat_exp and not cat_inc and not cat_est:
+            if not cat_exp and not cat_inc and not cat_est and not cliente_migrado(cliente_id):
                 try:
                     ano, m = mes.split("-")
                     dt_ini = f"{ano}-{m}-01"
@@ -2252,6 +2737,8 @@ def saldo_atual():
                     q = root.collection('transacoes').where('data_referencia', '>=', dt_ini).where('data_referencia', '<', dt_fim)
                     for d in q.stream():
                         t = d.to_dict() or {}
+                        if t.get('data_referencia'):
+                            agendar_reparo(cliente_id, "dia", str(t.get('data_referencia'))[:10])
                         if t.get('estornado'):
                             continue
                         tp_raw = str(t.get('tipo', '')).strip().lower()
@@ -2264,29 +2751,7 @@ def saldo_atual():
                         elif tp_raw in ('estorno',):
                             cat_est[cat] = float(cat_est.get(cat, 0) or 0) + abs(val)
                     try:
-                        mdoc_set = root.collection('meses').document(mes)
-                        mdoc_set.set({
-                            "categorias": {
-                                "saida": {k: float(v or 0) for k, v in _normalize_catmap(cat_exp).items()},
-                                "entrada": {k: float(v or 0) for k, v in _normalize_catmap(cat_inc).items()},
-                                "estorno": {k: float(v or 0) for k, v in _normalize_catmap(cat_est).items()},
-                                "ajuste": dict((mm.get("categorias", {}) or {}).get("ajuste", {}) or {}),
-                            },
-                            "totais_por_tipo": {
-                                "saida": float(sum(_normalize_catmap(cat_exp).values()) or 0.0),
-                                "entrada": float(sum(_normalize_catmap(cat_inc).values()) or 0.0),
-                                "estorno": float(sum(_normalize_catmap(cat_est).values()) or 0.0),
-                                "ajuste": float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or float((mm.get("totais_por_tipo", {}) or {}).get("ajuste", 0.0))),
-                            },
-                            "totais_mes": {
-                                "total_saida": float(sum(_normalize_catmap(cat_exp).values()) or 0.0),
-                                "total_entrada": float(sum(_normalize_catmap(cat_inc).values()) or 0.0),
-                                "total_estorno": float(sum(_normalize_catmap(cat_est).values()) or 0.0),
-                                "total_ajuste": float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or float((mm.get("totais_mes", {}) or {}).get("total_ajuste", 0.0))),
-                                "saldo_mes": float((float(sum(_normalize_catmap(cat_inc).values()) or 0.0) - float(sum(_normalize_catmap(cat_exp).values()) or 0.0) + float(sum(_normalize_catmap(cat_est).values()) or 0.0) + float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or 0.0))),
-                            },
-                            "atualizado_em": firestore.SERVER_TIMESTAMP,
-                        }, merge=True)
+                        agendar_reparo(cliente_id, "mes", mes)
                     except:
                         pass
                 except:
@@ -2310,17 +2775,12 @@ def saldo_atual():
                         dt_fim = f"{int(ano)+1}-01-01"
                     else:
                         dt_fim = f"{ano}-{int(m)+1:02d}-01"
-                    dt_cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-                    dt_end = datetime.strptime(dt_fim, "%Y-%m-%d")
                     cat_exp = {}
                     cat_inc = {}
                     cat_est = {}
-                    while dt_cur < dt_end:
-                        dkey = dt_cur.strftime("%Y-%m-%d")
-                        try:
-                            dd = root.collection('dias').document(dkey).get().to_dict() or {}
-                        except:
-                            dd = {}
+                    if dias_mes is None:
+                        dias_mes = get_dias_mes(cliente_id, mes)
+                    for dkey, dd in dias_mes.items():
                         try:
                             _c = _dd_categorias(dd)
                             for k, v in dict(_c.get("saida", {}) or {}).items():
@@ -2331,46 +2791,8 @@ def saldo_atual():
                                 cat_est[k] = float(cat_est.get(k, 0) or 0) + float(v or 0)
                         except:
                             pass
-                        dt_cur = dt_cur + timedelta(days=1)
                     try:
-                        mdoc_set2 = root.collection('meses').document(mes)
-                        sum_exp = float(sum(_normalize_catmap(cat_exp).values()) or 0.0)
-                        sum_inc = float(sum(_normalize_catmap(cat_inc).values()) or 0.0)
-                        sum_est = float(sum(_normalize_catmap(cat_est).values()) or 0.0)
-                        sum_adj = float(sum((mm.get("categorias", {}) or {}).get("ajuste", {}).values()) or float((mm.get("totais_por_tipo", {}) or {}).get("ajuste", 0.0)))
-                        # Manter consistência: não sobrescrever totais do mês com 0 se já existem valores
-                        mt_existing = _mm_totais(mm)
-                        mm_total_saida = float(mt_existing["saida"])
-                        mm_total_entrada = float(mt_existing["entrada"])
-                        mm_total_estorno = float(mt_existing["estorno"])
-                        mm_total_ajuste = float(mt_existing["ajuste"])
-                        total_saida_new = float(sum_exp or mm_total_saida)
-                        total_entrada_new = float(sum_inc or mm_total_entrada)
-                        total_estorno_new = float(sum_est or mm_total_estorno)
-                        total_ajuste_new = float(sum_adj or mm_total_ajuste)
-                        saldo_new = float(total_entrada_new - total_saida_new + total_estorno_new + total_ajuste_new)
-                        mdoc_set2.set({
-                            "categorias": {
-                                "saida": {k: float(v or 0) for k, v in _normalize_catmap(cat_exp).items()},
-                                "entrada": {k: float(v or 0) for k, v in _normalize_catmap(cat_inc).items()},
-                                "estorno": {k: float(v or 0) for k, v in _normalize_catmap(cat_est).items()},
-                                "ajuste": dict((mm.get("categorias", {}) or {}).get("ajuste", {}) or {}),
-                            },
-                            "totais_por_tipo": {
-                                "saida": float(sum_exp or mm_total_saida),
-                                "entrada": float(sum_inc or mm_total_entrada),
-                                "estorno": float(sum_est or mm_total_estorno),
-                                "ajuste": float(sum_adj or mm_total_ajuste),
-                            },
-                            "totais_mes": {
-                                "total_saida": total_saida_new,
-                                "total_entrada": total_entrada_new,
-                                "total_estorno": total_estorno_new,
-                                "total_ajuste": total_ajuste_new,
-                                "saldo_mes": saldo_new,
-                            },
-                            "atualizado_em": firestore.SERVER_TIMESTAMP,
-                        }, merge=True)
+                        agendar_reparo(cliente_id, "mes", mes)
                     except:
                         pass
                 except:
@@ -2417,6 +2839,60 @@ def saldo_atual():
                 }
             }
             return jsonify(resp)
+        if not mes and dt_ini and dt_fim and group_by in (None, '', 'categoria'):
+            # Intervalo com filtros/agrupamento: mesmo planejador dos totais, categorias dos agregados
+            r = somar_intervalo(cliente_id, dt_ini, dt_fim, incluir_fim=True)
+            rc = r["categorias"]
+            cat_exp = _normalize_catmap(rc.get("saida", {}))
+            cat_inc = _normalize_catmap(rc.get("entrada", {}))
+            cat_est = _normalize_catmap(rc.get("estorno", {}))
+            if cats:
+                cat_exp = {k: v for k, v in cat_exp.items() if k in cats}
+                cat_inc = {k: v for k, v in cat_inc.items() if k in cats}
+                cat_est = {k: v for k, v in cat_est.items() if k in cats}
+            if tipo_filter == 'saida':
+                cat_inc = {}
+            elif tipo_filter == 'entrada':
+                cat_exp = {}
+                cat_est = {}
+            if cats or tipo_filter:
+                total_despesas = sum(float(v or 0) for v in cat_exp.values())
+                total_receitas = sum(float(v or 0) for v in cat_inc.values())
+                total_estornos = sum(float(v or 0) for v in cat_est.values())
+                total_ajustes = 0.0
+            else:
+                total_despesas = float(r["totais"]["saida"])
+                total_receitas = float(r["totais"]["entrada"])
+                total_estornos = float(r["totais"]["estorno"])
+                total_ajustes = float(r["totais"]["ajuste"])
+            saldo = total_receitas - total_despesas + total_estornos + total_ajustes
+            resp = {
+                "sucesso": True,
+                "filtros": {
+                    "inicio": dt_ini,
+                    "fim": dt_fim,
+                    "mes": mes,
+                    "categorias": cats or [],
+                    "tipo": tipo_filter,
+                    "cliente_id": cliente_id,
+                },
+                "total": {
+                    "despesas": total_despesas,
+                    "receitas": total_receitas,
+                    "saldo": saldo,
+                    "estornos": total_estornos,
+                    "ajustes": total_ajustes
+                },
+                "plano": r["plano"],
+            }
+            if group_by == 'categoria':
+                resp["categorias"] = {
+                    "despesas": cat_exp,
+                    "receitas": cat_inc,
+                    "estornos": cat_est,
+                    "ajustes": _normalize_catmap(rc.get("ajuste", {})),
+                }
+            return jsonify(resp)
         # Caminho com agrupamento por categoria ou filtros → stream de transações do cliente
         # Preparar janela de consulta
         tcoll = root.collection('transacoes')
@@ -2500,6 +2976,83 @@ def health():
         "timestamp": _now_sp().isoformat(),
         "servico": "API Financeira"
     })
+@app.route('/debug/perfis', methods=['GET'])
+def debug_perfis():
+    # Perfis mais lentos entre os recentes; só com PROFILER_TOKEN definido, enviado em X-Profile-Token
+    if not _profiler.habilitado():
+        return jsonify({"sucesso": False, "erro": "profiler desabilitado"}), 404
+    if not _profiler.token_ok(request.headers.get("X-Profile-Token")):
+        return jsonify({"sucesso": False, "erro": "não autorizado"}), 403
+    try:
+        limite = int(request.args.get("limite", "20") or 20)
+        min_ms = float(request.args.get("min_ms", "0") or 0)
+        return jsonify({"sucesso": True, "diretorio": _profiler.diretorio(), "perfis": _profiler.listar(limite=limite, min_ms=min_ms)})
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
+@app.route('/debug/perfis/<perfil_id>', methods=['GET'])
+def debug_perfil(perfil_id):
+    # Pilhas no formato collapsed (flamegraph.pl, speedscope, inferno)
+    if not _profiler.habilitado():
+        return jsonify({"sucesso": False, "erro": "profiler desabilitado"}), 404
+    if not _profiler.token_ok(request.headers.get("X-Profile-Token")):
+        return jsonify({"sucesso": False, "erro": "não autorizado"}), 403
+    txt = _profiler.ler(perfil_id)
+    if txt is None:
+        return jsonify({"sucesso": False, "erro": "perfil não encontrado"}), 404
+    return app.response_class(txt, mimetype="text/plain")
+@app.route('/metrics', methods=['GET'])
+def metrics_prometheus():
+    extras = {}
+    try:
+        extras["apifinanceira_extracao_fonte_total"] = ("counter", "Transacoes extraidas por fonte.", {(("fonte", k),): v for k, v in SOURCE_STATS.items()})
+    except:
+        pass
+    try:
+        cs = cache_stats()
+        extras["apifinanceira_cache_eventos_total"] = ("counter", "Eventos do cache de respostas.", {(("evento", k),): cs.get(k, 0) for k in ("hits", "misses", "sets", "expirados", "invalidados", "despejados")})
+        sf = singleflight_stats()
+        extras["apifinanceira_singleflight_total"] = ("counter", "Chamadas coalescidas pelo single-flight.", {(("papel", k),): sf.get(k, 0) for k in ("lideres", "compartilhados", "timeouts", "erros")})
+        extras["apifinanceira_reparos_pendentes"] = ("gauge", "Reparos aguardando na fila.", {(): status_reparos().get("pendentes", 0)})
+    except:
+        pass
+    try:
+        ad = _admission.status_admissao()
+        extras["apifinanceira_admissao_fila"] = ("gauge", "Requisicoes de extracao esperando vaga.", {(): ad.get("fila", 0)})
+        extras["apifinanceira_admissao_em_execucao"] = ("gauge", "Extracoes em andamento.", {(): ad.get("em_execucao", 0)})
+        extras["apifinanceira_admissao_admitidos_total"] = ("counter", "Requisicoes de extracao admitidas.", {(): ad.get("admitidos", 0)})
+        rej = {(("motivo", "taxa"), ("classe", k)): v for k, v in (ad.get("rejeitados_taxa") or {}).items()}
+        rej[(("motivo", "fila_cheia"), ("classe", "*"))] = ad.get("rejeitados_fila_cheia", 0)
+        rej[(("motivo", "timeout_fila"), ("classe", "*"))] = ad.get("rejeitados_timeout_fila", 0)
+        extras["apifinanceira_admissao_rejeitados_total"] = ("counter", "Requisicoes de extracao recusadas (429/503).", rej)
+    except:
+        pass
+    try:
+        gcs = status_group_commit()
+        extras["apifinanceira_group_commit_total"] = ("counter", "Commits de salvar e chamadas que pegaram carona num grupo.", {(("evento", k),): gcs.get(k, 0) for k in ("commits", "grupos", "agrupados", "falhas")})
+        extras["apifinanceira_group_commit_escritas_coalescidas_total"] = ("counter", "Escritas no mesmo doc mescladas antes do commit.", {(): gcs.get("coalescidas", 0)})
+    except:
+        pass
+    try:
+        bw = status_batch_writer()
+        extras["apifinanceira_batch_writer_total"] = ("counter", "Lotes gravados, retentativas, divisoes de lote e escritas perdidas do BatchWriter.", {(("evento", k),): bw.get(k, 0) for k in ("lotes", "operacoes", "retentativas", "divisoes", "falhas")})
+    except:
+        pass
+    return app.response_class(_metrics.prometheus(extras), mimetype="text/plain; version=0.0.4")
+@app.route('/health/cache', methods=['GET'])
+def health_cache():
+    return jsonify({"sucesso": True, "cache": cache_stats(), "singleflight": singleflight_stats()})
+@app.route('/health/admissao', methods=['GET'])
+def health_admissao():
+    try:
+        return jsonify({"sucesso": True, "admissao": _admission.status_admissao()})
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
+@app.route('/health/reparos', methods=['GET'])
+def health_reparos():
+    try:
+        return jsonify({"sucesso": True, "fila": status_reparos()})
+    except Exception as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 500
 @app.route('/health/consistency', methods=['GET'])
 def health_consistency():
     hoje = _day_key_sp()
@@ -2533,17 +3086,19 @@ def health_consistency():
                 items = root.collection('transacoes').document(hoje).collection('items').stream()
             except:
                 items = []
+            migrado = cliente_migrado(cliente_id)
             try:
-                tops = root.collection('transacoes').where('data_referencia', '==', hoje).stream()
+                tops = root.collection('transacoes').where('data_referencia', '==', hoje).stream() if not migrado else []
             except:
                 tops = []
             idx = {}
             for it in items:
                 o = it.to_dict() or {}
-                k = str(o.get('ref_id') or '') or (str(o.get('tipo', '')) + '|' + str(float(o.get('valor', 0) or 0)) + '|' + str(o.get('categoria', '')) + '|' + str(o.get('descricao', '')) + '|' + str(o.get('timestamp_criacao', '')))
-                if idx.get(k):
-                    continue
-                idx[k] = 1
+                if not migrado:
+                    k = str(o.get('ref_id') or '') or (str(o.get('tipo', '')) + '|' + str(float(o.get('valor', 0) or 0)) + '|' + str(o.get('categoria', '')) + '|' + str(o.get('descricao', '')) + '|' + str(o.get('timestamp_criacao', '')))
+                    if idx.get(k):
+                        continue
+                    idx[k] = 1
                 if o.get('estornado'):
                     continue
                 tp = str(o.get('tipo', '')).strip().lower()
@@ -2575,19 +3130,16 @@ def health_consistency():
         qtd_validas_mesdoc = int(mm.get("quantidade_transacoes_validas", mm.get("quantidade_transacoes", 0)) or 0)
         td = tr = taj = tes = 0.0
         qtd_validas_dias = 0
+        dias_sem_doc = []
         try:
-            ano, mes = mes_atual.split("-")
-            dt_ini = f"{ano}-{mes}-01"
-            if mes == "12":
-                dt_fim = f"{int(ano)+1}-01-01"
-            else:
-                dt_fim = f"{ano}-{int(mes)+1:02d}-01"
-            cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-            end = datetime.strptime(dt_fim, "%Y-%m-%d")
-            while cur < end:
-                dkey = cur.strftime("%Y-%m-%d")
+            dias_mes2 = get_dias_mes(cliente_id, mes_atual)
+            sem_doc2 = dias_com_itens(cliente_id, _dias_sem_doc_suspeitos(mm, dias_mes2))
+            for dkey, dd2 in dias_mes2.items():
                 try:
-                    dd2 = root.collection('dias').document(dkey).get().to_dict() or {}
+                    if dkey in sem_doc2:
+                        # items sem doc de dia: conta pelos items e manda refazer o agregado
+                        dias_sem_doc.append(dkey)
+                        agendar_reparo(cliente_id, "dia", dkey)
                     _t2 = _dd_totais(dd2)
                     td += float(_t2["saida"])
                     tr += float(_t2["entrada"])
@@ -2595,7 +3147,7 @@ def health_consistency():
                     tes += float(_t2["estorno"])
                     if "quantidade_transacoes_validas" in dd2:
                         qtd_validas_dias += int(dd2.get("quantidade_transacoes_validas", 0) or 0)
-                    else:
+                    elif dd2 or dkey in sem_doc2:
                         try:
                             items = root.collection('transacoes').document(dkey).collection('items').stream()
                         except:
@@ -2610,7 +3162,6 @@ def health_consistency():
                         qtd_validas_dias += cnt
                 except:
                     pass
-                cur = cur + timedelta(days=1)
         except:
             pass
         mes_dias = {
@@ -2638,7 +3189,8 @@ def health_consistency():
                     abs(mes_ag["estornos"] - mes_dias["estornos"]) < 1e-6 and
                     abs(mes_ag["saldo"] - mes_dias["saldo"]) < 1e-6
                 ),
-                "consistente_qtd": (int(qtd_validas_mesdoc) == int(qtd_validas_dias))
+                "consistente_qtd": (int(qtd_validas_mesdoc) == int(qtd_validas_dias)),
+                "dias_sem_doc": dias_sem_doc,
             }
         }
         return jsonify(resp)
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+# Controle de admissão dos caminhos de extração (/processar, áudio, PDF):
+# - balde de tokens por (cliente_id, classe): rajada + recarga por minuto, configurável por classe;
+# - teto global de extrações simultâneas com fila de espera limitada.
+# Quem estoura o balde recebe 429; fila cheia ou espera longa demais, 503. Ambos com Retry-After.
+_PADROES = {
+    # classe: (rajada, por_minuto)
+    "texto": (20, 20),
+    "imagem": (6, 6),
+    "audio": (6, 6),
+    "pdf": (3, 2),
+}
+
+def _ler_env_int(nome, padrao):
+    try:
+        return int(os.getenv(nome, str(padrao)) or padrao)
+    except Exception:
+        return padrao
+
+def _limites(classe):
+    # ADMISSAO_<CLASSE>="rajada,por_minuto" (ex.: ADMISSAO_PDF="3,2")
+    rajada, por_min = _PADROES.get(classe, _PADROES["texto"])
+    v = os.getenv(f"ADMISSAO_{str(classe).upper()}")
+    if v:
+        try:
+            a, b = [float(x) for x in str(v).split(",", 1)]
+            rajada, por_min = a, b
+        except Exception:
+            pass
+    return float(rajada), float(por_min) / 60.0
+
+_MAX_CONCORRENTES = max(1, _ler_env_int("ADMISSAO_MAX_CONCORRENTES", 4))
+_FILA_MAX = max(0, _ler_env_int("ADMISSAO_FILA_MAX", 16))
+try:
+    _FILA_TIMEOUT = float(os.getenv("ADMISSAO_FILA_TIMEOUT", "10") or 10)
+except Exception:
+    _FILA_TIMEOUT = 10.0
+_MAX_BALDES = 10000
+
+_lock = threading.Lock()
+_cond = threading.Condition(threading.Lock())
+_baldes = {}
+_ativos = 0
+_fila = 0
+_stats = {
+    "admitidos": 0,
+    "rejeitados_taxa": {},
+    "rejeitados_fila_cheia": 0,
+    "rejeitados_timeout_fila": 0,
+    "espera_total_ms": 0.0,
+    "fila_pico": 0,
+}
+
+def consumir(cliente_id, classe):
+    """Tira um token do balde (cliente, classe). Retorna (ok, segundos_ate_proximo_token)."""
+    rajada, taxa = _limites(classe)
+    k = (str(cliente_id), str(classe))
+    agora = time.time()
+    with _lock:
+        tokens, ultimo = _baldes.get(k, (rajada, agora))
+        tokens = min(rajada, tokens + (agora - ultimo) * taxa)
+        if tokens >= 1.0:
+            _baldes[k] = (tokens - 1.0, agora)
+            return True, 0.0
+        _baldes[k] = (tokens, agora)
+        if len(_baldes) > _MAX_BALDES:
+            # baldes cheios equivalem a baldes ausentes: descarta os mais antigos
+            for kk in sorted(_baldes, key=lambda x: _baldes[x][1])[:len(_baldes) // 2]:
+                _baldes.pop(kk, None)
+        r = _stats["rejeitados_taxa"]
+        r[classe] = int(r.get(classe, 0)) + 1
+        return False, ((1.0 - tokens) / taxa) if taxa > 0 else 60.0
+
+def entrar(timeout=None):
+    """Ocupa uma vaga de extração, esperando na fila se preciso. Retorna 'ok', 'cheia' ou 'timeout'."""
+    global _ativos, _fila
+    t0 = time.time()
+    with _cond:
+        if _ativos < _MAX_CONCORRENTES:
+            _ativos += 1
+            with _lock:
+                _stats["admitidos"] += 1
+            return "ok"
+        if _fila >= _FILA_MAX:
+            with _lock:
+                _stats["rejeitados_fila_cheia"] += 1
+            return "cheia"
+        _fila += 1
+        with _lock:
+            _stats["fila_pico"] = max(_stats["fila_pico"], _fila)
+        fim = t0 + (_FILA_TIMEOUT if timeout is None else float(timeout))
+        try:
+            while _ativos >= _MAX_CONCORRENTES:
+                resta = fim - time.time()
+                if resta <= 0:
+                    with _lock:
+                        _stats["rejeitados_timeout_fila"] += 1
+                    return "timeout"
+                _cond.wait(resta)
+            _ativos += 1
+            with _lock:
+                _stats["admitidos"] += 1
+                _stats["espera_total_ms"] += (time.time() - t0) * 1000.0
+            return "ok"
+        finally:
+            _fila -= 1
+
+def sair():
+    global _ativos
+    with _cond:
+        _ativos = max(0, _ativos - 1)
+        _cond.notify()
+
+def status_admissao():
+    with _lock:
+        out = {k: (dict(v) if isinstance(v, dict) else v) for k, v in _stats.items()}
+        out["baldes"] = len(_baldes)
+    with _cond:
+        out["em_execucao"] = _ativos
+        out["fila"] = _fila
+    out["max_concorrentes"] = _MAX_CONCORRENTES
+    out["fila_max"] = _FILA_MAX
+    out["limites"] = {c: {"rajada": _limites(c)[0], "por_minuto": round(_limites(c)[1] * 60.0, 3)} for c in _PADROES}
+    return out
@@ -0,0 +1,159 @@
+import os
+import random
+import threading
+import time
+
+# Escritor em lotes reutilizável: acumula set/update/delete/create e grava em lotes abaixo do limite
+# de 500 operações do Firestore. O que fazer quando um commit falha depende de o erro garantir ou não
+# que nada foi gravado:
+# - rejeitado antes de aplicar e passageiro (Aborted, ResourceExhausted): repete com backoff + jitter;
+# - rejeitado por conteúdo (InvalidArgument, payload grande, NotFound em update...): divide o lote ao
+#   meio para isolar a operação ruim;
+# - ambíguo (DeadlineExceeded, Unavailable, erro de rede, desconhecido): o commit pode ter sido
+#   aplicado e Increment não é idempotente, então não repete nem divide; as operações ficam em
+#   `incertos_refs` para o chamador agendar reparo. Com idempotente=True (só set/delete sem Increment)
+#   o ambíguo também é repetido.
+LIMITE_OPS = 450
+try:
+    _TENTATIVAS = max(1, int(os.getenv("BATCH_WRITER_TENTATIVAS", "4") or 4))
+except Exception:
+    _TENTATIVAS = 4
+try:
+    _BACKOFF_MS = float(os.getenv("BATCH_WRITER_BACKOFF_MS", "100") or 100)
+except Exception:
+    _BACKOFF_MS = 100.0
+_BACKOFF_MAX_MS = 5000.0
+_TRANSITORIOS = ("Aborted", "ResourceExhausted", "TooManyRequests")
+_REJEITADOS = ("InvalidArgument", "BadRequest", "NotFound", "AlreadyExists", "FailedPrecondition", "OutOfRange", "ValueError", "TypeError")
+_PERMANENTES = ("PermissionDenied", "Unauthenticated", "Unauthorized", "Forbidden")
+
+_lock = threading.Lock()
+_stats = {
+    "lotes": 0,
+    "operacoes": 0,
+    "retentativas": 0,
+    "divisoes": 0,
+    "falhas": 0,
+    "incertos": 0,
+}
+
+def _path(ref):
+    p = getattr(ref, "path", None) or getattr(ref, "_path", None)
+    return str(p or getattr(ref, "id", "") or "")
+
+def _transitorio(e):
+    return type(e).__name__ in _TRANSITORIOS
+
+def nao_gravou(e):
+    """True se o erro garante que o commit não aplicou nada."""
+    return type(e).__name__ in _TRANSITORIOS + _REJEITADOS + _PERMANENTES
+
+def _contar(campo, n=1):
+    with _lock:
+        _stats[campo] += n
+
+class BatchWriter:
+    """Escritas em lotes com retry. Use flush() (ou `with`) no fim.
+
+    `falhas_refs` lista tudo que não foi confirmado; `incertos_refs` é a parte que pode ter sido gravada.
+    """
+    def __init__(self, db, tamanho=LIMITE_OPS, tentativas=None, auto_flush=True, idempotente=False):
+        self.db = db
+        self.tamanho = max(1, min(int(tamanho or LIMITE_OPS), LIMITE_OPS))
+        self.tentativas = max(1, int(tentativas or _TENTATIVAS))
+        self.auto_flush = auto_flush
+        self.idempotente = idempotente
+        self._pendentes = []
+        self.lotes = 0
+        self.gravadas = 0
+        self.falhas = 0
+        self.falhas_refs = []
+        self.incertos = 0
+        self.incertos_refs = []
+
+    def _op(self, nome, ref, *a, **k):
+        self._pendentes.append((nome, ref, a, k))
+        if self.auto_flush and len(self._pendentes) >= self.tamanho:
+            self.flush()
+        return self
+
+    def set(self, ref, dados, merge=False):
+        return self._op("set", ref, dados, merge=merge) if merge else self._op("set", ref, dados)
+
+    def update(self, ref, *a, **k):
+        return self._op("update", ref, *a, **k)
+
+    def delete(self, ref, *a, **k):
+        return self._op("delete", ref, *a, **k)
+
+    def create(self, ref, *a, **k):
+        return self._op("create", ref, *a, **k)
+
+    def flush(self):
+        ops, self._pendentes = self._pendentes, []
+        for i in range(0, len(ops), self.tamanho):
+            self._gravar(ops[i:i + self.tamanho])
+        return self.falhas == 0
+
+    def _falhar(self, parte, incerto):
+        refs = [_path(op[1]) for op in parte]
+        self.falhas += len(parte)
+        self.falhas_refs.extend(refs)
+        _contar("falhas", len(parte))
+        if incerto:
+            self.incertos += len(parte)
+            self.incertos_refs.extend(refs)
+            _contar("incertos", len(parte))
+
+    def _gravar(self, parte):
+        if not parte:
+            return
+        erro = self._commit(parte)
+        if erro is None:
+            self.lotes += 1
+            self.gravadas += len(parte)
+            return
+        nome = type(erro).__name__
+        if nome not in _REJEITADOS or len(parte) == 1:
+            # ambíguo não é repetido (pode ter gravado); permanente falharia igual em qualquer metade
+            self._falhar(parte, incerto=not nao_gravou(erro))
+            return
+        # rejeitado por conteúdo: metades menores isolam a escrita ruim sem cair para doc a doc
+        _contar("divisoes")
+        meio = len(parte) // 2
+        self._gravar(parte[:meio])
+        self._gravar(parte[meio:])
+
+    def _commit(self, parte):
+        for t in range(self.tentativas):
+            try:
+                batch = self.db.batch()
+                for nome, ref, a, k in parte:
+                    getattr(batch, nome)(ref, *a, **k)
+            except Exception as e:
+                # erro ao montar o lote: nada foi enviado
+                return e if type(e).__name__ in _REJEITADOS else ValueError(str(e))
+            try:
+                batch.commit()
+                _contar("lotes")
+                _contar("operacoes", len(parte))
+                return None
+            except Exception as e:
+                repete = _transitorio(e) or (self.idempotente and not nao_gravou(e))
+                if not repete or t == self.tentativas - 1:
+                    return e
+                _contar("retentativas")
+                espera = min(_BACKOFF_MAX_MS, _BACKOFF_MS * (2 ** t))
+                time.sleep(random.uniform(espera / 2.0, espera) / 1000.0)
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+def status_batch_writer():
+    with _lock:
+        return dict(_stats)
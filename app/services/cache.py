@@ -0,0 +1,242 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Cache de respostas da API: LRU limitado + TTL por entrada + geração por cliente_id.
+# Escritas de um cliente sobem a geração dele; entradas gravadas com geração antiga viram miss.
+# Backend em memória por processo (padrão) ou SQLite compartilhado (API_CACHE_BACKEND=sqlite).
+
+class CacheLRU:
+    def __init__(self, max_itens=2000, ttl_padrao=12.0):
+        self.max_itens = max(1, int(max_itens or 1))
+        self.ttl_padrao = float(ttl_padrao or 0)
+        self._itens = OrderedDict()
+        self._geracoes = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "expirados": 0, "invalidados": 0, "despejados": 0}
+
+    def geracao(self, cliente_id):
+        with self._lock:
+            return int(self._geracoes.get(str(cliente_id), 0))
+
+    def get(self, key, cliente_id=None):
+        agora = time.time()
+        with self._lock:
+            v = self._itens.get(key)
+            if v is None:
+                self._stats["misses"] += 1
+                return None
+            exp, cid, ger, data = v
+            if agora > exp:
+                del self._itens[key]
+                self._stats["expirados"] += 1
+                self._stats["misses"] += 1
+                return None
+            if cid is not None and ger != self._geracoes.get(cid, 0):
+                del self._itens[key]
+                self._stats["invalidados"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._itens.move_to_end(key)
+            self._stats["hits"] += 1
+            return data
+
+    def set(self, key, data, ttl=None, cliente_id=None, geracao=None):
+        # geracao: lida pelo chamador antes de calcular `data` (escrita no meio = entrada já inválida)
+        ttl = self.ttl_padrao if ttl is None else float(ttl or 0)
+        if ttl <= 0:
+            return
+        cid = str(cliente_id) if cliente_id is not None else None
+        with self._lock:
+            if cid is None:
+                ger = 0
+            else:
+                ger = self._geracoes.get(cid, 0) if geracao is None else int(geracao)
+            self._itens[key] = (time.time() + ttl, cid, ger, data)
+            self._itens.move_to_end(key)
+            self._stats["sets"] += 1
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self._stats["despejados"] += 1
+
+    def invalidar_cliente(self, cliente_id):
+        with self._lock:
+            cid = str(cliente_id)
+            self._geracoes[cid] = int(self._geracoes.get(cid, 0)) + 1
+            return self._geracoes[cid]
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out["itens"] = len(self._itens)
+            out["max_itens"] = self.max_itens
+            out["clientes_com_geracao"] = len(self._geracoes)
+        total = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / total, 4) if total else 0.0
+        out["backend"] = "memoria"
+        return out
+
+class CacheSQLite:
+    """Mesma interface do CacheLRU, num arquivo SQLite compartilhado entre processos (workers do gunicorn).
+
+    Valores são guardados como JSON; LRU aproximado pela coluna `acesso`.
+    """
+    def __init__(self, caminho, max_itens=2000, ttl_padrao=12.0):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.caminho = caminho
+        self.max_itens = max(1, int(max_itens or 1))
+        self.ttl_padrao = float(ttl_padrao or 0)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "expirados": 0, "invalidados": 0, "despejados": 0}
+        d = os.path.dirname(os.path.abspath(caminho))
+        if d:
+            os.makedirs(d, exist_ok=True)
+        con = self._con()
+        con.execute("CREATE TABLE IF NOT EXISTS itens (key TEXT PRIMARY KEY, exp REAL, cliente TEXT, ger INTEGER, acesso REAL, data TEXT)")
+        con.execute("CREATE INDEX IF NOT EXISTS itens_acesso ON itens(acesso)")
+        con.execute("CREATE TABLE IF NOT EXISTS geracoes (cliente TEXT PRIMARY KEY, ger INTEGER)")
+        con.commit()
+
+    def _con(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._sqlite3.connect(self.caminho, timeout=5, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("PRAGMA busy_timeout=5000")
+            self._local.con = con
+        return con
+
+    def _contar(self, campo, n=1):
+        with self._lock:
+            self._stats[campo] += n
+
+    def geracao(self, cliente_id):
+        row = self._con().execute("SELECT ger FROM geracoes WHERE cliente=?", (str(cliente_id),)).fetchone()
+        return int(row[0]) if row else 0
+
+    def get(self, key, cliente_id=None):
+        import json
+        con = self._con()
+        row = con.execute(
+            "SELECT i.exp, i.cliente, i.ger, i.data, COALESCE(g.ger, 0) FROM itens i LEFT JOIN geracoes g ON g.cliente = i.cliente WHERE i.key=?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            self._contar("misses")
+            return None
+        exp, cid, ger, data, ger_atual = row
+        agora = time.time()
+        if agora > float(exp or 0) or (cid is not None and int(ger or 0) != int(ger_atual or 0)):
+            con.execute("DELETE FROM itens WHERE key=?", (key,))
+            self._contar("expirados" if agora > float(exp or 0) else "invalidados")
+            self._contar("misses")
+            return None
+        con.execute("UPDATE itens SET acesso=? WHERE key=?", (agora, key))
+        self._contar("hits")
+        return json.loads(data)
+
+    def set(self, key, data, ttl=None, cliente_id=None, geracao=None):
+        # geracao: lida pelo chamador antes de calcular `data`; se o cliente escreveu no meio,
+        # a entrada já nasce invalidada em vez de herdar a geração nova
+        import json
+        ttl = self.ttl_padrao if ttl is None else float(ttl or 0)
+        if ttl <= 0:
+            return
+        cid = str(cliente_id) if cliente_id is not None else None
+        con = self._con()
+        agora = time.time()
+        if cid is None:
+            ger = 0
+        else:
+            ger = self.geracao(cid) if geracao is None else int(geracao)
+        con.execute(
+            "INSERT OR REPLACE INTO itens (key, exp, cliente, ger, acesso, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, agora + ttl, cid, ger, agora, json.dumps(data, ensure_ascii=False, default=str)),
+        )
+        self._contar("sets")
+        n = con.execute("SELECT COUNT(*) FROM itens").fetchone()[0]
+        if n > self.max_itens:
+            excesso = int(n - self.max_itens)
+            con.execute("DELETE FROM itens WHERE key IN (SELECT key FROM itens ORDER BY acesso LIMIT ?)", (excesso,))
+            self._contar("despejados", excesso)
+
+    def invalidar_cliente(self, cliente_id):
+        cid = str(cliente_id)
+        con = self._con()
+        con.execute("INSERT INTO geracoes (cliente, ger) VALUES (?, 1) ON CONFLICT(cliente) DO UPDATE SET ger = ger + 1", (cid,))
+        return self.geracao(cid)
+
+    def limpar(self):
+        self._con().execute("DELETE FROM itens")
+
+    def stats(self):
+        con = self._con()
+        with self._lock:
+            out = dict(self._stats)
+        out["itens"] = int(con.execute("SELECT COUNT(*) FROM itens").fetchone()[0])
+        out["max_itens"] = self.max_itens
+        out["clientes_com_geracao"] = int(con.execute("SELECT COUNT(*) FROM geracoes").fetchone()[0])
+        total = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / total, 4) if total else 0.0
+        out["backend"] = "sqlite"
+        out["caminho"] = self.caminho
+        return out
+
+try:
+    _MAX = int(os.getenv("API_CACHE_MAX", "2000") or 2000)
+except Exception:
+    _MAX = 2000
+try:
+    _TTL = float(os.getenv("API_CACHE_TTL", "12") or 12)
+except Exception:
+    _TTL = 12.0
+def _criar_backend():
+    # API_CACHE_BACKEND=sqlite: um arquivo em API_CACHE_DIR compartilhado por todos os workers
+    tipo = str(os.getenv("API_CACHE_BACKEND") or "memoria").strip().lower()
+    if tipo == "sqlite":
+        try:
+            import tempfile
+            d = os.getenv("API_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "apifinanceira_cache")
+            return CacheSQLite(os.path.join(d, "api_cache.sqlite3"), max_itens=_MAX, ttl_padrao=_TTL)
+        except Exception as e:
+            print(f"⚠️ Cache SQLite indisponível ({e}); usando cache em memória.")
+    return CacheLRU(max_itens=_MAX, ttl_padrao=_TTL)
+_backend = _criar_backend()
+
+def cache_get(key, cliente_id=None):
+    try:
+        return _backend.get(key, cliente_id=cliente_id)
+    except Exception:
+        return None
+
+def cache_set(key, data, ttl=None, cliente_id=None, geracao=None):
+    try:
+        _backend.set(key, data, ttl=ttl, cliente_id=cliente_id, geracao=geracao)
+    except Exception:
+        pass
+
+def invalidar_cliente(cliente_id):
+    try:
+        return _backend.invalidar_cliente(cliente_id)
+    except Exception:
+        return None
+
+def cache_geracao(cliente_id):
+    try:
+        return _backend.geracao(cliente_id)
+    except Exception:
+        return 0
+
+def cache_stats():
+    try:
+        return _backend.stats()
+    except Exception as e:
+        return {"erro": str(e)}
@@ -0,0 +1,161 @@
+import os
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from app.services.database import (
+    _cliente_root,
+    _listar_clientes_ids,
+    _totais_nivel,
+    _categorias_nivel,
+    _acumular_dia,
+    _transacoes_dia,
+    agregados_versao,
+    cliente_migrado,
+    get_docs_many,
+    day_keys_between,
+    month_bounds,
+    week_key,
+)
+
+# Verificação de consistência em massa: um snapshot por cliente (cliente + mês + semana + dias numa
+# leitura em lote, mais os itens de hoje) e clientes verificados num pool de threads limitado.
+try:
+    _WORKERS = int(os.getenv("CONSISTENCIA_WORKERS", "8") or 8)
+except Exception:
+    _WORKERS = 8
+_MAX_WORKERS = 32
+_TOL = 1e-6
+
+def _resposta(t):
+    return {
+        "despesas": float(t["saida"]),
+        "receitas": float(t["entrada"]),
+        "saldo": float(t["entrada"]) - float(t["saida"]) + float(t["estorno"]) + float(t["ajuste"]),
+        "estornos": float(t["estorno"]),
+        "ajustes": float(t["ajuste"]),
+    }
+
+def _somar(dst, t):
+    for k in ("entrada", "saida", "ajuste", "estorno"):
+        dst[k] = float(dst.get(k, 0.0) or 0.0) + float(t.get(k, 0.0) or 0.0)
+    return dst
+
+def _iguais(a, b):
+    return all(abs(float(a.get(k, 0) or 0) - float(b.get(k, 0) or 0)) < _TOL for k in ("entrada", "saida", "ajuste", "estorno"))
+
+def _qtd(doc):
+    doc = doc or {}
+    return int(doc.get("quantidade_transacoes_validas", doc.get("quantidade_transacoes", 0)) or 0)
+
+def verificar_cliente(cliente_id, dia, mes):
+    """Consistência de um cliente no dia/mês informados a partir de um único snapshot dos agregados."""
+    cid = str(cliente_id)
+    try:
+        root = _cliente_root(cid)
+        dia_dt = datetime.strptime(dia, "%Y-%m-%d")
+        inicio_semana = (dia_dt - timedelta(days=dia_dt.weekday())).strftime("%Y-%m-%d")
+        dt_ini, dt_fim = month_bounds(mes)
+        dias_keys = sorted(set(day_keys_between(dt_ini, dt_fim)) | set(day_keys_between(inicio_semana, dia, incluir_fim=True)))
+        refs = [root, root.collection("meses").document(mes), root.collection("semanas").document(week_key(dia))]
+        refs += [root.collection("dias").document(k) for k in dias_keys]
+        docs = get_docs_many(refs)
+        root_doc, mm, sem_doc = (list(docs) + [{}, {}, {}])[:3]
+        root_doc = root_doc or {}
+        dias = {k: (docs[3 + i] if 3 + i < len(docs) else {}) or {} for i, k in enumerate(dias_keys)}
+        versao = agregados_versao(root_doc)
+        # já memoiza o "migrado" com o doc lido, sem outra leitura dentro de _transacoes_dia
+        cliente_migrado(cid, root_doc=root_doc)
+
+        # Dia: agregado x itens
+        dd = dias.get(dia, {})
+        t_dia = _totais_nivel(dd, "dia")
+        a = _acumular_dia(_transacoes_dia(root, dia))
+        t_stream = {"entrada": a["total_entrada"], "saida": a["total_saida"], "ajuste": a["total_ajuste"], "estorno": a["total_estorno"]}
+        qtd_stream = int(a["quantidade_transacoes_validas"])
+        dia_ok = (_qtd(dd) == qtd_stream) and _iguais(t_dia, t_stream)
+
+        # Semana: doc semanal (versão >= 2) x soma dos dias
+        t_sem_dias = {}
+        for k in day_keys_between(inicio_semana, dia, incluir_fim=True):
+            _somar(t_sem_dias, _totais_nivel(dias.get(k, {}), "dia"))
+        t_sem = _totais_nivel(sem_doc, "semana") if versao >= 2 else _somar({}, t_sem_dias)
+        semana_ok = _iguais(t_sem, t_sem_dias)
+
+        # Mês: doc do mês x soma dos dias
+        t_mes = _totais_nivel(mm, "mes")
+        t_mes_dias = {}
+        qtd_dias = 0
+        for k in day_keys_between(dt_ini, dt_fim):
+            o = dias.get(k, {})
+            if o:
+                _somar(t_mes_dias, _totais_nivel(o, "dia"))
+                qtd_dias += _qtd(o)
+        _somar(t_mes_dias, {})
+        mes_ok_totais = _iguais(t_mes, t_mes_dias)
+        mes_ok_qtd = (_qtd(mm) == qtd_dias)
+
+        if versao >= 2:
+            geral = _resposta(_totais_nivel(root_doc, "geral"))
+        else:
+            geral = {"saldo": float(root_doc.get("saldo_real", 0) or 0)}
+        geral["saldo_real"] = float(root_doc.get("saldo_real", geral["saldo"]) or 0)
+
+        cm = _categorias_nivel(mm)
+        desp = dict(cm.get("saida") or {})
+        est = dict(cm.get("estorno") or {})
+        net = {k: float(desp.get(k, 0) or 0) - float(est.get(k, 0) or 0) for k in set(desp) | set(est)}
+        cats = sorted([(k, v) for k, v in net.items() if v > 0], key=lambda x: x[1], reverse=True)
+        cats_est = sorted([(k, float(v or 0)) for k, v in est.items()], key=lambda x: x[1], reverse=True)
+
+        return {
+            "cliente_id": cid,
+            "nome": str(root_doc.get("cliente_display") or root_doc.get("cliente_label") or cid),
+            "consistente": bool(dia_ok and semana_ok and mes_ok_totais and mes_ok_qtd),
+            "dia": {"data": dia, "total": _resposta(t_dia)},
+            "semana": {"inicio": inicio_semana, "fim": dia, "total": _resposta(t_sem)},
+            "mes": {"mes": mes, "total": _resposta(t_mes)},
+            "geral": {"total": geral},
+            "consistencia": {
+                "dia_consistente": bool(dia_ok),
+                "stream_count_validas": qtd_stream,
+                "semana_consistente": bool(semana_ok),
+                "mes_consistente_totais": bool(mes_ok_totais),
+                "mes_consistente_qtd": bool(mes_ok_qtd),
+                "mes_soma_dias": {**_resposta(t_mes_dias), "quantidade_transacoes_validas": qtd_dias},
+            },
+            "categorias_mes": {
+                "top_despesas": cats[:5],
+                "top_estornos": cats_est[:5],
+                "total_despesas": float(sum(v for _, v in cats)),
+                "total_estornos": float(sum(v for _, v in cats_est)),
+            },
+            "docs_lidos": len(refs),
+        }
+    except Exception as e:
+        return {"cliente_id": cid, "consistente": False, "erro": str(e)}
+
+def verificar_todos(dia, mes, workers=None, somente_inconsistentes=False, clientes=None):
+    """Gera o resultado de cada cliente assim que fica pronto (ordem de conclusão).
+
+    No máximo 2x `workers` clientes ficam em voo; nada é acumulado em memória.
+    """
+    # `workers` vem da query string: limitado para não abrir threads/RPCs sem teto
+    w = max(1, min(int(workers or _WORKERS), _MAX_WORKERS))
+    ids = iter(clientes if clientes is not None else _listar_clientes_ids())
+    with ThreadPoolExecutor(max_workers=w) as ex:
+        pend = set()
+        def encher():
+            while len(pend) < w * 2:
+                cid = next(ids, None)
+                if cid is None:
+                    return
+                pend.add(ex.submit(verificar_cliente, cid, dia, mes))
+        encher()
+        while pend:
+            feitos, pend = wait(pend, return_when=FIRST_COMPLETED)
+            for f in feitos:
+                r = f.result()
+                if somente_inconsistentes and r.get("consistente"):
+                    continue
+                yield r
+            encher()
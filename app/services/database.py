@@ -1,7 +1,11 @@
 import os
 import re
 import unicodedata
+import threading
+import time
 from datetime import datetime, timezone, timedelta
+from app.services.group_commit import LoteCoalescido, commit_agrupado
+from app.services.batch_writer import BatchWriter, LIMITE_OPS, nao_gravou
 try:
     import firebase_admin
     from firebase_admin import credentials, firestore
@@ -213,11 +217,20 @@ def init_firebase():
         class _FakeIncr:
             def __init__(self, val):
                 self.value = val
+        class _FakeArrayOp:
+            def __init__(self, values):
+                self.values = list(values or [])
         class _FakeFirestore:
             SERVER_TIMESTAMP = 0
             @staticmethod
             def Increment(val):
                 return _FakeIncr(val)
+            @staticmethod
+            def ArrayUnion(values):
+                return _FakeArrayOp(values)
+            @staticmethod
+            def ArrayRemove(values):
+                return _FakeArrayOp(values)
         _db = _FakeFirestoreClient()
         globals()["firestore"] = _FakeFirestore
         return _db
@@ -228,35 +241,98 @@ def init_firebase():
     _db = firestore.client()
     return _db
 
+def _com_metricas(fn):
+    try:
+        from app.services.metrics import propagar
+        return propagar(fn)
+    except Exception:
+        return fn
+_db_instr = None
 def get_db():
-    return init_firebase()
+    # Cliente embrulhado pelo contador de RPCs (app/services/metrics.py); FIRESTORE_METRICS=0 desliga
+    global _db_instr
+    db = init_firebase()
+    if getattr(_db_instr, "_alvo", _db_instr) is not db:
+        try:
+            from app.services.metrics import instrumentar
+            _db_instr = instrumentar(db)
+        except Exception:
+            _db_instr = db
+    return _db_instr
+# Clientes já vistos neste processo: evita o get() do doc raiz e segura as escritas de
+# last_seen (no máximo uma por CLIENTE_LAST_SEEN_INTERVALO segundos); perfil só é regravado se mudar.
+try:
+    _LAST_SEEN_INTERVALO = float(os.getenv("CLIENTE_LAST_SEEN_INTERVALO", "300") or 300)
+except Exception:
+    _LAST_SEEN_INTERVALO = 300.0
+_CLIENTES_MEMO_MAX = 20000
+_clientes_memo = {}
+_clientes_memo_lock = threading.Lock()
+def _perfil_cliente(cliente_id, nome, username):
+    safe_nm = None
+    try:
+        base_nm = str(nome or username or "").strip()
+        if base_nm:
+            safe_nm = re.sub(r'[^A-Za-z0-9._-]+', '_', base_nm).strip('_')
+    except:
+        safe_nm = None
+    label = f"{cliente_id}_{safe_nm}" if safe_nm else str(cliente_id)
+    return {
+        "cliente_nome": str(nome) if nome else None,
+        "cliente_username": str(username) if username else None,
+        "cliente_label": label,
+        "cliente_display": (safe_nm or None),
+    }
+def _perfil_mudou(atual, nome, username):
+    return bool((nome and str(nome) != str(atual.get("cliente_nome") or "")) or (username and str(username) != str(atual.get("cliente_username") or "")))
+def _visto_ha(last_seen):
+    try:
+        dt = datetime.fromisoformat(str(last_seen))
+        return (_now_sp() - dt).total_seconds()
+    except:
+        return None
 def ensure_cliente(cliente_id, nome=None, username=None):
-    db = get_db()
-    root = _cliente_root(cliente_id)
+    cid = str(cliente_id)
+    # chamadores às vezes mandam str(None)
+    nome = None if str(nome or "").strip() in ("", "None") else nome
+    username = None if str(username or "").strip() in ("", "None") else username
+    agora = time.time()
+    with _clientes_memo_lock:
+        memo = _clientes_memo.get(cid)
+    if memo is not None and not _perfil_mudou(memo, nome, username) and (agora - memo["visto_em"]) < _LAST_SEEN_INTERVALO:
+        return True
+    root = _cliente_root(cid)
     now = _now_sp().isoformat()
     try:
-        doc = root.get()
-        safe_nm = None
-        try:
-            base_nm = str(nome or username or "").strip()
-            if base_nm:
-                safe_nm = re.sub(r'[^A-Za-z0-9._-]+', '_', base_nm).strip('_')
-        except:
-            safe_nm = None
-        label = f"{cliente_id}_{safe_nm}" if safe_nm else str(cliente_id)
-        base = {
-            "cliente_id": str(cliente_id),
-            "cliente_nome": str(nome) if nome else None,
-            "cliente_username": str(username) if username else None,
-            "cliente_label": label,
-            "cliente_display": (safe_nm or None),
-            "last_seen": now,
-        }
-        if not doc.exists:
-            base.update({"created_at": now})
-            root.set({k: v for k, v in base.items() if v is not None}, merge=True)
+        if memo is None:
+            doc = root.get()
+            atual = (doc.to_dict() or {}) if doc.exists else None
+        else:
+            atual = memo
+        payload = {}
+        if atual is None:
+            payload.update({"cliente_id": cid, "created_at": now, "last_seen": now})
+            payload.update(_perfil_cliente(cid, nome, username))
+            atual = {}
         else:
-            root.set({k: v for k, v in base.items() if v is not None}, merge=True)
+            if _perfil_mudou(atual, nome, username):
+                payload.update(_perfil_cliente(cid, nome or atual.get("cliente_nome"), username or atual.get("cliente_username")))
+            visto = atual.get("visto_em")
+            ha = (agora - visto) if visto is not None else _visto_ha(atual.get("last_seen"))
+            if payload or ha is None or ha >= _LAST_SEEN_INTERVALO:
+                payload["last_seen"] = now
+        payload = {k: v for k, v in payload.items() if v is not None}
+        if payload:
+            root.set(payload, merge=True)
+        novo = {
+            "cliente_nome": payload.get("cliente_nome", atual.get("cliente_nome")),
+            "cliente_username": payload.get("cliente_username", atual.get("cliente_username")),
+            "visto_em": agora if "last_seen" in payload else (atual.get("visto_em") or agora - (_visto_ha(atual.get("last_seen")) or 0.0)),
+        }
+        with _clientes_memo_lock:
+            if len(_clientes_memo) >= _CLIENTES_MEMO_MAX:
+                _clientes_memo.clear()
+            _clientes_memo[cid] = novo
     except:
         pass
     return True
@@ -273,6 +349,375 @@ def _cliente_root(cliente_id):
     db = get_db()
     return db.collection("clientes").document(str(cliente_id or "default"))
 
+try:
+    _RANGE_READ_WORKERS = int(os.getenv("FIRESTORE_RANGE_WORKERS", "8") or "8")
+except Exception:
+    _RANGE_READ_WORKERS = 8
+_GET_ALL_CHUNK = 300
+def _ref_path(ref):
+    p = getattr(ref, "path", None) or getattr(ref, "_path", None)
+    return str(p or getattr(ref, "id", "") or "")
+def get_docs_many(refs):
+    # Uma ida ao Firestore via get_all; sem ele, leituras paralelas limitadas. Saída alinhada com `refs` ({} = inexistente).
+    db = get_db()
+    refs = list(refs or [])
+    if not refs:
+        return []
+    getter = getattr(db, "get_all", None)
+    if getter is not None:
+        try:
+            out = [{} for _ in refs]
+            pos = {}
+            for i, r in enumerate(refs):
+                pos.setdefault(_ref_path(r), []).append(i)
+            for i in range(0, len(refs), _GET_ALL_CHUNK):
+                for snap in getter(refs[i:i + _GET_ALL_CHUNK]):
+                    if not getattr(snap, "exists", False):
+                        continue
+                    data = snap.to_dict() or {}
+                    for j in pos.get(_ref_path(getattr(snap, "reference", None)), []):
+                        out[j] = data
+            return out
+        except Exception:
+            pass
+    def _one(ref):
+        try:
+            return ref.get().to_dict() or {}
+        except Exception:
+            return {}
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, min(_RANGE_READ_WORKERS, len(refs)))) as ex:
+            return list(ex.map(_com_metricas(_one), refs))
+    except Exception:
+        return [_one(r) for r in refs]
+def month_bounds(mes):
+    ano, m = str(mes).split("-")
+    dt_ini = f"{ano}-{m}-01"
+    if m == "12":
+        dt_fim = f"{int(ano)+1}-01-01"
+    else:
+        dt_fim = f"{ano}-{int(m)+1:02d}-01"
+    return dt_ini, dt_fim
+def day_keys_between(inicio, fim, incluir_fim=False):
+    try:
+        cur = datetime.strptime(str(inicio)[:10], "%Y-%m-%d")
+        end = datetime.strptime(str(fim)[:10], "%Y-%m-%d")
+    except Exception:
+        return []
+    out = []
+    while cur < end or (incluir_fim and cur == end):
+        out.append(cur.strftime("%Y-%m-%d"))
+        cur = cur + timedelta(days=1)
+    return out
+def get_dias_range(cliente_id, inicio, fim, incluir_fim=False):
+    root = _cliente_root(cliente_id)
+    keys = day_keys_between(inicio, fim, incluir_fim=incluir_fim)
+    docs = get_docs_many([root.collection("dias").document(k) for k in keys])
+    return {k: (docs[i] if i < len(docs) else {}) for i, k in enumerate(keys)}
+def get_dias_mes(cliente_id, mes):
+    dt_ini, dt_fim = month_bounds(mes)
+    return get_dias_range(cliente_id, dt_ini, dt_fim)
+def dias_com_itens(cliente_id, dias):
+    # Quais dos `dias` têm ao menos um item aninhado (uma consulta limit(1) por dia, em paralelo).
+    # Acha dias com transações cujo doc em `dias` nunca foi gravado.
+    root = _cliente_root(cliente_id)
+    dias = sorted(set(str(d) for d in (dias or []) if d))
+    if not dias:
+        return set()
+    def _tem(dr):
+        try:
+            return dr, any(True for _ in root.collection("transacoes").document(dr).collection("items").limit(1).stream())
+        except Exception:
+            return dr, False
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, min(_RANGE_READ_WORKERS, len(dias)))) as ex:
+            return {dr for dr, tem in ex.map(_tem, dias) if tem}
+    except Exception:
+        return {dr for dr, tem in map(_tem, dias) if tem}
+
+# Versão do esquema de agregados; recompute_cliente_aggregates grava no doc do cliente.
+# >= 2: anos/{YYYY}, semanas/{YYYY-Www} e totais_geral no doc do cliente são mantidos a cada escrita.
+# >= 3: cada doc de `meses` guarda saldo_anterior (soma de saldo_mes de todos os meses anteriores),
+#       refeito pelo recompute/reparo; ver saldo_anterior_gravado.
+AGREGADOS_VERSAO = 3
+# Contador de dados do cliente (campo `versao` no doc raiz): toda escrita que muda transações ou
+# agregados soma 1. A API usa o valor para montar ETags dos GETs de agregados.
+def versao_dados(cliente_id):
+    try:
+        return int((_cliente_root(cliente_id).get().to_dict() or {}).get("versao", 0) or 0)
+    except Exception:
+        return 0
+def agregados_versao(root_doc):
+    try:
+        return int((root_doc or {}).get("agregados_versao", 0) or 0)
+    except Exception:
+        return 0
+def week_key(dr):
+    try:
+        y, w, _ = datetime.strptime(str(dr)[:10], "%Y-%m-%d").isocalendar()
+        return f"{y}-W{w:02d}"
+    except Exception:
+        return None
+def incrementos_agregado(nivel, tipo, valor, categoria=None):
+    tp = tipo if tipo in ("entrada", "saida", "ajuste", "estorno") else "ajuste"
+    v = abs(float(valor or 0)) if tp == "estorno" else float(valor or 0)
+    sinal = -1.0 if tp == "saida" else 1.0
+    inc = {
+        "quantidade_transacoes": firestore.Increment(1),
+        "quantidade_transacoes_validas": firestore.Increment(1),
+        f"totais_{nivel}.total_{tp}": firestore.Increment(v),
+        f"totais_por_tipo.{tp}": firestore.Increment(v),
+        f"totais_{nivel}.saldo_{nivel}": firestore.Increment(sinal * v),
+    }
+    if categoria is not None:
+        inc[f"categorias.{tp}.{categoria}"] = firestore.Increment(v)
+    return inc
+def incrementar_agregados_superiores(batch, root, dr, tipo, valor, categoria):
+    # anos/semanas do dia + totais_geral no doc do cliente, no mesmo batch de dias/meses
+    try:
+        ano_k = str(dr)[:4]
+        batch.set(root.collection("anos").document(ano_k), {"ano": int(ano_k), "atualizado_em": firestore.SERVER_TIMESTAMP, **incrementos_agregado("ano", tipo, valor, categoria)}, merge=True)
+    except Exception:
+        pass
+    wk = week_key(dr)
+    if wk:
+        batch.set(root.collection("semanas").document(wk), {"semana": wk, "atualizado_em": firestore.SERVER_TIMESTAMP, **incrementos_agregado("semana", tipo, valor, categoria)}, merge=True)
+    batch.set(root, incrementos_agregado("geral", tipo, valor), merge=True)
+def _saldo_mes_doc(mm):
+    t = dict((mm or {}).get("totais_mes", {}) or {})
+    try:
+        if t.get("saldo_mes") is not None:
+            return float(t.get("saldo_mes") or 0)
+    except Exception:
+        pass
+    return float(t.get("total_entrada", 0) or 0) - float(t.get("total_saida", 0) or 0) + float(t.get("total_estorno", 0) or 0) + float(t.get("total_ajuste", 0) or 0)
+def _meses_a_partir(root, mk):
+    fp = getattr(getattr(firestore, "FieldPath", None), "document_id", None)
+    campo = fp() if fp else "__name__"
+    return list(root.collection("meses").where(campo, ">=", root.collection("meses").document(mk)).stream())
+def _marca_dia(dr):
+    return "d" + str(dr)[:10].replace("-", "")
+def _payload_sujos(dias):
+    # dias_sujos: conjunto compacto de dias alterados desde a última verificação.
+    # dias_sujos_marca.{dia}: contador de escritas do dia; o reparo só limpa o dia se ele não mudou.
+    return {
+        "dias_sujos": firestore.ArrayUnion(list(dias)),
+        "dias_sujos_marca": {_marca_dia(d): firestore.Increment(1) for d in dias},
+    }
+def marcar_dias_sujos(batch, root, dias):
+    # Gravado no mesmo lote da escrita
+    dias = sorted(set(str(d)[:10] for d in (dias or []) if d))
+    if dias:
+        batch.set(root, _payload_sujos(dias), merge=True)
+def marcas_dias_sujos(root_doc, dias=None):
+    # {dia: marca} lida antes de um reparo; None para dias sujos de antes do contador
+    marcas = dict((root_doc or {}).get("dias_sujos_marca") or {})
+    if dias is None:
+        dias = (root_doc or {}).get("dias_sujos") or []
+    return {str(d)[:10]: marcas.get(_marca_dia(d)) for d in dias if d}
+def limpar_dias_sujos(root, marcas_lidas):
+    """Compare-and-remove dos dias reparados: retira de dias_sujos só os dias cuja marca ainda é a lida
+    antes do reparo. Escrita no meio (mesmo num dia que já estava sujo) mantém o dia sujo.
+
+    Retorna os dias que continuam sujos.
+    """
+    marcas_lidas = dict(marcas_lidas or {})
+    if not marcas_lidas:
+        return []
+    apagar = getattr(firestore, "DELETE_FIELD", None)
+    def _aplicar(atual, gravar):
+        marcas = dict((atual or {}).get("dias_sujos_marca") or {})
+        limpos = sorted(d for d, m in marcas_lidas.items() if marcas.get(_marca_dia(d)) == m)
+        if limpos:
+            payload = {"dias_sujos": firestore.ArrayRemove(limpos), "verificado_em": firestore.SERVER_TIMESTAMP}
+            if apagar is not None:
+                payload["dias_sujos_marca"] = {_marca_dia(d): apagar for d in limpos}
+            gravar(payload)
+        return sorted(set(marcas_lidas) - set(limpos))
+    db = get_db()
+    transactional = getattr(firestore, "transactional", None)
+    try:
+        if transactional is None or getattr(db, "transaction", None) is None:
+            # cliente sem transação (modo de teste): mesma comparação fora de transação
+            return _aplicar(root.get().to_dict(), lambda p: root.set(p, merge=True))
+        @transactional
+        def _tx(transaction):
+            return _aplicar(root.get(transaction=transaction).to_dict(), lambda p: transaction.set(root, p, merge=True))
+        return _tx(db.transaction())
+    except Exception:
+        return sorted(marcas_lidas)
+def saldo_anterior_gravado(root_doc, mes, mm, cliente_id=None):
+    # saldo_anterior gravado no doc do mês, ou None se ausente ou desatualizado. As escritas não o
+    # ajustam (nada de leitura nem corrida no caminho de escrita): vale até uma escrita num mês
+    # anterior, que fica em dias_sujos até o reparo refazer a cadeia. Com cliente_id, os dias sujos
+    # que bloqueiam o valor vão para a fila de reparos, que os drena.
+    if (mm or {}).get("saldo_anterior") is None:
+        return None
+    bloqueiam = [d for d in ((root_doc or {}).get("dias_sujos") or []) if str(d)[:7] < str(mes)]
+    if bloqueiam:
+        if cliente_id is not None:
+            try:
+                from app.services.repair_queue import agendar_reparo  # lazy import
+                for d in bloqueiam:
+                    agendar_reparo(cliente_id, "dia", str(d)[:10])
+            except Exception:
+                pass
+        return None
+    return float(mm.get("saldo_anterior") or 0)
+def saldo_anterior_mes(cliente_id, mes, root_doc=None):
+    # (saldo acumulado antes de `mes`, doc do mês, docs lidos); saldo None quando o cliente não tem o índice
+    root = _cliente_root(cliente_id)
+    if root_doc is None:
+        root_doc, mm = get_docs_many([root, root.collection("meses").document(mes)])
+        lidos = 2
+    else:
+        mm = root.collection("meses").document(mes).get().to_dict() or {}
+        lidos = 1
+    if agregados_versao(root_doc) < 3:
+        return None, mm, lidos
+    gravado = saldo_anterior_gravado(root_doc, mes, mm, cliente_id=cliente_id)
+    if gravado is not None:
+        return gravado, mm, lidos
+    try:
+        seguintes = [d.to_dict() or {} for d in _meses_a_partir(root, mes)]
+    except Exception:
+        return None, mm, lidos
+    saldo_geral = float((root_doc.get("totais_geral", {}) or {}).get("saldo_geral", 0) or 0)
+    return saldo_geral - sum(_saldo_mes_doc(o) for o in seguintes), mm, lidos + len(seguintes)
+def planejar_intervalo(inicio, fim, incluir_fim=True, usar_anos=True):
+    # Decompõe [inicio, fim] em anos inteiros, meses inteiros e dias avulsos nas bordas: [(nivel, chave)]
+    try:
+        cur = datetime.strptime(str(inicio)[:10], "%Y-%m-%d")
+        end = datetime.strptime(str(fim)[:10], "%Y-%m-%d")
+    except Exception:
+        return []
+    if incluir_fim:
+        end = end + timedelta(days=1)
+    out = []
+    while cur < end:
+        if usar_anos and cur.month == 1 and cur.day == 1 and datetime(cur.year + 1, 1, 1) <= end:
+            out.append(("ano", cur.strftime("%Y")))
+            cur = datetime(cur.year + 1, 1, 1)
+            continue
+        if cur.day == 1:
+            prox = datetime(cur.year + 1, 1, 1) if cur.month == 12 else datetime(cur.year, cur.month + 1, 1)
+            if prox <= end:
+                out.append(("mes", cur.strftime("%Y-%m")))
+                cur = prox
+                continue
+        out.append(("dia", cur.strftime("%Y-%m-%d")))
+        cur = cur + timedelta(days=1)
+    return out
+_NIVEL_COLECAO = {"ano": "anos", "mes": "meses", "dia": "dias"}
+def _totais_nivel(doc, nivel):
+    doc = doc or {}
+    t = dict(doc.get(f"totais_{nivel}", {}) or {})
+    if not t:
+        t = doc
+    return {
+        "entrada": float(t.get("total_entrada", 0) or 0),
+        "saida": float(t.get("total_saida", 0) or 0),
+        "ajuste": float(t.get("total_ajuste", 0) or 0),
+        "estorno": float(t.get("total_estorno", 0) or 0),
+    }
+def _categorias_nivel(doc):
+    doc = doc or {}
+    c = dict(doc.get("categorias", {}) or {})
+    return {tp: dict(c.get(tp, doc.get(f"categorias_{tp}", {})) or {}) for tp in ("entrada", "saida", "estorno", "ajuste")}
+def somar_intervalo(cliente_id, inicio, fim, incluir_fim=True, root_doc=None):
+    # Totais e categorias de um intervalo lendo o mínimo de docs de agregado (anos > meses > dias).
+    # Anos só são usados para clientes com agregados_versao >= 2; senão o ano é aberto em meses.
+    root = _cliente_root(cliente_id)
+    plano = planejar_intervalo(inicio, fim, incluir_fim=incluir_fim)
+    lidos = 0
+    if root_doc is None and any(n == "ano" for n, _ in plano):
+        root_doc = get_docs_many([root])[0]
+        lidos += 1
+    if agregados_versao(root_doc) < 2:
+        aberto = []
+        for nivel, chave in plano:
+            if nivel == "ano":
+                aberto.extend(("mes", f"{chave}-{m:02d}") for m in range(1, 13))
+            else:
+                aberto.append((nivel, chave))
+        plano = aberto
+    docs = get_docs_many([root.collection(_NIVEL_COLECAO[n]).document(k) for n, k in plano])
+    lidos += len(plano)
+    totais = {"entrada": 0.0, "saida": 0.0, "ajuste": 0.0, "estorno": 0.0}
+    categorias = {"entrada": {}, "saida": {}, "estorno": {}, "ajuste": {}}
+    for (nivel, chave), d in zip(plano, docs):
+        if not d:
+            continue
+        for tp, v in _totais_nivel(d, nivel).items():
+            totais[tp] += v
+        for tp, cm in _categorias_nivel(d).items():
+            for k, v in cm.items():
+                categorias[tp][k] = float(categorias[tp].get(k, 0.0) or 0.0) + float(v or 0)
+    totais["saldo"] = totais["entrada"] - totais["saida"] + totais["estorno"] + totais["ajuste"]
+    return {
+        "totais": totais,
+        "categorias": categorias,
+        "plano": {
+            "anos": [k for n, k in plano if n == "ano"],
+            "meses": [k for n, k in plano if n == "mes"],
+            "dias": len([1 for n, _ in plano if n == "dia"]),
+            "docs_lidos": lidos,
+        },
+    }
+def _novo_acumulado():
+    return {
+        "total_entrada": 0.0,
+        "total_saida": 0.0,
+        "total_ajuste": 0.0,
+        "total_estorno": 0.0,
+        "quantidade_transacoes": 0,
+        "quantidade_transacoes_validas": 0,
+        "categorias": {"entrada": {}, "saida": {}, "estorno": {}, "ajuste": {}},
+    }
+def _somar_acumulado(a, totais, qtd, qtd_validas, categorias):
+    for k in ("total_entrada", "total_saida", "total_ajuste", "total_estorno"):
+        a[k] = float(a.get(k, 0.0) or 0.0) + float(totais.get(k, 0.0) or 0.0)
+    a["quantidade_transacoes"] += int(qtd or 0)
+    a["quantidade_transacoes_validas"] += int(qtd_validas or 0)
+    for tp, cmap in dict(categorias or {}).items():
+        dst = a["categorias"].setdefault(tp, {})
+        for c, v in dict(cmap or {}).items():
+            dst[c] = float(dst.get(c, 0.0) or 0.0) + float(v or 0.0)
+def _payload_acumulado(nivel, a, com_categorias=True):
+    te = float(a.get("total_entrada", 0.0) or 0.0)
+    ts = float(a.get("total_saida", 0.0) or 0.0)
+    ta = float(a.get("total_ajuste", 0.0) or 0.0)
+    tes = float(a.get("total_estorno", 0.0) or 0.0)
+    payload = {
+        "quantidade_transacoes": int(a.get("quantidade_transacoes", 0) or 0),
+        "quantidade_transacoes_validas": int(a.get("quantidade_transacoes_validas", 0) or 0),
+        "totais_por_tipo": {"entrada": te, "saida": ts, "estorno": tes, "ajuste": ta},
+        f"totais_{nivel}": {
+            "total_entrada": te,
+            "total_saida": ts,
+            "total_estorno": tes,
+            "total_ajuste": ta,
+            f"saldo_{nivel}": float(te - ts + tes + ta),
+        },
+        "atualizado_em": firestore.SERVER_TIMESTAMP,
+    }
+    if com_categorias:
+        payload["categorias"] = {tp: dict(cmap or {}) for tp, cmap in dict(a.get("categorias", {}) or {}).items()}
+    return payload
+def _mover_categoria_superiores(batch, root, dr, tipo, valor, cat_antiga, cat_nova):
+    refs = [root.collection("anos").document(str(dr)[:4])]
+    wk = week_key(dr)
+    if wk:
+        refs.append(root.collection("semanas").document(wk))
+    for ref in refs:
+        batch.set(ref, {
+            f"categorias.{tipo}.{cat_antiga}": firestore.Increment(-valor),
+            f"categorias.{tipo}.{cat_nova}": firestore.Increment(valor),
+            "atualizado_em": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
 _DESC_FIX = {
     'vndas': 'vendas',
     'vend': 'vendas',
@@ -415,8 +860,9 @@ def salvar_transacao_cliente(dados, cliente_id="default", origem="api", referenc
     mr = _month_key_sp()
     arr = dados if isinstance(dados, list) else [dados]
     out = []
-    fallback_out = None
-    batch = db.batch()
+    itens = []
+    # escritas repetidas em dias/meses/raiz viram uma por doc; commit_agrupado pode juntar chamadas simultâneas
+    batch = LoteCoalescido()
     for item in arr or []:
         base = normalize_item_for_store(item or {})
         tp_raw = str(base.get("tipo", "0")).strip().lower()
@@ -452,14 +898,15 @@ def salvar_transacao_cliente(dados, cliente_id="default", origem="api", referenc
         item_ref = day_ref.collection("items").document()
         doc["ref_id"] = build_ref_id(doc["data_referencia"], item_ref.id)
         batch.set(item_ref, doc)
+        indexar_extrato(batch, root, doc["data_referencia"], item_ref.id, doc)
         dref = root.collection("dias").document(doc["data_referencia"])
         mkey = doc["data_referencia"][:7]
         mref = root.collection("meses").document(mkey)
         try:
             ano, m = mkey.split("-")
-            mref.set({"ano": int(ano), "mes": int(m)}, merge=True)
+            batch.set(mref, {"ano": int(ano), "mes": int(m)}, merge=True)
         except:
-            mref.set({}, merge=True)
+            batch.set(mref, {}, merge=True)
         try:
             ano_d, mes_d, dia_d = doc["data_referencia"].split("-")
             batch.set(dref, {"ano": int(ano_d), "mes": int(mes_d), "dia": int(dia_d), "data": doc["data_referencia"]}, merge=True)
@@ -468,93 +915,11 @@ def salvar_transacao_cliente(dados, cliente_id="default", origem="api", referenc
         inc_d = {"atualizado_em": firestore.SERVER_TIMESTAMP}
         inc_m = {"atualizado_em": firestore.SERVER_TIMESTAMP}
         cat = str(base.get("categoria", "outros"))
-        if tp_txt == "entrada":
-            inc_d.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_dia.total_entrada": firestore.Increment(val),
-                "totais_por_tipo.entrada": firestore.Increment(val),
-                "totais_dia.saldo_dia": firestore.Increment(val),
-            })
-            inc_m.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_mes.total_entrada": firestore.Increment(val),
-                "totais_por_tipo.entrada": firestore.Increment(val),
-                "totais_mes.saldo_mes": firestore.Increment(val),
-            })
-            inc_m.update({f"categorias.entrada.{cat}": firestore.Increment(val)})
-            inc_d.update({f"categorias.entrada.{cat}": firestore.Increment(val)})
-        elif tp_txt == "saida":
-            inc_d.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_dia.total_saida": firestore.Increment(val),
-                "totais_por_tipo.saida": firestore.Increment(val),
-                "totais_dia.saldo_dia": firestore.Increment(-val),
-            })
-            inc_m.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_mes.total_saida": firestore.Increment(val),
-                "totais_por_tipo.saida": firestore.Increment(val),
-                "totais_mes.saldo_mes": firestore.Increment(-val),
-            })
-            inc_m.update({f"categorias.saida.{cat}": firestore.Increment(val)})
-            inc_d.update({f"categorias.saida.{cat}": firestore.Increment(val)})
-        elif tp_txt == "ajuste":
-            inc_d.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_dia.total_ajuste": firestore.Increment(val),
-                "totais_por_tipo.ajuste": firestore.Increment(val),
-                "totais_dia.saldo_dia": firestore.Increment(val),
-            })
-            inc_m.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_mes.total_ajuste": firestore.Increment(val),
-                "totais_por_tipo.ajuste": firestore.Increment(val),
-                "totais_mes.saldo_mes": firestore.Increment(val),
-            })
-            inc_m.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-            inc_d.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-        elif tp_txt == "estorno":
-            inc_d.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_dia.total_estorno": firestore.Increment(abs(val)),
-                "totais_por_tipo.estorno": firestore.Increment(abs(val)),
-                "totais_dia.saldo_dia": firestore.Increment(abs(val)),
-            })
-            inc_m.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_mes.total_estorno": firestore.Increment(abs(val)),
-                "totais_por_tipo.estorno": firestore.Increment(abs(val)),
-                "totais_mes.saldo_mes": firestore.Increment(abs(val)),
-            })
-            inc_m.update({f"categorias.estorno.{cat}": firestore.Increment(abs(val))})
-            inc_d.update({f"categorias.estorno.{cat}": firestore.Increment(abs(val))})
-        else:
-            inc_d.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_dia.total_ajuste": firestore.Increment(val),
-                "totais_por_tipo.ajuste": firestore.Increment(val),
-                "totais_dia.saldo_dia": firestore.Increment(val),
-            })
-            inc_m.update({
-                "quantidade_transacoes": firestore.Increment(1),
-                "quantidade_transacoes_validas": firestore.Increment(1),
-                "totais_mes.total_ajuste": firestore.Increment(val),
-                "totais_por_tipo.ajuste": firestore.Increment(val),
-                "totais_mes.saldo_mes": firestore.Increment(val),
-            })
-            inc_m.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-            inc_d.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
+        inc_d.update(incrementos_agregado("dia", tp_txt, val, cat))
+        inc_m.update(incrementos_agregado("mes", tp_txt, val, cat))
         batch.set(dref, inc_d, merge=True)
         batch.set(mref, inc_m, merge=True)
+        incrementar_agregados_superiores(batch, root, doc["data_referencia"], tp_txt, val, cat)
         try:
             delta = 0.0
             if tp_txt == "entrada":
@@ -567,163 +932,51 @@ def salvar_transacao_cliente(dados, cliente_id="default", origem="api", referenc
                 batch.set(root, {"saldo_real": firestore.Increment(delta), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
         except:
             pass
+        batch.set(root, {"versao": firestore.Increment(1)}, merge=True)
         out.append(doc)
+        itens.append(_ref_path(item_ref))
     try:
-        batch.commit()
+        marcar_dias_sujos(batch, root, [o.get("data_referencia") for o in out])
     except Exception:
-        fallback_out = []
-        for item in arr or []:
-            try:
-                base = normalize_item_for_store(item or {})
-                tp_raw = str(base.get("tipo", "0")).strip().lower()
-                if tp_raw in ("1", "receita", "entrada"):
-                    tp_txt = "entrada"
-                elif tp_raw in ("0", "despesa", "saida"):
-                    tp_txt = "saida"
-                elif tp_raw in ("ajuste",):
-                    tp_txt = "ajuste"
-                elif tp_raw in ("estorno",):
-                    tp_txt = "estorno"
-                else:
-                    tp_txt = "saida"
-                if tipo_operacao in ("ajuste", "estorno"):
-                    tp_txt = tipo_operacao
-                val = float(base.get("valor", 0) or 0)
-                ref_day = str(base.get("data_referencia") or dr)
-                day_ref = root.collection("transacoes").document(ref_day)
-                item_ref = day_ref.collection("items").document()
-                doc = {
-                    "valor": val,
-                    "tipo": tp_txt,
-                    "categoria": str(base.get("categoria", "outros")),
-                    "descricao": str(base.get("descricao", "")),
-                    "data_referencia": ref_day,
-                    "timestamp_criacao": firestore.SERVER_TIMESTAMP,
-                    "moeda": str(item.get("moeda", "BRL")),
-                    "origem": origem,
-                    "referencia_id": referencia_id,
-                    "motivo_ajuste": motivo_ajuste,
-                    "imutavel": True,
-                    "confidence_score": float(base.get("confidence_score", item.get("confidence_score", 0.0) or 0.0) or 0.0),
-                    "pendente_confirmacao": bool(base.get("pendente_confirmacao", item.get("pendente_confirmacao", False))),
-                }
-                doc["ref_id"] = build_ref_id(ref_day, item_ref.id)
-                dref = root.collection("dias").document(ref_day)
-                mref = root.collection("meses").document(ref_day[:7])
-                item_ref.set(doc)
-                inc_d = {"atualizado_em": firestore.SERVER_TIMESTAMP}
-                inc_m = {"atualizado_em": firestore.SERVER_TIMESTAMP}
-                cat = str(base.get("categoria", "outros"))
-                if tp_txt == "entrada":
-                    inc_d.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_dia.total_entrada": firestore.Increment(val),
-                        "totais_por_tipo.entrada": firestore.Increment(val),
-                        "totais_dia.saldo_dia": firestore.Increment(val)
-                    })
-                    inc_m.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_mes.total_entrada": firestore.Increment(val),
-                        "totais_por_tipo.entrada": firestore.Increment(val),
-                        "totais_mes.saldo_mes": firestore.Increment(val)
-                    })
-                    inc_m.update({f"categorias.entrada.{cat}": firestore.Increment(val)})
-                    inc_d.update({f"categorias.entrada.{cat}": firestore.Increment(val)})
-                elif tp_txt == "saida":
-                    inc_d.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_dia.total_saida": firestore.Increment(val),
-                        "totais_por_tipo.saida": firestore.Increment(val),
-                        "totais_dia.saldo_dia": firestore.Increment(-val)
-                    })
-                    inc_m.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_mes.total_saida": firestore.Increment(val),
-                        "totais_por_tipo.saida": firestore.Increment(val),
-                        "totais_mes.saldo_mes": firestore.Increment(-val)
-                    })
-                    inc_m.update({f"categorias.saida.{cat}": firestore.Increment(val)})
-                    inc_d.update({f"categorias.saida.{cat}": firestore.Increment(val)})
-                elif tp_txt == "ajuste":
-                    inc_d.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_dia.total_ajuste": firestore.Increment(val),
-                        "totais_por_tipo.ajuste": firestore.Increment(val),
-                        "totais_dia.saldo_dia": firestore.Increment(val)
-                    })
-                    inc_m.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_mes.total_ajuste": firestore.Increment(val),
-                        "totais_por_tipo.ajuste": firestore.Increment(val),
-                        "totais_mes.saldo_mes": firestore.Increment(val)
-                    })
-                    inc_m.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-                    inc_d.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-                elif tp_txt == "estorno":
-                    inc_d.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_dia.total_estorno": firestore.Increment(abs(val)),
-                        "totais_por_tipo.estorno": firestore.Increment(abs(val)),
-                        "totais_dia.saldo_dia": firestore.Increment(abs(val)),
-                    })
-                    inc_m.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_mes.total_estorno": firestore.Increment(abs(val)),
-                        "totais_por_tipo.estorno": firestore.Increment(abs(val)),
-                        "totais_mes.saldo_mes": firestore.Increment(abs(val)),
-                    })
-                    inc_m.update({f"categorias.estorno.{cat}": firestore.Increment(abs(val))})
-                    inc_d.update({f"categorias.estorno.{cat}": firestore.Increment(abs(val))})
-                else:
-                    inc_d.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_dia.total_ajuste": firestore.Increment(val),
-                        "totais_por_tipo.ajuste": firestore.Increment(val),
-                        "totais_dia.saldo_dia": firestore.Increment(val)
-                    })
-                    inc_m.update({
-                        "quantidade_transacoes": firestore.Increment(1),
-                        "quantidade_transacoes_validas": firestore.Increment(1),
-                        "totais_mes.total_ajuste": firestore.Increment(val),
-                        "totais_por_tipo.ajuste": firestore.Increment(val),
-                        "totais_mes.saldo_mes": firestore.Increment(val)
-                    })
-                    inc_m.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-                    inc_d.update({f"categorias.ajuste.{cat}": firestore.Increment(val)})
-                try:
-                    ano_d, mes_d, dia_d = ref_day.split("-")
-                    root.collection("dias").document(ref_day).set({"ano": int(ano_d), "mes": int(mes_d), "dia": int(dia_d), "data": ref_day}, merge=True)
-                except:
-                    root.collection("dias").document(ref_day).set({"data": ref_day}, merge=True)
-                root.collection("dias").document(ref_day).set(inc_d, merge=True)
-                mref.set(inc_m, merge=True)
-                try:
-                    delta = 0.0
-                    if tp_txt == "entrada":
-                        delta = float(val or 0)
-                    elif tp_txt == "saida":
-                        delta = -float(val or 0)
-                    elif tp_txt == "ajuste":
-                        delta = float(val or 0)
-                    if abs(delta) > 0:
-                        root.set({"saldo_real": firestore.Increment(delta), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
-                except:
-                    pass
-                fallback_out.append(doc)
-            except Exception:
-                pass
-    if fallback_out is not None:
-        return fallback_out
-    return out
+        pass
+    erro = None
+    if batch.tamanho() <= LIMITE_OPS:
+        try:
+            commit_agrupado(str(cliente_id or "default"), batch, db)
+            return out
+        except Exception as e:
+            erro = e
+    dias_lote = sorted(set(str(o.get("data_referencia")) for o in out))
+    if erro is not None and not nao_gravou(erro):
+        # commit ambíguo (timeout, rede): pode ter sido aplicado; repetir dobraria os Increment.
+        # Não reenvia; marca os dias para reparo e devolve a falha marcada como incerta.
+        _reparar_dias(root, cliente_id, dias_lote)
+        try:
+            erro.escrita_incerta = True
+        except Exception:
+            pass
+        raise erro
+    # Lote grande demais ou recusado sem gravar nada: as mesmas escritas (mesmos ids) em lotes menores
+    w = BatchWriter(db)
+    batch.reproduzir(w)
+    w.flush()
+    if not w.falhas:
+        return out
+    _reparar_dias(root, cliente_id, dias_lote)
+    falhos = set(w.falhas_refs)
+    return [o for o, p in zip(out, itens) if p not in falhos]
+def _reparar_dias(root, cliente_id, dias):
+    # dias_sujos persiste a pendência; a fila resolve logo no processo atual
+    try:
+        root.set(_payload_sujos(dias), merge=True)
+    except Exception:
+        pass
+    try:
+        from app.services.repair_queue import agendar_reparo  # lazy import
+        for dr in dias:
+            agendar_reparo(cliente_id, "dia", dr)
+    except Exception:
+        pass
 def estornar_transacao(cliente_id, referencia_id, motivo=None, origem="api"):
     db = get_db()
     root = _cliente_root(cliente_id)
@@ -808,6 +1061,11 @@ def estornar_transacao(cliente_id, referencia_id, motivo=None, origem="api"):
         batch.update(orig_ref, {"estornado": True, "atualizado_em": firestore.SERVER_TIMESTAMP})
     except:
         pass
+    try:
+        desindexar_extrato(batch, root, dr, orig_ref.id)
+        indexar_extrato(batch, root, dr, estorno_ref.id, payload)
+    except Exception:
+        pass
     dref = root.collection("dias").document(dr)
     mref = root.collection("meses").document(dr[:7])
     cat = payload_cat
@@ -837,6 +1095,11 @@ def estornar_transacao(cliente_id, referencia_id, motivo=None, origem="api"):
     })
     batch.set(dref, inc_d, merge=True)
     batch.set(mref, inc_m, merge=True)
+    incrementar_agregados_superiores(batch, root, dr, "estorno", abs_val, cat)
+    try:
+        marcar_dias_sujos(batch, root, [dr])
+    except Exception:
+        pass
     try:
         delta = 0.0
         if tp == "entrada":
@@ -844,7 +1107,7 @@ def estornar_transacao(cliente_id, referencia_id, motivo=None, origem="api"):
         else:
             delta = float(val or 0)
         if abs(delta) > 0:
-            batch.set(root, {"saldo_real": firestore.Increment(delta), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+            batch.set(root, {"saldo_real": firestore.Increment(delta), "versao": firestore.Increment(1), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
     except:
         pass
     batch.commit()
@@ -952,8 +1215,14 @@ def atualizar_categoria_transacao(cliente_id: str, referencia_id: str, nova_cate
         })
     batch.set(dref, inc_d, merge=True)
     batch.set(mref, inc_m, merge=True)
+    if tp_raw in ("entrada", "1", "receita"):
+        _mover_categoria_superiores(batch, root, dr, "entrada", val, old_cat, novo_cat)
+    elif tp_raw in ("saida", "0", "despesa"):
+        _mover_categoria_superiores(batch, root, dr, "saida", val, old_cat, novo_cat)
     try:
-        batch.set(root, {"atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+        batch.set(root, {"versao": firestore.Increment(1), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+        marcar_dias_sujos(batch, root, [dr])
+        indexar_extrato(batch, root, dr, tdoc_ref.id, {**o, **upd})
     except:
         pass
     batch.commit()
@@ -986,35 +1255,158 @@ def atualizar_memoria_categoria(cliente_id: str, key: str, categoria: str):
         return True
     except:
         return False
+# Coleções sem subcoleções no esquema atual: não vale um RPC collections() por documento.
+# `meses` não entra: cada mês tem o índice meses/{YYYY-MM}/extrato, e o doc restaurado mantém
+# extrato_indexado=True.
+_BACKUP_FOLHAS = {"items", "dias", "extrato", "anos", "semanas"}
+def _backup_encode(v):
+    if isinstance(v, dict):
+        return {str(k): _backup_encode(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_backup_encode(x) for x in v]
+    if isinstance(v, datetime):
+        return {"__tipo__": "timestamp", "valor": v.isoformat()}
+    if isinstance(v, bytes):
+        import base64
+        return {"__tipo__": "bytes", "valor": base64.b64encode(v).decode("ascii")}
+    if hasattr(v, "latitude") and hasattr(v, "longitude"):
+        return {"__tipo__": "geopoint", "valor": [v.latitude, v.longitude]}
+    if hasattr(v, "path") and hasattr(v, "collection"):
+        return {"__tipo__": "referencia", "valor": str(v.path)}
+    return v
+def _backup_decode(db, v):
+    if isinstance(v, list):
+        return [_backup_decode(db, x) for x in v]
+    if not isinstance(v, dict):
+        return v
+    tp = v.get("__tipo__")
+    if tp and len(v) == 2 and "valor" in v:
+        try:
+            if tp == "timestamp":
+                return datetime.fromisoformat(v["valor"])
+            if tp == "bytes":
+                import base64
+                return base64.b64decode(v["valor"])
+            if tp == "geopoint":
+                return firestore.GeoPoint(*v["valor"])
+            if tp == "referencia":
+                return db.document(v["valor"])
+        except Exception:
+            return v["valor"]
+    return {k: _backup_decode(db, x) for k, x in v.items()}
+def _subcolecoes(ref):
+    try:
+        return list(ref.collections())
+    except Exception:
+        return []
+def _backup_colecao(col, escrever):
+    # Percorre a coleção em profundidade; docs "ausentes" (só com subcoleções, como transacoes/{dia})
+    # aparecem em list_documents e são visitados sem registro próprio.
+    n = 0
+    vistos = set()
+    folha = str(col.id) in _BACKUP_FOLHAS
+    for snap in col.stream():
+        escrever({"path": str(snap.reference.path), "data": _backup_encode(snap.to_dict() or {})})
+        n += 1
+        if not folha:
+            vistos.add(snap.id)
+            for sub in _subcolecoes(snap.reference):
+                n += _backup_colecao(sub, escrever)
+    if not folha:
+        try:
+            ausentes = [r for r in col.list_documents() if r.id not in vistos]
+        except Exception:
+            ausentes = []
+        for ref in ausentes:
+            for sub in _subcolecoes(ref):
+                n += _backup_colecao(sub, escrever)
+    return n
 def backup_firestore_data(output_path=None):
+    """Exporta o banco inteiro para NDJSON gzip, um registro {"path", "data"} por documento.
+
+    Escreve em streaming (memória constante), percorre todas as subcoleções e fecha com um
+    registro __fim__ contendo a contagem de documentos. Retorna o caminho do arquivo ou None.
+    """
+    import gzip
+    import json as _json
     db = get_db()
     ts = _now_sp().strftime("%Y%m%dT%H%M%S")
-    path = output_path or os.path.join(os.getcwd(), f"backup_firestore_{ts}.json")
-    data = {"clientes": {}, "transacoes_root": []}
+    path = output_path or os.path.join(os.getcwd(), f"backup_firestore_{ts}.ndjson.gz")
     try:
-        for d in db.collection("transacoes").stream():
-            data["transacoes_root"].append(d.to_dict() or {})
-    except:
-        pass
-    try:
-        for c in db.collection("clientes").stream():
-            cid = c.id
-            data["clientes"][cid] = {"transacoes": [], "dias": {}, "meses": {}}
-            for t in db.collection("clientes").document(cid).collection("transacoes").stream():
-                data["clientes"][cid]["transacoes"].append(t.to_dict() or {})
-            for d in db.collection("clientes").document(cid).collection("dias").stream():
-                data["clientes"][cid]["dias"][d.id] = d.to_dict() or {}
-            for m in db.collection("clientes").document(cid).collection("meses").stream():
-                data["clientes"][cid]["meses"][m.id] = m.to_dict() or {}
-    except:
-        pass
+        colecoes = list(db.collections())
+    except Exception:
+        colecoes = [db.collection("clientes"), db.collection("transacoes")]
+    total = 0
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            import json as _json
-            _json.dump(data, f, ensure_ascii=False, indent=2)
-    except:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            def _escrever(rec):
+                f.write(_json.dumps(rec, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+            _escrever({"__backup__": {"versao": 2, "criado_em": _now_sp().isoformat()}})
+            for col in colecoes:
+                total += _backup_colecao(col, _escrever)
+            _escrever({"__fim__": {"documentos": total}})
+    except Exception:
         return None
     return path
+def restore_firestore_data(input_path, lote=None):
+    """Restaura um backup NDJSON gzip de backup_firestore_data gravando em lotes (set sem merge)."""
+    import gzip
+    import json as _json
+    db = get_db()
+    lote = max(1, int(lote or _BATCH_MAX_OPS))
+    escritas = []
+    out = {"documentos": 0, "lotes": 0, "falhas": 0, "completo": False}
+    def _flush():
+        lotes, falhas = _gravar_em_lotes(db, escritas, tamanho=lote)
+        out["lotes"] += lotes
+        out["falhas"] += falhas
+        del escritas[:]
+    with gzip.open(input_path, "rt", encoding="utf-8") as f:
+        for linha in f:
+            linha = linha.strip()
+            if not linha:
+                continue
+            rec = _json.loads(linha)
+            if "__fim__" in rec:
+                out["completo"] = int((rec.get("__fim__") or {}).get("documentos", -1)) == out["documentos"]
+                continue
+            if "path" not in rec:
+                continue
+            escritas.append((db.document(rec["path"]), _backup_decode(db, rec.get("data") or {}), False))
+            out["documentos"] += 1
+            if len(escritas) >= lote:
+                _flush()
+    if escritas:
+        _flush()
+    return out
+# transacoes_schema >= 2 no doc do cliente: todas as transações estão em transacoes/{dia}/items e
+# as leituras não precisam mais da consulta legada em `transacoes` plana nem do mapa de dedup.
+TRANSACOES_SCHEMA_ANINHADO = 2
+_MIGRADOS = {}
+_MIGRADOS_LOCK = threading.Lock()
+try:
+    _MIGRADOS_TTL_NEG = float(os.getenv("MIGRADO_CACHE_TTL", "300") or 300)
+except Exception:
+    _MIGRADOS_TTL_NEG = 300.0
+def _marcar_migrado_cache(cliente_id, migrado):
+    with _MIGRADOS_LOCK:
+        _MIGRADOS[str(cliente_id)] = (bool(migrado), time.time())
+def cliente_migrado(cliente_id, root_doc=None):
+    # Memoizado: "migrado" não volta atrás; "não migrado" é reconsultado após MIGRADO_CACHE_TTL segundos
+    k = str(cliente_id)
+    with _MIGRADOS_LOCK:
+        cur = _MIGRADOS.get(k)
+    if cur is not None and (cur[0] or (time.time() - cur[1]) < _MIGRADOS_TTL_NEG):
+        return cur[0]
+    try:
+        if root_doc is None:
+            root_doc = _cliente_root(k).get().to_dict() or {}
+        migrado = int((root_doc or {}).get("transacoes_schema", 0) or 0) >= TRANSACOES_SCHEMA_ANINHADO
+    except Exception:
+        return False
+    _marcar_migrado_cache(k, migrado)
+    return migrado
 def migrate_cliente_transacoes_to_nested(cliente_id: str, delete_original: bool = False):
     db = get_db()
     root = _cliente_root(cliente_id)
@@ -1025,6 +1417,7 @@ def migrate_cliente_transacoes_to_nested(cliente_id: str, delete_original: bool
         docs = list(root.collection("transacoes").stream())
     except Exception:
         docs = []
+    alvos = []
     for d in docs:
         try:
             o = d.to_dict() or {}
@@ -1032,418 +1425,760 @@ def migrate_cliente_transacoes_to_nested(cliente_id: str, delete_original: bool
             if not dr or len(dr) != 10:
                 skipped += 1
                 continue
-            items = root.collection("transacoes").document(dr).collection("items")
-            # Avoid duplicates: reuse original id
-            tgt = items.document(d.id)
-            tdoc = tgt.get()
-            if tdoc.exists:
-                skipped += 1
-                # Optionally delete original even if exists
-                if delete_original:
-                    try:
-                        root.collection("transacoes").document(d.id).delete()
-                    except:
-                        pass
-                continue
-            payload = dict(o)
-            payload["ref_id"] = build_ref_id(dr, d.id)
-            tgt.set(payload)
-            moved += 1
-            if delete_original:
-                try:
-                    root.collection("transacoes").document(d.id).delete()
-                except:
-                    pass
+            # reaproveita o id original para não duplicar
+            alvos.append((d.id, o, dr, root.collection("transacoes").document(dr).collection("items").document(d.id)))
         except Exception:
             errors += 1
-    return {"cliente_id": str(cliente_id), "moved": moved, "skipped": skipped, "errors": errors}
-def recompute_cliente_aggregates(cliente_id: str):
-    db = get_db()
-    root = _cliente_root(cliente_id)
-    month_agg = {}
-    days_processed = 0
-    day_keys = []
+    existentes = get_docs_many([t for _i, _o, _dr, t in alvos]) if alvos else []
+    w = BatchWriter(db, idempotente=True)
+    for (did, o, dr, tgt), atual in zip(alvos, existentes):
+        if atual:
+            skipped += 1
+            continue
+        payload = dict(o)
+        payload["ref_id"] = build_ref_id(dr, did)
+        w.set(tgt, payload)
+        moved += 1
+    w.flush()
+    moved -= w.falhas
+    errors += w.falhas
+    if delete_original:
+        # original só sai depois que a cópia aninhada foi gravada
+        falhos = set(w.falhas_refs)
+        wd = BatchWriter(db, idempotente=True)
+        for did, _o, _dr, tgt in alvos:
+            if _ref_path(tgt) not in falhos:
+                wd.delete(root.collection("transacoes").document(did))
+        wd.flush()
+    migrado = False
+    if errors == 0:
+        try:
+            root.set({
+                "transacoes_schema": TRANSACOES_SCHEMA_ANINHADO,
+                "transacoes_migrado_em": firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+            _marcar_migrado_cache(cliente_id, True)
+            migrado = True
+        except Exception:
+            pass
+    return {"cliente_id": str(cliente_id), "moved": moved, "skipped": skipped, "errors": errors, "migrado": migrado}
+def _dedup_transacoes(fontes):
+    # Junta listas de dicts (aninhados primeiro, legados depois) descartando repetidos por ref_id/assinatura
+    out = []
+    idx = {}
+    for docs in fontes:
+        for o in docs:
+            try:
+                k = str(o.get("ref_id") or "") or (str(o.get("tipo", "")) + "|" + str(float(o.get("valor", 0) or 0)) + "|" + str(o.get("categoria", "")) + "|" + str(o.get("descricao", "")) + "|" + str(o.get("timestamp_criacao", "")))
+            except Exception:
+                k = str(o.get("ref_id") or "")
+            if idx.get(k):
+                continue
+            idx[k] = 1
+            out.append(o)
+    return out
+def _transacoes_dia(root, dr):
+    # Itens aninhados do dia + legados planos com data_referencia == dia, sem duplicados
+    fontes = []
     try:
-        for d in list(root.collection("transacoes").stream()):
-            di = str(d.id or "").strip()
-            if re.fullmatch(r"\d{4}-\d{2}-\d{2}", di or ""):
-                day_keys.append(di)
+        fontes.append([it.to_dict() or {} for it in root.collection("transacoes").document(dr).collection("items").stream()])
     except Exception:
         pass
+    if cliente_migrado(root.id):
+        return [o for docs in fontes for o in docs]
     try:
-        for dd in list(root.collection("dias").stream()):
-            di = str(dd.id or "").strip()
-            if re.fullmatch(r"\d{4}-\d{2}-\d{2}", di or ""):
-                day_keys.append(di)
+        fontes.append([it.to_dict() or {} for it in root.collection("transacoes").where("data_referencia", "==", dr).stream()])
     except Exception:
         pass
+    return _dedup_transacoes(fontes)
+# Índice do extrato mensal: meses/{YYYY-MM}/extrato/{id_do_item} guarda uma cópia enxuta de cada
+# transação não estornada. Consultado por valor (desc) + item_id, uma página lê só `limit` docs.
+# meses/{YYYY-MM}.extrato_indexado marca os meses cujo índice já foi montado.
+def _extrato_ref(root, dr, item_id):
+    return root.collection("meses").document(str(dr)[:7]).collection("extrato").document(str(item_id))
+def _extrato_payload(item_id, o, dr):
+    tp_raw = str(o.get("tipo", "")).strip().lower()
+    tp = "entrada" if tp_raw in ("1", "receita", "entrada") else ("saida" if tp_raw in ("0", "despesa", "saida") else tp_raw)
+    return {
+        "item_id": str(item_id),
+        "ref_id": str(o.get("ref_id") or build_ref_id(dr, item_id)),
+        "valor": float(o.get("valor", 0) or 0),
+        "tipo": tp,
+        "categoria": str(o.get("categoria", "outros") or "outros").strip().lower(),
+        "descricao": str(o.get("descricao", "")),
+        "data_referencia": str(dr),
+        "timestamp_criacao": o.get("timestamp_criacao"),
+    }
+def indexar_extrato(batch, root, dr, item_id, o):
+    if not dr or not item_id or bool((o or {}).get("estornado", False)):
+        return
+    batch.set(_extrato_ref(root, dr, item_id), _extrato_payload(item_id, o or {}, dr))
+def desindexar_extrato(batch, root, dr, item_id):
+    if dr and item_id:
+        batch.delete(_extrato_ref(root, dr, item_id))
+def construir_extrato_mes(cliente_id, mes):
+    """Monta o índice do extrato de um mês a partir dos itens (e legados planos). Retorna quantos docs gravou."""
+    db = get_db()
+    root = _cliente_root(cliente_id)
+    dt_ini, dt_fim = month_bounds(mes)
+    escritas = []
+    origens = []
+    vistos = set()
+    for dr, docs in sorted(_items_por_dia_paralelo(root, day_keys_between(dt_ini, dt_fim)).items()):
+        for o in docs:
+            _dr, item_id = parse_ref_id(o.get("ref_id"))
+            if not item_id or item_id in vistos:
+                continue
+            vistos.add(item_id)
+            if not bool(o.get("estornado", False)):
+                escritas.append((_extrato_ref(root, dr, item_id), _extrato_payload(item_id, o, dr), False))
+                origens.append(root.collection("transacoes").document(dr).collection("items").document(item_id))
+    if not cliente_migrado(cliente_id):
+        try:
+            tops = root.collection("transacoes").where("data_referencia", ">=", dt_ini).where("data_referencia", "<", dt_fim).stream()
+        except Exception:
+            tops = []
+        for t in tops:
+            o = t.to_dict() or {}
+            item_id = parse_ref_id(o.get("ref_id"))[1] if o.get("ref_id") else t.id
+            if item_id in vistos or bool(o.get("estornado", False)):
+                continue
+            vistos.add(item_id)
+            escritas.append((_extrato_ref(root, o.get("data_referencia"), item_id), _extrato_payload(item_id, o, str(o.get("data_referencia"))), False))
+            origens.append(t.reference)
+    _lotes, falhas = _gravar_em_lotes(db, escritas)
+    # Um estorno entre a leitura dos itens e a gravação acima teria a entrada recriada por cima do
+    # desindexar_extrato dele: relê os itens e remove o que foi estornado no meio.
+    # Estorno que chegar depois desta releitura remove a própria entrada.
+    atuais = get_docs_many(origens)
+    w = BatchWriter(db, idempotente=True)
+    for (ref, _p, _m), o in zip(escritas, atuais):
+        if bool((o or {}).get("estornado", False)):
+            w.delete(ref)
+    w.flush()
+    falhas += w.falhas
+    if falhas == 0:
+        root.collection("meses").document(mes).set({"extrato_indexado": True}, merge=True)
+    return len(escritas)
+def _cursor_encode(d):
+    import base64, json
+    return base64.urlsafe_b64encode(json.dumps(d, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+def _cursor_decode(c):
+    import base64, json
+    c = str(c or "")
+    return json.loads(base64.urlsafe_b64decode(c + "=" * (-len(c) % 4)).decode("utf-8"))
+def pagina_extrato_mes(cliente_id, mes, limit=50, cursor=None, categoria=None, mes_doc=None):
+    """Uma página do extrato do mês, ordenada por valor desc. Retorna (itens, proximo_cursor, docs_lidos).
+
+    O cursor é opaco para o cliente; cursor malformado ou de outro mês/categoria gera ValueError. Mês sem índice
+    montado retorna None e agenda a montagem na fila de reparos (a leitura não grava).
+    """
+    root = _cliente_root(cliente_id)
+    cat = str(categoria).strip().lower() if categoria else ""
+    lidos = 0
+    if mes_doc is None:
+        mes_doc = root.collection("meses").document(mes).get().to_dict() or {}
+        lidos += 1
+    if not mes_doc.get("extrato_indexado"):
+        from app.services.repair_queue import agendar_reparo  # lazy import
+        agendar_reparo(cliente_id, "extrato", mes)
+        return None
+    ultimo = None
+    if cursor:
+        try:
+            c = _cursor_decode(cursor)
+            ultimo = {"valor": float(c["v"]), "item_id": str(c["i"])}
+        except Exception:
+            raise ValueError("cursor inválido")
+        if c.get("m") != mes or c.get("c") != cat:
+            raise ValueError("cursor não corresponde ao mês/categoria")
+    q = root.collection("meses").document(mes).collection("extrato")
+    if cat:
+        q = q.where("categoria", "==", cat)
+    q = q.order_by("valor", direction="DESCENDING").order_by("item_id", direction="DESCENDING")
+    if ultimo is not None:
+        q = q.start_after(ultimo)
+    docs = [d.to_dict() or {} for d in q.limit(int(limit) + 1).stream()]
+    lidos += len(docs)
+    prox = None
+    if len(docs) > int(limit):
+        docs = docs[:int(limit)]
+        ult = docs[-1]
+        prox = _cursor_encode({"m": mes, "c": cat, "v": float(ult.get("valor", 0) or 0), "i": str(ult.get("item_id"))})
+    return docs, prox, lidos
+def totais_extrato_mes(cliente_id, mes, categoria=None):
+    """Soma de entradas e saídas do índice do extrato (só itens não estornados). Retorna {"entrada", "saida"}.
+
+    Usa a agregação sum() do Firestore (1 leitura a cada 1000 entradas); sem ela, percorre o índice.
+    """
+    col = _cliente_root(cliente_id).collection("meses").document(mes).collection("extrato")
+    cat = str(categoria).strip().lower() if categoria else ""
+    out = {}
+    for tp in ("entrada", "saida"):
+        q = col.where("tipo", "==", tp)
+        if cat:
+            q = q.where("categoria", "==", cat)
+        try:
+            res = q.sum("valor", alias="total").get()
+            out[tp] = float(res[0][0].value or 0)
+        except AttributeError:
+            out[tp] = sum(float((d.to_dict() or {}).get("valor", 0) or 0) for d in q.select(["valor"]).stream())
+    return out
+def listar_transacoes_dia(cliente_id, dr):
+    return _transacoes_dia(_cliente_root(cliente_id), dr)
+def _acumular_dia(transacoes):
+    a = _novo_acumulado()
+    for o in transacoes or []:
+        tp_raw = str(o.get("tipo", "")).strip().lower()
+        cat = str(o.get("categoria", "outros") or "outros").strip().lower()
+        val = float(o.get("valor", 0) or 0)
+        if tp_raw in ("estorno",):
+            tp = "estorno"
+            val = abs(val)
+        elif bool(o.get("estornado", False)):
+            continue
+        elif tp_raw in ("1", "receita", "entrada"):
+            tp = "entrada"
+        elif tp_raw in ("0", "despesa", "saida"):
+            tp = "saida"
+        elif tp_raw in ("ajuste",):
+            tp = "ajuste"
+        else:
+            continue
+        if tp != "estorno":
+            a["quantidade_transacoes"] += 1
+            a["quantidade_transacoes_validas"] += 1
+        a[f"total_{tp}"] += val
+        a["categorias"][tp][cat] = float(a["categorias"][tp].get(cat, 0.0) or 0.0) + val
+    return a
+def _payload_dia(dr, a):
+    try:
+        ano_d, mes_d, dia_d = [int(x) for x in str(dr).split("-")]
+    except Exception:
+        ano_d = mes_d = dia_d = None
+    return {"ano": ano_d, "mes": mes_d, "dia": dia_d, "data": dr, **_payload_acumulado("dia", a)}
+def _payload_mes(mk, a):
     try:
-        day_keys = sorted(list(set(day_keys)))
+        ano_i, mes_i = [int(x) for x in str(mk).split("-")]
     except Exception:
-        day_keys = list(set(day_keys))
-    for dr in day_keys:
-        total_entrada = 0.0
-        total_saida = 0.0
-        total_ajuste = 0.0
-        total_estorno = 0.0
-        qtd = 0
-        qtd_validas = 0
-        day_cat_inc = {}
-        day_cat_exp = {}
-        day_cat_est = {}
-        day_cat_adj = {}
-        idx = {}
-        items = []
-        tops = []
+        ano_i = mes_i = None
+    return {"ano": ano_i, "mes": mes_i, **_payload_acumulado("mes", a)}
+def _acumulado_de_doc(doc, nivel):
+    a = _novo_acumulado()
+    doc = doc or {}
+    t = _totais_nivel(doc, nivel)
+    _somar_acumulado(
+        a,
+        {f"total_{tp}": v for tp, v in t.items()},
+        int(doc.get("quantidade_transacoes", 0) or 0),
+        int(doc.get("quantidade_transacoes_validas", doc.get("quantidade_transacoes", 0)) or 0),
+        _categorias_nivel(doc),
+    )
+    return a
+def recompute_cliente_dias(cliente_id, dias=None, meses=None):
+    # Reparo pontual: refaz os dias a partir das transações, os meses afetados a partir dos docs de dia
+    # e, para clientes versionados, anos/semanas/totais_geral e a cadeia de saldo_anterior.
+    db = get_db()
+    root = _cliente_root(cliente_id)
+    dias = sorted(set(str(d) for d in (dias or []) if d))
+    meses = set(str(m) for m in (meses or []) if m)
+    w = BatchWriter(db, idempotente=True)
+    for dr in dias:
         try:
-            items = list(root.collection("transacoes").document(dr).collection("items").stream())
+            w.set(root.collection("dias").document(dr), _payload_dia(dr, _acumular_dia(_transacoes_dia(root, dr))), merge=True)
         except Exception:
-            items = []
+            pass
+        meses.add(dr[:7])
+    # os meses abaixo são somados a partir dos docs de dia recém-gravados
+    w.flush()
+    semanas = set()
+    for mk in sorted(meses):
+        a = _novo_acumulado()
         try:
-            tops = list(root.collection("transacoes").where("data_referencia", "==", dr).stream())
+            dias_mes = get_dias_mes(cliente_id, mk)
         except Exception:
-            tops = []
-        def _sig(o):
-            try:
-                return str(o.get("ref_id") or "") or (str(o.get("tipo", "")) + "|" + str(float(o.get("valor", 0) or 0)) + "|" + str(o.get("categoria", "")) + "|" + str(o.get("descricao", "")) + "|" + str(o.get("timestamp_criacao", "")))
-            except Exception:
-                return str(o.get("ref_id") or "")
-        for it in items:
-            o = it.to_dict() or {}
-            k = _sig(o)
-            if idx.get(k):
-                continue
-            idx[k] = 1
-            tp_raw = str(o.get("tipo", "")).strip().lower()
-            cat = str(o.get("categoria", "outros") or "outros").strip().lower()
-            val = float(o.get("valor", 0) or 0)
-            if tp_raw in ("estorno",):
-                total_estorno += abs(val)
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_estorno"] += abs(val)
-                m["categorias_estorno"][cat] = float(m["categorias_estorno"].get(cat, 0.0) or 0.0) + abs(val)
-                day_cat_est[cat] = float(day_cat_est.get(cat, 0.0) or 0.0) + abs(val)
-            elif bool(o.get("estornado", False)):
-                pass
-            elif tp_raw in ("1", "receita", "entrada"):
-                total_entrada += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_entrada"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_entrada"][cat] = float(m["categorias_entrada"].get(cat, 0.0) or 0.0) + val
-                day_cat_inc[cat] = float(day_cat_inc.get(cat, 0.0) or 0.0) + val
-            elif tp_raw in ("0", "despesa", "saida"):
-                total_saida += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_saida"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_saida"][cat] = float(m["categorias_saida"].get(cat, 0.0) or 0.0) + val
-                day_cat_exp[cat] = float(day_cat_exp.get(cat, 0.0) or 0.0) + val
-            elif tp_raw in ("ajuste",):
-                total_ajuste += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_ajuste"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_ajuste"][cat] = float(m["categorias_ajuste"].get(cat, 0.0) or 0.0) + val
-                day_cat_adj[cat] = float(day_cat_adj.get(cat, 0.0) or 0.0) + val
-        for it in tops:
-            o = it.to_dict() or {}
-            k = _sig(o)
-            if idx.get(k):
+            continue
+        for dk, dd in dias_mes.items():
+            if not dd:
                 continue
-            idx[k] = 1
-            tp_raw = str(o.get("tipo", "")).strip().lower()
-            cat = str(o.get("categoria", "outros") or "outros").strip().lower()
-            val = float(o.get("valor", 0) or 0)
-            if tp_raw in ("estorno",):
-                total_estorno += abs(val)
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_estorno"] += abs(val)
-                m["categorias_estorno"][cat] = float(m["categorias_estorno"].get(cat, 0.0) or 0.0) + abs(val)
-                day_cat_est[cat] = float(day_cat_est.get(cat, 0.0) or 0.0) + abs(val)
-            elif bool(o.get("estornado", False)):
-                pass
-            elif tp_raw in ("1", "receita", "entrada"):
-                total_entrada += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_entrada"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_entrada"][cat] = float(m["categorias_entrada"].get(cat, 0.0) or 0.0) + val
-                day_cat_inc[cat] = float(day_cat_inc.get(cat, 0.0) or 0.0) + val
-            elif tp_raw in ("0", "despesa", "saida"):
-                total_saida += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_saida"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_saida"][cat] = float(m["categorias_saida"].get(cat, 0.0) or 0.0) + val
-                day_cat_exp[cat] = float(day_cat_exp.get(cat, 0.0) or 0.0) + val
-            elif tp_raw in ("ajuste",):
-                total_ajuste += val
-                qtd += 1
-                qtd_validas += 1
-                mk = dr[:7]
-                m = month_agg.setdefault(mk, {
-                    "total_entrada": 0.0,
-                    "total_saida": 0.0,
-                    "total_ajuste": 0.0,
-                    "total_estorno": 0.0,
-                    "quantidade_transacoes": 0,
-                    "quantidade_transacoes_validas": 0,
-                    "categorias_entrada": {},
-                    "categorias_saida": {},
-                    "categorias_estorno": {},
-                    "categorias_ajuste": {},
-                })
-                m["total_ajuste"] += val
-                m["quantidade_transacoes"] += 1
-                m["quantidade_transacoes_validas"] += 1
-                m["categorias_ajuste"][cat] = float(m["categorias_ajuste"].get(cat, 0.0) or 0.0) + val
-                day_cat_adj[cat] = float(day_cat_adj.get(cat, 0.0) or 0.0) + val
-        saldo_dia = total_entrada - total_saida + total_ajuste
+            d_acc = _acumulado_de_doc(dd, "dia")
+            _somar_acumulado(a, d_acc, d_acc["quantidade_transacoes"], d_acc["quantidade_transacoes_validas"], d_acc["categorias"])
+            wk = week_key(dk)
+            if wk:
+                semanas.add(wk)
+        w.set(root.collection("meses").document(mk), _payload_mes(mk, a), merge=True)
+    w.flush()
+    out = {"cliente_id": str(cliente_id), "dias_reparados": len(dias), "meses_reparados": len(meses), "superiores": False}
+    def _fim():
+        # versao só sobe depois que todos os agregados foram gravados: uma ETag montada no meio do
+        # reparo não fica valendo para o resultado final
         try:
-            try:
-                ano_d, mes_d, dia_d = dr.split("-")
-            except:
-                ano_d = None
-                mes_d = None
-                dia_d = None
-            root.collection("dias").document(dr).set({
-                "ano": (int(ano_d) if ano_d is not None else None),
-                "mes": (int(mes_d) if mes_d is not None else None),
-                "dia": (int(dia_d) if dia_d is not None else None),
-                "data": dr,
-                "quantidade_transacoes": qtd,
-                "quantidade_transacoes_validas": qtd_validas,
-                "categorias": {
-                    "entrada": dict({k: float(v or 0.0) for k, v in day_cat_inc.items()}),
-                    "saida": dict({k: float(v or 0.0) for k, v in day_cat_exp.items()}),
-                    "estorno": dict({k: float(v or 0.0) for k, v in day_cat_est.items()}),
-                    "ajuste": dict({k: float(v or 0.0) for k, v in day_cat_adj.items()}),
-                },
-                "totais_por_tipo": {
-                    "entrada": float(sum(day_cat_inc.values()) or total_entrada),
-                    "saida": float(sum(day_cat_exp.values()) or total_saida),
-                    "estorno": float(sum(day_cat_est.values()) or total_estorno),
-                    "ajuste": float(sum(day_cat_adj.values()) or total_ajuste),
-                },
-                "totais_dia": {
-                    "total_entrada": total_entrada,
-                    "total_saida": total_saida,
-                    "total_estorno": total_estorno,
-                    "total_ajuste": total_ajuste,
-                    "saldo_dia": float(total_entrada - total_saida + total_estorno + total_ajuste),
-                },
-                "atualizado_em": firestore.SERVER_TIMESTAMP,
-            }, merge=True)
+            root.set({"versao": firestore.Increment(1)}, merge=True)
         except Exception:
             pass
-        days_processed += 1
-    months_processed = 0
-    for mk, m in month_agg.items():
-        tot_entrada = float(m.get("total_entrada", 0.0) or 0.0)
-        tot_saida = float(m.get("total_saida", 0.0) or 0.0)
-        tot_ajuste = float(m.get("total_ajuste", 0.0) or 0.0)
-        tot_estorno = float(m.get("total_estorno", 0.0) or 0.0)
-        saldo_mes = tot_entrada - tot_saida + tot_estorno + tot_ajuste
+        return out
+    try:
+        root_doc = root.get().to_dict() or {}
+    except Exception:
+        root_doc = {}
+    if not meses or agregados_versao(root_doc) < 2:
+        return _fim()
+    try:
+        todos = sorted(((d.id, d.to_dict() or {}) for d in root.collection("meses").stream()), key=lambda x: x[0])
+    except Exception:
+        return _fim()
+    escritas = []
+    anos = {}
+    geral = _novo_acumulado()
+    saldo_anterior = 0.0
+    for mk, mo in todos:
+        m_acc = _acumulado_de_doc(mo, "mes")
+        if mk[:4] in set(x[:4] for x in meses):
+            _somar_acumulado(anos.setdefault(mk[:4], _novo_acumulado()), m_acc, m_acc["quantidade_transacoes"], m_acc["quantidade_transacoes_validas"], m_acc["categorias"])
+        _somar_acumulado(geral, m_acc, m_acc["quantidade_transacoes"], m_acc["quantidade_transacoes_validas"], {})
+        if agregados_versao(root_doc) >= 3 and mo.get("saldo_anterior") != saldo_anterior:
+            escritas.append((root.collection("meses").document(mk), {"saldo_anterior": float(saldo_anterior)}, True))
+        saldo_anterior += float(_saldo_mes_doc(mo))
+    for ano_k, a in anos.items():
+        escritas.append((root.collection("anos").document(ano_k), {"ano": int(ano_k), **_payload_acumulado("ano", a)}, False))
+    for wk in sorted(semanas):
         try:
-            ano_i = int(mk.split("-")[0])
-            mes_i = int(mk.split("-")[1])
-        except:
-            ano_i = None
-            mes_i = None
+            ano_w, num_w = wk.split("-W")
+            seg = datetime.strptime(f"{ano_w}-W{num_w}-1", "%G-W%V-%u")
+            a = _novo_acumulado()
+            for dd in get_dias_range(cliente_id, seg.strftime("%Y-%m-%d"), (seg + timedelta(days=7)).strftime("%Y-%m-%d")).values():
+                if dd:
+                    d_acc = _acumulado_de_doc(dd, "dia")
+                    _somar_acumulado(a, d_acc, d_acc["quantidade_transacoes"], d_acc["quantidade_transacoes_validas"], d_acc["categorias"])
+            escritas.append((root.collection("semanas").document(wk), {"semana": wk, **_payload_acumulado("semana", a)}, False))
+        except Exception:
+            pass
+    escritas.append((root, _payload_acumulado("geral", geral, com_categorias=False), True))
+    _lotes, falhas = _gravar_em_lotes(db, escritas)
+    out["superiores"] = falhas == 0
+    return _fim()
+_BATCH_MAX_OPS = LIMITE_OPS
+def _gravar_em_lotes(db, escritas, tamanho=_BATCH_MAX_OPS):
+    # escritas: [(ref, payload, merge)] sem Increment, então o commit ambíguo também pode ser repetido
+    w = BatchWriter(db, tamanho=tamanho, idempotente=True)
+    for ref, payload, merge in escritas:
+        w.set(ref, payload, merge=merge)
+    w.flush()
+    return w.lotes, w.falhas
+def _items_por_dia_scan(root):
+    # Uma única consulta collection group restrita ao intervalo de paths clientes/{id}/transacoes/*
+    db = get_db()
+    fp = getattr(getattr(firestore, "FieldPath", None), "document_id", None)
+    campo = fp() if fp else "__name__"
+    col = root.collection("transacoes")
+    q = db.collection_group("items").where(campo, ">=", col.document("0")).where(campo, "<", col.document("\uf8ff"))
+    por_dia = {}
+    for it in q.stream():
+        dr = it.reference.parent.parent.id
+        por_dia.setdefault(dr, []).append(it.to_dict() or {})
+    return por_dia
+def _items_por_dia_paralelo(root, day_keys):
+    from concurrent.futures import ThreadPoolExecutor
+    def _ler(dr):
         try:
-            doc = root.collection("meses").document(mk)
-            payload = {
-                "ano": ano_i,
-                "mes": mes_i,
-                "quantidade_transacoes": int(m.get("quantidade_transacoes", 0) or 0),
-                "quantidade_transacoes_validas": int(m.get("quantidade_transacoes_validas", 0) or 0),
-                "categorias": {
-                    "entrada": dict(m.get("categorias_entrada", {}) or {}),
-                    "saida": dict(m.get("categorias_saida", {}) or {}),
-                    "estorno": dict(m.get("categorias_estorno", {}) or {}),
-                    "ajuste": dict(m.get("categorias_ajuste", {}) or {}),
-                },
-                "totais_por_tipo": {
-                    "entrada": float(sum((m.get("categorias_entrada", {}) or {}).values()) or tot_entrada),
-                    "saida": float(sum((m.get("categorias_saida", {}) or {}).values()) or tot_saida),
-                    "estorno": float(sum((m.get("categorias_estorno", {}) or {}).values()) or tot_estorno),
-                    "ajuste": float(sum((m.get("categorias_ajuste", {}) or {}).values()) or tot_ajuste),
-                },
-                "totais_mes": {
-                    "total_entrada": tot_entrada,
-                    "total_saida": tot_saida,
-                    "total_estorno": tot_estorno,
-                    "total_ajuste": tot_ajuste,
-                    "saldo_mes": float(saldo_mes or 0.0),
-                },
-                "atualizado_em": firestore.SERVER_TIMESTAMP,
-            }
-            doc.set(payload, merge=True)
+            return dr, [it.to_dict() or {} for it in root.collection("transacoes").document(dr).collection("items").stream()]
+        except Exception:
+            return dr, []
+    if not day_keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(_RANGE_READ_WORKERS, len(day_keys)))) as ex:
+        return {dr: docs for dr, docs in ex.map(_com_metricas(_ler), day_keys) if docs}
+def reparar_dias_sujos(cliente_id, dias=(), meses=(), root_doc=None):
+    # Refaz os dias pedidos e todos os de dias_sujos (com meses/níveis superiores) e retira do conjunto
+    # os que não foram escritos durante o reparo. Usado pela fila de reparos e pelo incremental.
+    root = _cliente_root(cliente_id)
+    if root_doc is None:
+        try:
+            root_doc = root.get().to_dict() or {}
+        except Exception:
+            root_doc = {}
+    # marcas lidas antes de recompute_cliente_dias ler os items
+    marcas = marcas_dias_sujos(root_doc)
+    todos = sorted(set(str(d)[:10] for d in (dias or []) if d) | set(marcas))
+    out = dict(recompute_cliente_dias(cliente_id, dias=todos, meses=list(meses or [])) or {}) if (todos or meses) else {}
+    out["dias_ainda_sujos"] = limpar_dias_sujos(root, marcas)
+    return out
+def recompute_cliente_incremental(cliente_id, root_doc=None):
+    # Refaz só os dias marcados em dias_sujos (e seus meses/níveis superiores) e os retira do conjunto
+    # se não foram escritos durante o reparo. Clientes sem agregados na versão atual passam pela
+    # reconstrução completa.
+    root = _cliente_root(cliente_id)
+    if root_doc is None:
+        try:
+            root_doc = root.get().to_dict() or {}
+        except Exception:
+            root_doc = {}
+    dias = sorted(set(str(d)[:10] for d in (root_doc.get("dias_sujos") or []) if d))
+    if agregados_versao(root_doc) < AGREGADOS_VERSAO:
+        res = recompute_cliente_aggregates(cliente_id)
+        res["modo"] = "completo"
+        return res
+    out = {"cliente_id": str(cliente_id), "modo": "incremental", "dias_sujos": len(dias)}
+    if not dias:
+        return out
+    out.update(reparar_dias_sujos(cliente_id, root_doc=root_doc))
+    return out
+def recompute_cliente_aggregates(cliente_id: str, substituir: bool = False):
+    # Reconstrução em passada única: lê todos os items do cliente (collection group, ou dias em paralelo
+    # como fallback), agrega em memória e grava dias/meses/anos/semanas em lotes.
+    # substituir=True (rebuild): cada doc é trocado inteiro por um da nova `geracao` (sem merge, então
+    # categorias velhas somem), os docs que não pertencem a ela são apagados depois e o doc do cliente
+    # aponta para a geração nova por último. A troca não é atômica: durante a gravação um leitor pode
+    # ver docs das duas gerações. Escritas normais feitas durante o rebuild marcam dias_sujos; esses
+    # dias (e docs com atualizado_em depois do início) não são apagados e vão para a fila de reparos.
+    db = get_db()
+    root = _cliente_root(cliente_id)
+    t0 = time.time()
+    inicio = None
+    if substituir:
+        try:
+            # hora do servidor, comparável com os atualizado_em das escritas concorrentes
+            root.set({"agregados_rebuild_em": firestore.SERVER_TIMESTAMP}, merge=True)
+        except Exception:
+            pass
+    try:
+        root_doc = root.get().to_dict() or {}
+        sujos = marcas_dias_sujos(root_doc)
+        inicio = root_doc.get("agregados_rebuild_em") if substituir else None
+    except Exception:
+        sujos = {}
+    day_keys = set()
+    try:
+        refs = list(root.collection("dias").list_documents())
+    except Exception:
+        try:
+            refs = list(root.collection("dias").stream())
+        except Exception:
+            refs = []
+    for r in refs:
+        di = str(r.id or "").strip()
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", di or ""):
+            day_keys.add(di)
+    modo_leitura = "collection_group"
+    try:
+        items_por_dia = _items_por_dia_scan(root)
+    except Exception:
+        modo_leitura = "por_dia"
+        items_por_dia = _items_por_dia_paralelo(root, sorted(day_keys))
+    legados_por_dia = {}
+    if not cliente_migrado(cliente_id):
+        try:
+            for d in root.collection("transacoes").stream():
+                o = d.to_dict() or {}
+                dr = str(o.get("data_referencia") or "").strip()[:10]
+                if re.fullmatch(r"\d{4}-\d{2}-\d{2}", dr or ""):
+                    legados_por_dia.setdefault(dr, []).append(o)
         except Exception:
             pass
-        months_processed += 1
+    day_keys.update(k for k in items_por_dia.keys() if re.fullmatch(r"\d{4}-\d{2}-\d{2}", k or ""))
+    day_keys.update(legados_por_dia.keys())
+    t1 = time.time()
+    month_agg = {}
+    year_agg = {}
+    week_agg = {}
+    geral_agg = {}
+    escritas = []
+    for dr in sorted(day_keys):
+        a = _acumular_dia(_dedup_transacoes([items_por_dia.get(dr, []), legados_por_dia.get(dr, [])]))
+        escritas.append((root.collection("dias").document(dr), _payload_dia(dr, a), True))
+        for agg, chave in ((month_agg, dr[:7]), (year_agg, dr[:4]), (week_agg, week_key(dr)), (geral_agg, "geral")):
+            if chave:
+                _somar_acumulado(agg.setdefault(chave, _novo_acumulado()), a, a["quantidade_transacoes"], a["quantidade_transacoes_validas"], a["categorias"])
+    saldo_anterior = 0.0
+    for mk in sorted(month_agg.keys()):
+        m = month_agg[mk]
+        escritas.append((root.collection("meses").document(mk), {**_payload_mes(mk, m), "saldo_anterior": float(saldo_anterior)}, True))
+        saldo_anterior += float(m["total_entrada"] - m["total_saida"] + m["total_estorno"] + m["total_ajuste"])
+    for ano_k, a in year_agg.items():
+        escritas.append((root.collection("anos").document(ano_k), {"ano": int(ano_k), **_payload_acumulado("ano", a)}, False))
+    for wk, a in week_agg.items():
+        escritas.append((root.collection("semanas").document(wk), {"semana": wk, **_payload_acumulado("semana", a)}, False))
+    geracao = None
+    varridos = 0
+    if substituir:
+        geracao = _now_sp().strftime("%Y%m%dT%H%M%S") + "-" + os.urandom(3).hex()
+        try:
+            meses_atuais = {m.id: (m.to_dict() or {}) for m in root.collection("meses").stream()}
+        except Exception:
+            meses_atuais = {}
+        escritas = [(ref, _payload_geracao(ref, payload, geracao, meses_atuais), False) for ref, payload, _merge in escritas]
+    t2 = time.time()
+    lotes, falhas = _gravar_em_lotes(db, escritas)
+    novos_sujos = []
+    if substituir:
+        # dias novos ou com marca diferente da lida no início foram escritos durante o rebuild
+        try:
+            atuais = marcas_dias_sujos(root.get().to_dict() or {})
+            novos_sujos = sorted(d for d, m in atuais.items() if d not in sujos or sujos[d] != m)
+        except Exception:
+            novos_sujos = []
+    if substituir and falhas == 0:
+        varridos = _varrer_geracao(db, root, geracao, {_ref_path(ref) for ref, _p, _m in escritas}, inicio=inicio, dias_protegidos=novos_sujos)
+    if novos_sujos:
+        # o rebuild pode ter sobrescrito incrementos feitos no meio: esses dias são refeitos
+        try:
+            from app.services.repair_queue import agendar_reparo  # lazy import
+            for dr in novos_sujos:
+                agendar_reparo(cliente_id, "dia", dr)
+        except Exception:
+            pass
+    # Doc do cliente por último: agregados_versao só sobe depois que os níveis abaixo foram gravados
+    try:
+        payload_root = {
+            **_payload_acumulado("geral", geral_agg.get("geral") or _novo_acumulado(), com_categorias=False),
+            "agregados_versao": AGREGADOS_VERSAO,
+            "versao": firestore.Increment(1),
+        }
+        if substituir and falhas == 0:
+            payload_root["agregados_geracao"] = geracao
+            payload_root["agregados_geracao_em"] = firestore.SERVER_TIMESTAMP
+        root.set(payload_root, merge=True)
+    except Exception:
+        falhas += 1
+    if sujos and falhas == 0:
+        # só sai de dias_sujos o dia que ninguém escreveu depois da leitura inicial
+        limpar_dias_sujos(root, sujos)
+    t3 = time.time()
     return {
         "cliente_id": str(cliente_id),
-        "dias_processados": days_processed,
-        "meses_processados": months_processed,
+        "dias_processados": len(day_keys),
+        "meses_processados": len(month_agg),
+        "anos_processados": len(year_agg),
+        "semanas_processadas": len(week_agg),
+        "transacoes_lidas": sum(len(v) for v in items_por_dia.values()) + sum(len(v) for v in legados_por_dia.values()),
+        "leitura": modo_leitura,
+        "lotes": lotes,
+        "falhas_escrita": falhas,
+        "geracao": geracao if (substituir and falhas == 0) else None,
+        "docs_antigos_removidos": varridos,
+        "dias_escritos_durante": novos_sujos,
+        "tempo_ms": {
+            "leitura": round((t1 - t0) * 1000, 2),
+            "agregacao": round((t2 - t1) * 1000, 2),
+            "escrita": round((t3 - t2) * 1000, 2),
+            "total": round((t3 - t0) * 1000, 2),
+        },
     }
+def _payload_geracao(ref, payload, geracao, meses_atuais):
+    out = {**payload, "geracao": geracao}
+    # o índice do extrato não depende dos agregados: mantém a marca para não remontá-lo à toa
+    p = _ref_path(ref)
+    if "/meses/" in p and (meses_atuais.get(p.rsplit("/", 1)[-1]) or {}).get("extrato_indexado"):
+        out["extrato_indexado"] = True
+    return out
+def _depois_de(ts, inicio):
+    try:
+        return ts is not None and inicio is not None and ts >= inicio
+    except Exception:
+        return True
+def _varrer_geracao(db, root, geracao, gravados, inicio=None, dias_protegidos=()):
+    # Apaga dias/meses/anos/semanas que ficaram fora da geração nova (e o índice do extrato dos meses
+    # removidos). Poupa o que foi escrito depois de `inicio` e os níveis dos dias marcados sujos no meio.
+    protegidos = set()
+    for dr in dias_protegidos or []:
+        dr = str(dr)
+        protegidos.update({("dias", dr), ("meses", dr[:7]), ("anos", dr[:4]), ("semanas", week_key(dr))})
+    w = BatchWriter(db, idempotente=True)
+    n = 0
+    for col in ("dias", "meses", "anos", "semanas"):
+        try:
+            docs = [(d.reference, d.to_dict() or {}) for d in root.collection(col).stream()]
+        except Exception:
+            try:
+                docs = [(r, {}) for r in root.collection(col).list_documents()]
+            except Exception:
+                docs = []
+        for r, o in docs:
+            if _ref_path(r) in gravados or (col, r.id) in protegidos:
+                continue
+            if _depois_de(o.get("atualizado_em"), inicio):
+                continue
+            if col == "meses":
+                try:
+                    for e in root.collection("meses").document(r.id).collection("extrato").list_documents():
+                        w.delete(e)
+                except Exception:
+                    pass
+            w.delete(root.collection(col).document(r.id))
+            n += 1
+    w.flush()
+    return n - sum(1 for p in w.falhas_refs if "/extrato/" not in p)
 def purge_cliente_aggregates(cliente_id: str, purge_days: bool = True, purge_months: bool = True):
     db = get_db()
     root = _cliente_root(cliente_id)
     deleted_days = 0
     deleted_months = 0
+    w = BatchWriter(db, idempotente=True)
     try:
         if purge_days:
             try:
-                days = list(root.collection("dias").stream())
+                days = list(root.collection("dias").list_documents())
             except Exception:
-                days = []
-            for d in days:
                 try:
-                    root.collection("dias").document(d.id).delete()
-                    deleted_days += 1
+                    days = list(root.collection("dias").stream())
                 except Exception:
-                    pass
+                    days = []
+            for d in days:
+                w.delete(root.collection("dias").document(d.id))
+                deleted_days += 1
     except Exception:
         pass
     try:
         if purge_months:
             try:
-                months = list(root.collection("meses").stream())
+                months = list(root.collection("meses").list_documents())
             except Exception:
-                months = []
+                try:
+                    months = list(root.collection("meses").stream())
+                except Exception:
+                    months = []
             for m in months:
+                # o doc do mês não leva a subcoleção junto: o índice do extrato sai no mesmo lote
                 try:
-                    root.collection("meses").document(m.id).delete()
-                    deleted_months += 1
+                    for e in root.collection("meses").document(m.id).collection("extrato").list_documents():
+                        w.delete(e)
                 except Exception:
                     pass
+                w.delete(root.collection("meses").document(m.id))
+                deleted_months += 1
     except Exception:
         pass
+    w.flush()
+    falhos = set(w.falhas_refs)
+    deleted_days -= sum(1 for p in falhos if "/dias/" in p)
+    deleted_months -= sum(1 for p in falhos if "/meses/" in p and "/extrato/" not in p)
     return {
         "cliente_id": str(cliente_id),
         "dias_deletados": deleted_days,
         "meses_deletados": deleted_months,
     }
-def migrate_all_clientes(delete_original: bool = False, recompute: bool = True):
+try:
+    _MIGRACAO_WORKERS = int(os.getenv("MIGRACAO_WORKERS", "4") or 4)
+except Exception:
+    _MIGRACAO_WORKERS = 4
+_JOBS_COLLECTION = "jobs"
+def _listar_clientes_ids():
     db = get_db()
-    results = []
     try:
-        clientes = list(db.collection("clientes").stream())
+        # list_documents também devolve clientes sem doc raiz (só subcoleções)
+        return sorted(r.id for r in db.collection("clientes").list_documents())
+    except Exception:
+        return sorted(c.id for c in db.collection("clientes").stream())
+def _job_ref(job_id):
+    return get_db().collection(_JOBS_COLLECTION).document(str(job_id))
+def _migrar_um_cliente(cid, delete_original, recompute):
+    res_mig = migrate_cliente_transacoes_to_nested(cid, delete_original=delete_original)
+    res_rec = recompute_cliente_aggregates(cid) if recompute else None
+    out = {"migracao": res_mig}
+    if res_rec is not None:
+        out["recompute"] = {k: res_rec.get(k) for k in ("dias_processados", "meses_processados", "falhas_escrita", "tempo_ms")}
+    return out
+def migrate_all_clientes(delete_original: bool = False, recompute: bool = True, workers: int = None, job_id: str = None, progresso=None):
+    """Migra (e recomputa) todos os clientes num pool de threads, com checkpoint por cliente em jobs/{job_id}.
+
+    Rodar de novo com o mesmo job_id retoma: clientes já com checkpoint 'ok' são pulados.
+    progresso(evento) é chamado a cada cliente concluído.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    job_id = str(job_id or _now_sp().strftime("migracao-%Y%m%d-%H%M%S"))
+    workers = max(1, int(workers or _MIGRACAO_WORKERS))
+    job = _job_ref(job_id)
+    clientes = _listar_clientes_ids()
+    feitos = set()
+    try:
+        for d in job.collection("clientes").stream():
+            if (d.to_dict() or {}).get("status") == "ok":
+                feitos.add(d.id)
     except Exception:
-        clientes = []
-    for c in clientes:
-        cid = c.id
-        res_mig = migrate_cliente_transacoes_to_nested(cid, delete_original=delete_original)
-        res_rec = None
-        if recompute:
+        pass
+    pendentes = [c for c in clientes if c not in feitos]
+    try:
+        job.set({
+            "tipo": "migracao",
+            "status": "executando",
+            "delete_original": bool(delete_original),
+            "recompute": bool(recompute),
+            "workers": workers,
+            "total": len(clientes),
+            "retomados": len(feitos),
+            "iniciado_em": _now_sp().isoformat(),
+            "atualizado_em": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception:
+        pass
+    cont = {"ok": len(feitos), "erro": 0}
+    erros = []
+    lock = threading.Lock()
+    def _um(cid):
+        try:
+            return cid, _migrar_um_cliente(cid, delete_original, recompute), None
+        except Exception as e:
+            return cid, None, str(e)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futs = [ex.submit(_um, cid) for cid in pendentes]
+        for fut in as_completed(futs):
+            cid, res, erro = fut.result()
+            status = "ok" if erro is None and int(((res or {}).get("migracao") or {}).get("errors", 0) or 0) == 0 else "erro"
+            with lock:
+                cont[status] += 1
+                if status == "erro" and len(erros) < 50:
+                    erros.append({"cliente_id": cid, "erro": erro or "falhas na migração"})
+                processados = cont["ok"] + cont["erro"]
             try:
-                res_rec = recompute_cliente_aggregates(cid)
+                job.collection("clientes").document(cid).set({"status": status, "resultado": res, "erro": erro, "em": _now_sp().isoformat()})
+                job.set({"processados": processados, "ok": cont["ok"], "erros": cont["erro"], "ultimo_cliente": cid, "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
             except Exception:
-                res_rec = None
-        results.append({"migracao": res_mig, "recompute": res_rec})
+                pass
+            if progresso is not None:
+                try:
+                    progresso({"job_id": job_id, "cliente_id": cid, "status": status, "processados": processados, "total": len(clientes), "erro": erro})
+                except Exception:
+                    pass
+    final = "concluido" if cont["erro"] == 0 else "concluido_com_erros"
+    try:
+        job.set({"status": final, "finalizado_em": _now_sp().isoformat(), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+    except Exception:
+        pass
     return {
         "sucesso": True,
-        "clientes_processados": len(results),
-        "detalhes": results,
+        "job_id": job_id,
+        "status": final,
+        "clientes_total": len(clientes),
+        "clientes_processados": cont["ok"] + cont["erro"],
+        "clientes_retomados": len(feitos),
+        "ok": cont["ok"],
+        "erros": cont["erro"],
+        "detalhes_erros": erros,
     }
+_JOBS_ATIVOS = {}
+def iniciar_migracao_em_segundo_plano(delete_original=False, recompute=True, workers=None, job_id=None):
+    job_id = str(job_id or _now_sp().strftime("migracao-%Y%m%d-%H%M%S"))
+    t = _JOBS_ATIVOS.get(job_id)
+    if t is not None and t.is_alive():
+        return job_id, False
+    def _run():
+        try:
+            migrate_all_clientes(delete_original=delete_original, recompute=recompute, workers=workers, job_id=job_id)
+        except Exception as e:
+            try:
+                _job_ref(job_id).set({"status": "falhou", "erro": str(e), "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+            except Exception:
+                pass
+    t = threading.Thread(target=_run, name=f"job-{job_id}", daemon=True)
+    _JOBS_ATIVOS[job_id] = t
+    t.start()
+    return job_id, True
+def status_job(job_id):
+    snap = _job_ref(job_id).get()
+    if not snap.exists:
+        return None
+    o = snap.to_dict() or {}
+    t = _JOBS_ATIVOS.get(str(job_id))
+    o["em_execucao_neste_processo"] = bool(t is not None and t.is_alive())
+    o.pop("atualizado_em", None)
+    return o
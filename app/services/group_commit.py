@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+
+# Group commit das escritas de salvar_transacao_cliente.
+# LoteCoalescido grava as operações em memória e junta os set(merge=True) do mesmo doc num só
+# (Increment somados, ArrayUnion unidos, o resto "último vence"). Com SALVAR_GROUP_COMMIT_MS > 0,
+# escritas simultâneas do mesmo cliente esperam essa janela e saem num único commit.
+try:
+    _JANELA_MS = float(os.getenv("SALVAR_GROUP_COMMIT_MS", "0") or 0)
+except Exception:
+    _JANELA_MS = 0.0
+_MAX_OPS = 450  # folga abaixo do limite de 500 escritas por lote do Firestore
+
+_lock = threading.Lock()
+_abertos = {}
+_stats = {
+    "commits": 0,
+    "grupos": 0,
+    "agrupados": 0,
+    "coalescidas": 0,
+    "falhas": 0,
+}
+_INCOMPATIVEL = object()
+
+def _firestore():
+    from app.services import database  # lazy import (database importa este módulo)
+    return database.firestore
+
+def _path(ref):
+    p = getattr(ref, "path", None) or getattr(ref, "_path", None)
+    return str(p or getattr(ref, "id", "") or id(ref))
+
+def _incremento(v):
+    if type(v).__name__ in ("Increment", "_FakeIncr"):
+        try:
+            val = v.value
+            return val if isinstance(val, (int, float)) else float(val)
+        except Exception:
+            return None
+    return None
+
+def _combinar_valor(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        c = _combinar(a, b)
+        return _INCOMPATIVEL if c is None else c
+    nb = _incremento(b)
+    if nb is not None:
+        na = _incremento(a)
+        if na is not None:
+            return _firestore().Increment(na + nb)
+        if isinstance(a, (int, float)) and not isinstance(a, bool):
+            return a + nb
+        return _INCOMPATIVEL
+    if type(b).__name__ == "ArrayUnion" and type(a).__name__ == "ArrayUnion":
+        va = list(getattr(a, "values", []) or [])
+        return _firestore().ArrayUnion(va + [x for x in (getattr(b, "values", []) or []) if x not in va])
+    if type(b).__name__ in ("ArrayUnion", "ArrayRemove", "_FakeArrayOp"):
+        return _INCOMPATIVEL
+    return b
+
+def _combinar(a, b):
+    out = dict(a)
+    for k, v in b.items():
+        if k not in out:
+            out[k] = v
+            continue
+        c = _combinar_valor(out[k], v)
+        if c is _INCOMPATIVEL:
+            return None
+        out[k] = c
+    return out
+
+class LoteCoalescido:
+    """Mesma interface de escrita de um WriteBatch; commit(db) monta e envia o lote real."""
+    def __init__(self):
+        self._ops = []
+        self._merge = {}
+        self.coalescidas = 0
+
+    def set(self, ref, dados, merge=False):
+        p = _path(ref)
+        if merge is True:
+            i = self._merge.get(p)
+            if i is not None:
+                c = _combinar(self._ops[i][2][0], dados or {})
+                if c is not None:
+                    self._ops[i][2] = (c,)
+                    self.coalescidas += 1
+                    return self
+            self._merge[p] = len(self._ops)
+            self._ops.append(["set", ref, (dict(dados or {}),), {"merge": True}])
+            return self
+        # escrita não mesclável no doc: merges seguintes começam uma entrada nova
+        self._merge.pop(p, None)
+        self._ops.append(["set", ref, (dados,), {"merge": merge} if merge else {}])
+        return self
+
+    def _direta(self, nome, ref, *a, **k):
+        self._merge.pop(_path(ref), None)
+        self._ops.append([nome, ref, a, k])
+        return self
+
+    def update(self, ref, *a, **k):
+        return self._direta("update", ref, *a, **k)
+
+    def delete(self, ref, *a, **k):
+        return self._direta("delete", ref, *a, **k)
+
+    def create(self, ref, *a, **k):
+        return self._direta("create", ref, *a, **k)
+
+    def tamanho(self):
+        return len(self._ops)
+
+    def absorver(self, outro):
+        for nome, ref, a, k in outro._ops:
+            if nome == "set":
+                self.set(ref, a[0], **k)
+            else:
+                self._direta(nome, ref, *a, **k)
+        self.coalescidas += outro.coalescidas
+
+    def reproduzir(self, destino):
+        # repete as operações em outro lote (WriteBatch, BatchWriter)
+        for nome, ref, a, k in self._ops:
+            getattr(destino, nome)(ref, *a, **k)
+        return destino
+
+    def commit(self, db):
+        if not self._ops:
+            return None
+        return self.reproduzir(db.batch()).commit()
+
+class _Grupo:
+    def __init__(self, lote):
+        self.lote = lote
+        self.evento = threading.Event()
+        self.erro = None
+
+def commit_agrupado(chave, lote, db):
+    """Commita `lote`, possivelmente junto com escritas simultâneas da mesma chave (cliente).
+
+    Todos do grupo recebem a mesma exceção se o commit falhar; cada um decide pelo tipo do erro
+    (batch_writer.nao_gravou) se pode reenviar as próprias escritas.
+    """
+    if _JANELA_MS <= 0:
+        with _lock:
+            _stats["commits"] += 1
+            _stats["coalescidas"] += lote.coalescidas
+        try:
+            return lote.commit(db)
+        except Exception:
+            with _lock:
+                _stats["falhas"] += 1
+            raise
+    with _lock:
+        gr = _abertos.get(chave)
+        if gr is not None and gr.lote.tamanho() + lote.tamanho() <= _MAX_OPS:
+            gr.lote.absorver(lote)
+            _stats["agrupados"] += 1
+            lider = False
+        else:
+            # o grupo tem lote próprio: o do líder fica intacto para o fallback dele
+            gr = _Grupo(LoteCoalescido())
+            gr.lote.absorver(lote)
+            _abertos[chave] = gr
+            _stats["grupos"] += 1
+            lider = True
+    if not lider:
+        gr.evento.wait()
+        if gr.erro is not None:
+            raise gr.erro
+        return None
+    time.sleep(_JANELA_MS / 1000.0)
+    with _lock:
+        if _abertos.get(chave) is gr:
+            _abertos.pop(chave, None)
+        _stats["commits"] += 1
+        _stats["coalescidas"] += gr.lote.coalescidas
+    try:
+        return gr.lote.commit(db)
+    except Exception as e:
+        gr.erro = e
+        with _lock:
+            _stats["falhas"] += 1
+        raise
+    finally:
+        gr.evento.set()
+
+def status_group_commit():
+    with _lock:
+        out = dict(_stats)
+        out["abertos"] = len(_abertos)
+    out["janela_ms"] = _JANELA_MS
+    return out
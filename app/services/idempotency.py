@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+from datetime import timedelta
+
+from app.services.database import _cliente_root, _now_sp
+
+# Chaves de idempotência das rotas de extração: clientes/{id}/idempotencia/{hash(rota|chave)}.
+# A primeira requisição reivindica a chave com create() (falha se já existir) e, ao terminar com
+# sucesso, grava a resposta; repetições dentro do TTL recebem a mesma resposta sem extrair nem gravar.
+# `expira_em` é um timestamp para poder ligar a política de TTL do Firestore no grupo "idempotencia".
+try:
+    _TTL = float(os.getenv("IDEMPOTENCIA_TTL", "3600") or 3600)
+except Exception:
+    _TTL = 3600.0
+try:
+    _LEASE = float(os.getenv("IDEMPOTENCIA_LEASE", "120") or 120)
+except Exception:
+    _LEASE = 120.0
+_COLECAO = "idempotencia"
+
+def _ref(cliente_id, rota, chave):
+    h = hashlib.sha1(f"{rota}|{chave}".encode("utf-8")).hexdigest()[:32]
+    return _cliente_root(cliente_id).collection(_COLECAO).document(h)
+
+def _vencida(o, agora):
+    try:
+        if o.get("status") == "em_andamento":
+            return (agora - o.get("iniciado_em")).total_seconds() > _LEASE
+        return o.get("expira_em") is not None and o.get("expira_em") < agora
+    except Exception:
+        return True
+
+def reivindicar(cliente_id, rota, chave):
+    """Retorna ("novo", None), ("concluido", resposta_dict), ("em_andamento", None) ou ("incerto", None)."""
+    ref = _ref(cliente_id, rota, chave)
+    agora = _now_sp()
+    claim = {
+        "rota": str(rota),
+        "chave": str(chave)[:200],
+        "status": "em_andamento",
+        "iniciado_em": agora,
+        "expira_em": agora + timedelta(seconds=_TTL),
+    }
+    criar = getattr(ref, "create", None)
+    if criar is not None:
+        try:
+            criar(claim)
+            return "novo", None
+        except Exception as e:
+            if type(e).__name__ not in ("AlreadyExists", "Conflict"):
+                raise
+    o = ref.get().to_dict() or {}
+    if not o or _vencida(o, agora):
+        # chave vencida (ou sem create() no cliente de teste): assume a chave
+        ref.set(claim)
+        return "novo", None
+    if o.get("status") == "concluido":
+        try:
+            return "concluido", json.loads(o.get("resposta_json") or "{}")
+        except Exception:
+            return "novo", None
+    if o.get("status") == "incerto":
+        return "incerto", None
+    return "em_andamento", None
+
+def concluir(cliente_id, rota, chave, resposta):
+    agora = _now_sp()
+    _ref(cliente_id, rota, chave).set({
+        "status": "concluido",
+        "resposta_json": json.dumps(resposta, ensure_ascii=False, default=str),
+        "concluido_em": agora,
+        "expira_em": agora + timedelta(seconds=_TTL),
+    }, merge=True)
+
+def liberar(cliente_id, rota, chave):
+    # falhou: a próxima tentativa com a mesma chave processa de novo
+    _ref(cliente_id, rota, chave).delete()
+
+def incerto(cliente_id, rota, chave):
+    # commit ambíguo: a escrita pode ter sido aplicada, então a chave não é liberada até o TTL
+    agora = _now_sp()
+    _ref(cliente_id, rota, chave).set({
+        "status": "incerto",
+        "incerto_em": agora,
+        "expira_em": agora + timedelta(seconds=_TTL),
+    }, merge=True)
@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+
+# Contabilidade de RPCs do Firestore por requisição HTTP e por endpoint.
+# get_db() devolve o cliente embrulhado por instrumentar(); cada leitura/escrita/consulta soma no
+# contador da requisição corrente (thread-local) e, ao fim da requisição, no total do endpoint.
+_local = threading.local()
+_lock = threading.Lock()
+_CAMPOS = ("reads", "writes", "queries", "docs", "commits", "firestore_ms")
+_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+_por_endpoint = {}
+_SEM_REQUISICAO = "_fora_de_requisicao"
+
+def ativo():
+    return str(os.getenv("FIRESTORE_METRICS", "1") or "1").strip().lower() not in ("0", "false", "no", "off")
+
+def _novo():
+    return {k: 0 for k in _CAMPOS}
+
+def _atual():
+    c = getattr(_local, "contador", None)
+    if c is None:
+        # operações fora de uma requisição (threads de pool, jobs, worker da fila)
+        with _lock:
+            e = _por_endpoint.setdefault(_SEM_REQUISICAO, _novo_endpoint())
+        return e["totais"], True
+    return c, False
+
+def _contar(campo, n=1):
+    c, _compartilhado = _atual()
+    # o contador da requisição também é usado pelas threads de pool (propagar), daí o lock
+    with _lock:
+        c[campo] += n
+
+def _contar_ms(t0):
+    _contar("firestore_ms", (time.time() - t0) * 1000.0)
+
+def _novo_endpoint():
+    return {"requisicoes": 0, "totais": _novo(), "buckets": [0] * len(_BUCKETS_MS), "soma_ms": 0.0}
+
+def iniciar_requisicao():
+    _local.contador = _novo()
+    _local.inicio = time.time()
+
+def propagar(fn):
+    """Faz fn (rodando em thread de pool) contar na requisição de quem o criou."""
+    c = getattr(_local, "contador", None)
+    def rodar(*a, **k):
+        antigo = getattr(_local, "contador", None)
+        _local.contador = c
+        try:
+            return fn(*a, **k)
+        finally:
+            _local.contador = antigo
+    return rodar
+
+def finalizar_requisicao(endpoint):
+    """Fecha a requisição corrente, soma no endpoint e devolve os contadores dela (ou None)."""
+    c = getattr(_local, "contador", None)
+    t0 = getattr(_local, "inicio", None)
+    _local.contador = None
+    _local.inicio = None
+    if c is None or t0 is None:
+        return None
+    dur_ms = (time.time() - t0) * 1000.0
+    with _lock:
+        e = _por_endpoint.setdefault(str(endpoint or "desconhecido"), _novo_endpoint())
+        e["requisicoes"] += 1
+        for k in _CAMPOS:
+            e["totais"][k] += c[k]
+        for i, b in enumerate(_BUCKETS_MS):
+            if dur_ms <= b:
+                e["buckets"][i] += 1
+        e["soma_ms"] += dur_ms
+    out = dict(c)
+    out["duracao_ms"] = dur_ms
+    return out
+
+def snapshot():
+    with _lock:
+        return {k: {"requisicoes": v["requisicoes"], "totais": dict(v["totais"]), "buckets": list(v["buckets"]), "soma_ms": v["soma_ms"]} for k, v in _por_endpoint.items()}
+
+def _rotulo(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def prometheus(extras=None):
+    """Texto no formato de exposição do Prometheus. extras: {nome_metrica: (tipo, ajuda, {rotulos_tuple: valor})}."""
+    snap = snapshot()
+    linhas = []
+    def serie(nome, tipo, ajuda, valores):
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        for rotulos, v in valores:
+            r = ",".join(f'{k}="{_rotulo(x)}"' for k, x in rotulos)
+            linhas.append(f"{nome}{{{r}}} {float(v):g}" if r else f"{nome} {float(v):g}")
+    serie("apifinanceira_requests_total", "counter", "Requisicoes HTTP por endpoint.",
+          [((("endpoint", ep),), e["requisicoes"]) for ep, e in sorted(snap.items()) if ep != _SEM_REQUISICAO])
+    for campo, nome, ajuda in (
+        ("reads", "apifinanceira_firestore_reads_total", "Documentos lidos por get/get_all."),
+        ("writes", "apifinanceira_firestore_writes_total", "Escritas (set/update/delete, diretas ou em lote)."),
+        ("queries", "apifinanceira_firestore_queries_total", "Consultas executadas (stream/get/list_documents)."),
+        ("docs", "apifinanceira_firestore_docs_streamed_total", "Documentos devolvidos por consultas."),
+        ("commits", "apifinanceira_firestore_commits_total", "Commits de lote."),
+    ):
+        serie(nome, "counter", ajuda, [((("endpoint", ep),), e["totais"][campo]) for ep, e in sorted(snap.items())])
+    serie("apifinanceira_firestore_seconds_total", "counter", "Tempo gasto em chamadas ao Firestore.",
+          [((("endpoint", ep),), e["totais"]["firestore_ms"] / 1000.0) for ep, e in sorted(snap.items())])
+    linhas.append("# HELP apifinanceira_request_duration_seconds Latencia das requisicoes HTTP por endpoint.")
+    linhas.append("# TYPE apifinanceira_request_duration_seconds histogram")
+    for ep, e in sorted(snap.items()):
+        if ep == _SEM_REQUISICAO:
+            continue
+        for i, b in enumerate(_BUCKETS_MS):
+            linhas.append(f'apifinanceira_request_duration_seconds_bucket{{endpoint="{_rotulo(ep)}",le="{b / 1000.0:g}"}} {e["buckets"][i]}')
+        linhas.append(f'apifinanceira_request_duration_seconds_bucket{{endpoint="{_rotulo(ep)}",le="+Inf"}} {e["requisicoes"]}')
+        linhas.append(f'apifinanceira_request_duration_seconds_sum{{endpoint="{_rotulo(ep)}"}} {e["soma_ms"] / 1000.0:g}')
+        linhas.append(f'apifinanceira_request_duration_seconds_count{{endpoint="{_rotulo(ep)}"}} {e["requisicoes"]}')
+    for nome, (tipo, ajuda, valores) in sorted((extras or {}).items()):
+        serie(nome, tipo, ajuda, sorted(valores.items()))
+    return "\n".join(linhas) + "\n"
+
+# ---- proxies do cliente Firestore ----
+def _desembrulhar(x):
+    if isinstance(x, _Instr):
+        return x._alvo
+    if isinstance(x, (list, tuple)):
+        return type(x)(_desembrulhar(i) for i in x)
+    return x
+
+def _embrulhar(x):
+    if x is None or isinstance(x, _Instr):
+        return x
+    if hasattr(x, "stream") and hasattr(x, "where"):
+        return _ConsultaInstr(x)
+    if hasattr(x, "collection") and hasattr(x, "set") and hasattr(x, "get"):
+        return _DocInstr(x)
+    return x
+
+class _Instr:
+    __slots__ = ("_alvo",)
+    def __init__(self, alvo):
+        object.__setattr__(self, "_alvo", alvo)
+    def __getattr__(self, nome):
+        attr = getattr(self._alvo, nome)
+        if callable(attr):
+            def chamar(*a, **k):
+                return _embrulhar(attr(*_desembrulhar(a), **{kk: _desembrulhar(v) for kk, v in k.items()}))
+            return chamar
+        return _embrulhar(attr)
+    def __eq__(self, outro):
+        return self._alvo == _desembrulhar(outro)
+    def __hash__(self):
+        return hash(self._alvo)
+    def __repr__(self):
+        return repr(self._alvo)
+
+class _DocInstr(_Instr):
+    __slots__ = ()
+    def get(self, *a, **k):
+        t0 = time.time()
+        try:
+            return self._alvo.get(*a, **k)
+        finally:
+            _contar("reads")
+            _contar_ms(t0)
+    def _escrita(self, nome, *a, **k):
+        t0 = time.time()
+        try:
+            return getattr(self._alvo, nome)(*a, **k)
+        finally:
+            _contar("writes")
+            _contar_ms(t0)
+    def set(self, *a, **k):
+        return self._escrita("set", *a, **k)
+    def update(self, *a, **k):
+        return self._escrita("update", *a, **k)
+    def delete(self, *a, **k):
+        return self._escrita("delete", *a, **k)
+    def create(self, *a, **k):
+        return self._escrita("create", *a, **k)
+
+class _ConsultaInstr(_Instr):
+    __slots__ = ()
+    def stream(self, *a, **k):
+        _contar("queries")
+        t0 = time.time()
+        try:
+            for snap in self._alvo.stream(*a, **k):
+                _contar("docs")
+                yield snap
+        finally:
+            _contar_ms(t0)
+    def get(self, *a, **k):
+        return list(self.stream(*a, **k))
+    def list_documents(self, *a, **k):
+        _contar("queries")
+        t0 = time.time()
+        try:
+            return [_DocInstr(r) for r in self._alvo.list_documents(*a, **k)]
+        finally:
+            _contar_ms(t0)
+
+class _LoteInstr(_Instr):
+    __slots__ = ("_ops",)
+    def __init__(self, alvo):
+        super().__init__(alvo)
+        object.__setattr__(self, "_ops", 0)
+    def _op(self, nome, ref, *a, **k):
+        getattr(self._alvo, nome)(_desembrulhar(ref), *a, **k)
+        object.__setattr__(self, "_ops", self._ops + 1)
+        return self
+    def set(self, ref, *a, **k):
+        return self._op("set", ref, *a, **k)
+    def update(self, ref, *a, **k):
+        return self._op("update", ref, *a, **k)
+    def delete(self, ref, *a, **k):
+        return self._op("delete", ref, *a, **k)
+    def create(self, ref, *a, **k):
+        return self._op("create", ref, *a, **k)
+    def commit(self, *a, **k):
+        t0 = time.time()
+        try:
+            return self._alvo.commit(*a, **k)
+        finally:
+            _contar("commits")
+            _contar("writes", self._ops)
+            _contar_ms(t0)
+
+class _ClienteInstr(_Instr):
+    __slots__ = ()
+    def batch(self):
+        return _LoteInstr(self._alvo.batch())
+    def get_all(self, refs, *a, **k):
+        t0 = time.time()
+        try:
+            for snap in self._alvo.get_all(_desembrulhar(list(refs)), *a, **k):
+                _contar("reads")
+                yield snap
+        finally:
+            _contar_ms(t0)
+    def collections(self, *a, **k):
+        _contar("queries")
+        return [_embrulhar(c) for c in self._alvo.collections(*a, **k)]
+
+def instrumentar(db):
+    if db is None or isinstance(db, _Instr) or not ativo():
+        return db
+    return _ClienteInstr(db)
@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+
+# Profiler por amostragem (opt-in): uma thread amostra a pilha das threads de requisição marcadas
+# a cada PROFILE_INTERVAL_MS e grava as pilhas no formato "collapsed" (flamegraph.pl / speedscope),
+# um arquivo por requisição em PROFILE_DIR, com um .json de metadados ao lado.
+# O header X-Profile e as rotas /debug/perfis só funcionam com PROFILER_TOKEN definido; a thread de
+# amostragem só existe enquanto há requisição sendo perfilada.
+try:
+    _TAXA = float(os.getenv("PROFILE_RATE", "0") or 0)
+except Exception:
+    _TAXA = 0.0
+try:
+    _INTERVALO = max(0.001, float(os.getenv("PROFILE_INTERVAL_MS", "5") or 5) / 1000.0)
+except Exception:
+    _INTERVALO = 0.005
+try:
+    _MAX_ARQUIVOS = int(os.getenv("PROFILE_MAX_ARQUIVOS", "200") or 200)
+except Exception:
+    _MAX_ARQUIVOS = 200
+HEADER = os.getenv("PROFILE_HEADER", "X-Profile") or "X-Profile"
+_TOKEN = os.getenv("PROFILER_TOKEN") or ""
+
+_lock = threading.Lock()
+_alvos = {}
+_amostrador = None
+
+def diretorio():
+    import tempfile
+    return os.getenv("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "apifinanceira_profiles")
+
+def habilitado():
+    return bool(_TOKEN)
+
+def token_ok(valor):
+    import hmac
+    return bool(_TOKEN) and hmac.compare_digest(str(valor or ""), _TOKEN)
+
+def deve_perfilar(header_valor=None):
+    # Header de debug com o valor de PROFILER_TOKEN, ou sorteio por PROFILE_RATE
+    if header_valor and token_ok(header_valor):
+        return True
+    return _TAXA > 0 and random.random() < _TAXA
+
+def _rotulo(frame):
+    co = frame.f_code
+    return f"{os.path.basename(co.co_filename)}:{co.co_name}".replace(";", ",")
+
+def _loop():
+    global _amostrador
+    while True:
+        time.sleep(_INTERVALO)
+        with _lock:
+            if not _alvos:
+                # nada sendo perfilado: a thread termina; iniciar() cria outra
+                _amostrador = None
+                return
+            tids = list(_alvos.keys())
+        frames = sys._current_frames()
+        for tid in tids:
+            f = frames.get(tid)
+            if f is None:
+                continue
+            pilha = []
+            while f is not None:
+                pilha.append(_rotulo(f))
+                f = f.f_back
+            chave = ";".join(reversed(pilha))
+            with _lock:
+                cont = _alvos.get(tid)
+                if cont is not None:
+                    cont[chave] = cont.get(chave, 0) + 1
+
+def iniciar():
+    global _amostrador
+    tid = threading.get_ident()
+    with _lock:
+        _alvos[tid] = {}
+        # decidido sob o mesmo lock em que _loop desiste, então um alvo novo nunca fica sem thread
+        if _amostrador is None:
+            _amostrador = threading.Thread(target=_loop, name="profiler-amostrador", daemon=True)
+            _amostrador.start()
+    return tid
+
+def parar(tid):
+    with _lock:
+        return _alvos.pop(tid, None) or {}
+
+def salvar(pilhas, endpoint, cliente_id=None, duracao_ms=0.0, status=None):
+    """Grava {id}.folded e {id}.json; devolve o id do perfil."""
+    d = diretorio()
+    os.makedirs(d, exist_ok=True)
+    slug = "".join(c if c.isalnum() else "_" for c in str(endpoint or "rota").strip("/"))[:60] or "raiz"
+    cid = "".join(c if c.isalnum() else "_" for c in str(cliente_id or "-"))[:40]
+    pid = f"{time.strftime('%Y%m%dT%H%M%S')}_{int(time.time() * 1000) % 1000:03d}_{slug}_{cid}_{int(duracao_ms)}ms"
+    with open(os.path.join(d, pid + ".folded"), "w", encoding="utf-8") as f:
+        for chave, n in sorted(pilhas.items(), key=lambda x: -x[1]):
+            f.write(f"{chave} {n}\n")
+    meta = {
+        "id": pid,
+        "endpoint": str(endpoint),
+        "cliente_id": cliente_id,
+        "duracao_ms": round(float(duracao_ms), 2),
+        "status": status,
+        "amostras": int(sum(pilhas.values())),
+        "intervalo_ms": _INTERVALO * 1000.0,
+        "criado_em": time.time(),
+    }
+    with open(os.path.join(d, pid + ".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _podar(d)
+    return pid
+
+def _podar(d):
+    try:
+        metas = sorted(n for n in os.listdir(d) if n.endswith(".json"))
+        for n in metas[:max(0, len(metas) - _MAX_ARQUIVOS)]:
+            for ext in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(d, n[:-5] + ext))
+                except Exception:
+                    pass
+    except Exception:
+        pass
+
+def listar(limite=20, min_ms=0.0, recentes=200):
+    """Perfis mais lentos entre os `recentes` últimos gravados."""
+    d = diretorio()
+    try:
+        nomes = sorted((n for n in os.listdir(d) if n.endswith(".json")), reverse=True)[:int(recentes)]
+    except Exception:
+        return []
+    out = []
+    for n in nomes:
+        try:
+            with open(os.path.join(d, n), encoding="utf-8") as f:
+                m = json.load(f)
+            if float(m.get("duracao_ms", 0) or 0) >= float(min_ms or 0):
+                out.append(m)
+        except Exception:
+            pass
+    out.sort(key=lambda m: -float(m.get("duracao_ms", 0) or 0))
+    return out[:int(limite)]
+
+def ler(pid):
+    nome = os.path.basename(str(pid or ""))
+    p = os.path.join(diretorio(), nome + ".folded")
+    if not nome or not os.path.exists(p):
+        return None
+    with open(p, encoding="utf-8") as f:
+        return f.read()
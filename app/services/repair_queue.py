@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Fila de reparos de agregados: os GETs só avisam que um dia/mês precisa ser refeito (ou que o
+# índice do extrato de um mês precisa ser montado) e um worker em segundo plano junta os avisos
+# repetidos e faz cada reparo uma única vez.
+_lock = threading.Lock()
+_cond = threading.Condition(_lock)
+_pendentes = OrderedDict()
+_worker = None
+_stats = {
+    "agendados": 0,
+    "coalescidos": 0,
+    "executados": 0,
+    "descartados": 0,
+    "falhas": 0,
+    "ultimo_erro": None,
+}
+try:
+    _ATRASO = float(os.getenv("REPAIR_QUEUE_DELAY", "2") or 2)
+except Exception:
+    _ATRASO = 2.0
+try:
+    _MAX_PENDENTES = int(os.getenv("REPAIR_QUEUE_MAX", "5000") or 5000)
+except Exception:
+    _MAX_PENDENTES = 5000
+
+def _executar(cliente_id, dias, meses, extratos=()):
+    from app.services.database import recompute_cliente_dias, reparar_dias_sujos, construir_extrato_mes  # lazy import
+    # reparo de dia também drena dias_sujos do cliente (só limpa os dias que não mudaram no meio)
+    if dias:
+        res = reparar_dias_sujos(cliente_id, dias=dias, meses=meses)
+    else:
+        res = recompute_cliente_dias(cliente_id, meses=meses) if meses else {}
+    for mes in extratos:
+        construir_extrato_mes(cliente_id, mes)
+    try:
+        from app.services.cache import invalidar_cliente
+        invalidar_cliente(cliente_id)
+    except Exception:
+        pass
+    return res
+
+def _loop():
+    while True:
+        with _cond:
+            while not _pendentes:
+                _cond.wait()
+        # janela curta para os avisos repetidos do mesmo cliente se acumularem
+        time.sleep(_ATRASO)
+        with _cond:
+            if not _pendentes:
+                continue
+            (cliente_id, _escopo, _chave) = next(iter(_pendentes))
+            dias = set()
+            meses = set()
+            extratos = set()
+            for k in [k for k in _pendentes if k[0] == cliente_id]:
+                _pendentes.pop(k, None)
+                if k[1] == "dia":
+                    dias.add(k[2])
+                elif k[1] == "extrato":
+                    extratos.add(k[2])
+                else:
+                    meses.add(k[2])
+        try:
+            _executar(cliente_id, sorted(dias), sorted(meses), sorted(extratos))
+            with _lock:
+                _stats["executados"] += 1
+        except Exception as e:
+            with _lock:
+                _stats["falhas"] += 1
+                _stats["ultimo_erro"] = str(e)
+
+def _garantir_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    _worker = threading.Thread(target=_loop, name="repair-queue", daemon=True)
+    _worker.start()
+
+def agendar_reparo(cliente_id, escopo, chave):
+    """Agenda o reparo de um dia ('dia', YYYY-MM-DD), mês ('mes', YYYY-MM) ou a montagem do índice do
+    extrato de um mês ('extrato', YYYY-MM). Retorna False se já estava na fila."""
+    if escopo not in ("dia", "mes", "extrato") or not chave:
+        return False
+    k = (str(cliente_id), escopo, str(chave))
+    with _cond:
+        if k in _pendentes:
+            _stats["coalescidos"] += 1
+            return False
+        if len(_pendentes) >= _MAX_PENDENTES:
+            _stats["descartados"] += 1
+            return False
+        _pendentes[k] = time.time()
+        _stats["agendados"] += 1
+        _cond.notify()
+    try:
+        _garantir_worker()
+    except Exception:
+        pass
+    return True
+
+def status_reparos():
+    with _lock:
+        out = dict(_stats)
+        out["pendentes"] = len(_pendentes)
+    out["worker_ativo"] = bool(_worker is not None and _worker.is_alive())
+    return out
@@ -0,0 +1,59 @@
+import os
+import threading
+
+# Single-flight: chamadas concorrentes com a mesma chave esperam uma única execução e dividem o resultado.
+# Usado nos cache misses dos GETs de agregados (vários pedidos iguais logo depois de uma escrita).
+_lock = threading.Lock()
+_voos = {}
+_stats = {
+    "lideres": 0,
+    "compartilhados": 0,
+    "timeouts": 0,
+    "erros": 0,
+}
+try:
+    _TIMEOUT = float(os.getenv("SINGLEFLIGHT_TIMEOUT", "30") or 30)
+except Exception:
+    _TIMEOUT = 30.0
+
+class _Voo:
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+def executar_unico(chave, fn, timeout=None):
+    """Executa fn() uma vez por chave em andamento. Retorna (resultado, compartilhado)."""
+    with _lock:
+        voo = _voos.get(chave)
+        lider = voo is None
+        if lider:
+            voo = _Voo()
+            _voos[chave] = voo
+            _stats["lideres"] += 1
+    if not lider:
+        ok = voo.evento.wait(_TIMEOUT if timeout is None else timeout)
+        if ok and voo.erro is None:
+            with _lock:
+                _stats["compartilhados"] += 1
+            return voo.resultado, True
+        # líder demorou demais ou falhou: este chamador segue sozinho
+        with _lock:
+            _stats["timeouts" if not ok else "erros"] += 1
+        return fn(), False
+    try:
+        voo.resultado = fn()
+        return voo.resultado, False
+    except Exception as e:
+        voo.erro = e
+        raise
+    finally:
+        with _lock:
+            _voos.pop(chave, None)
+        voo.evento.set()
+
+def singleflight_stats():
+    with _lock:
+        out = dict(_stats)
+        out["em_voo"] = len(_voos)
+    return out
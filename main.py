@@ -36,8 +36,10 @@ def _month_key_sp():
     except:
         return datetime.now().strftime("%Y-%m")
 try:
-    from app.services.database import migrate_all_clientes, migrate_cliente_transacoes_to_nested, recompute_cliente_aggregates, get_db, firestore
+    from app.services.database import migrate_all_clientes, migrate_cliente_transacoes_to_nested, recompute_cliente_aggregates, recompute_cliente_incremental, get_db, get_dias_mes, firestore
 except Exception:
+    recompute_cliente_incremental = None
+    get_dias_mes = None
     migrate_all_clientes = None
     migrate_cliente_transacoes_to_nested = None
     recompute_cliente_aggregates = None
@@ -72,20 +74,14 @@ def _ensure_month_consistency(cliente_id: str, mes_atual: str):
             return
     except Exception:
         pass
-    ano, mes = mes_atual.split("-")
-    dt_ini = f"{ano}-{mes}-01"
-    if mes == "12":
-        dt_fim = f"{int(ano)+1}-01-01"
-    else:
-        dt_fim = f"{ano}-{int(mes)+1:02d}-01"
-    cur = datetime.strptime(dt_ini, "%Y-%m-%d")
-    end = datetime.strptime(dt_fim, "%Y-%m-%d")
     s_td = s_tr = s_taj = s_tes = 0.0
     qv_sum = 0
-    while cur < end:
-        dkey = cur.strftime("%Y-%m-%d")
+    try:
+        dias_mes = get_dias_mes(cliente_id, mes_atual)
+    except Exception:
+        return
+    for dkey, dd in dias_mes.items():
         try:
-            dd = root.collection("dias").document(dkey).get().to_dict() or {}
             tdd = dict(dd.get("totais_dia", {}) or {})
             s_td += float(tdd.get("total_saida", dd.get("total_saida", 0)) or 0)
             s_tr += float(tdd.get("total_entrada", dd.get("total_entrada", 0)) or 0)
@@ -94,7 +90,6 @@ def _ensure_month_consistency(cliente_id: str, mes_atual: str):
             qv_sum += int(dd.get("quantidade_transacoes_validas", 0) or 0)
         except Exception:
             pass
-        cur = cur + timedelta(days=1)
     s_saldo = s_tr - s_td + s_tes + s_taj
     need_fix = False
     try:
@@ -152,6 +147,13 @@ def _consistency_monitor(interval_seconds: int = 300, recent_hours: int = 8):
                     ok = True
                 if not ok:
                     continue
+                # Dias marcados como sujos pelas escritas: reparo incremental; senão só a checagem do mês
+                if o.get("dias_sujos") and recompute_cliente_incremental is not None:
+                    try:
+                        recompute_cliente_incremental(cid, root_doc=o)
+                    except Exception:
+                        pass
+                    continue
                 _ensure_month_consistency(cid, mes_atual)
         except Exception:
             pass
@@ -243,14 +245,33 @@ def main():
     parser.add_argument("--cliente_id", type=str, help="Migrar/Recomputar apenas este cliente")
     parser.add_argument("--delete_original", action="store_true", help="Apagar documentos antigos após migrar")
     parser.add_argument("--no_recompute", action="store_true", help="Não recomputar agregados após migrar")
+    parser.add_argument("--backup", nargs="?", const="", default=None, help="Exportar o Firestore para NDJSON gzip (caminho opcional)")
+    parser.add_argument("--restore", type=str, default=None, help="Restaurar um backup NDJSON gzip")
+    parser.add_argument("--workers", type=int, default=None, help="Clientes migrados em paralelo (padrão: MIGRACAO_WORKERS ou 4)")
+    parser.add_argument("--job_id", type=str, default=None, help="Id do job de migração; repetir o mesmo id retoma do último checkpoint")
     args = parser.parse_args()
+    if args.backup is not None or args.restore:
+        try:
+            from app.services.database import backup_firestore_data, restore_firestore_data
+        except Exception:
+            print("❌ Dependências do Firestore não estão disponíveis.")
+            sys.exit(1)
+        if args.restore:
+            print(json.dumps(restore_firestore_data(args.restore), ensure_ascii=False, indent=2))
+        else:
+            path = backup_firestore_data(args.backup or None)
+            print(f"✅ Backup salvo em {path}" if path else "❌ Falha ao gerar backup")
+        return
     if args.migrar_todos or args.cliente_id:
         if migrate_all_clientes is None:
             print("❌ Dependências do Firestore não estão disponíveis.")
             sys.exit(1)
         recompute = not args.no_recompute
         if args.migrar_todos:
-            res = migrate_all_clientes(delete_original=args.delete_original, recompute=recompute)
+            def _progresso(ev):
+                marca = "✅" if ev.get("status") == "ok" else "❌"
+                print(f"{marca} [{ev.get('processados')}/{ev.get('total')}] {ev.get('cliente_id')}" + (f" — {ev.get('erro')}" if ev.get("erro") else ""), flush=True)
+            res = migrate_all_clientes(delete_original=args.delete_original, recompute=recompute, workers=args.workers, job_id=args.job_id, progresso=_progresso)
             print(json.dumps(res, ensure_ascii=False, indent=2))
             return
         if args.cliente_id:
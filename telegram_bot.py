@@ -145,11 +145,34 @@ async def _req_json_async(url, timeout=4):
         except:
             return {}
     return await loop.run_in_executor(None, _call)
+_ETAGS = {}
+async def _req_json_revalidar_async(url, timeout=4):
+    # GET condicional: com ETag guardada manda If-None-Match e, no 304, reaproveita o corpo anterior
+    loop = asyncio.get_event_loop()
+    def _call():
+        antigo = _ETAGS.get(url)
+        try:
+            headers = {"If-None-Match": antigo[0]} if antigo else {}
+            r = requests.get(url, timeout=timeout, headers=headers)
+            if r.status_code == 304 and antigo:
+                return antigo[1]
+            d = r.json()
+            et = r.headers.get("ETag")
+            if et and isinstance(d, dict) and d.get("sucesso"):
+                if len(_ETAGS) > 1000:
+                    _ETAGS.clear()
+                _ETAGS[url] = (et, d)
+            else:
+                _ETAGS.pop(url, None)
+            return d
+        except:
+            return {}
+    return await loop.run_in_executor(None, _call)
 async def _req_json_cached_async(url, key, ttl=15, timeout=4):
     v = _cache_get(key)
     if v is not None:
         return v
-    d = await _req_json_async(url, timeout=timeout)
+    d = await _req_json_revalidar_async(url, timeout=timeout)
     try:
         if isinstance(d, dict) and ('sucesso' in d) and (not d.get('sucesso')):
             return d
@@ -170,6 +193,25 @@ async def _req_json_cached_async(url, key, ttl=15, timeout=4):
     except:
         pass
     return d
+async def _dashboard_async(cid, qs, include_transacoes=True, timeout=4):
+    # /dashboard traz dia, semana, mês, categorias, extrato de hoje e consistência numa ida só
+    it = "true" if include_transacoes else "false"
+    d = await _req_json_cached_async(f"{API_URL}/dashboard?include_transacoes={it}&{qs}", f"dashboard:{cid}:{_day_key_sp()}:{it}", ttl=10, timeout=timeout)
+    return d if isinstance(d, dict) and d.get("sucesso") else None
+def _dashboard_views(d):
+    # Mesmo formato das respostas de /saldo/atual, /total/mes, /extrato/hoje e /health/consistency
+    mes = d.get("mes") or {}
+    extrato = d.get("extrato") or {}
+    return {
+        "dia": {"sucesso": True, "total": (d.get("dia") or {}).get("total") or {}},
+        "semana": {"sucesso": True, **(d.get("semana") or {})},
+        "mes": {"sucesso": True, "total": mes.get("total") or {}, "quantidade_transacoes_validas": mes.get("quantidade_transacoes_validas", 0)},
+        "mes_soma": {"sucesso": True, "total": mes.get("total") or {}},
+        "mes_categorias": {"sucesso": True, "total": mes.get("total") or {}, "categorias": mes.get("categorias") or {}},
+        "extrato": {"sucesso": True, "data": extrato.get("data"), "transacoes": extrato.get("transacoes") or [], "total": (d.get("dia") or {}).get("total") or {}, "quantidade_transacoes_validas": (d.get("dia") or {}).get("quantidade_transacoes_validas", 0)},
+        "consistencia": {"sucesso": True, "mes": (d.get("consistencia") or {}).get("mes") or {}},
+        "geral": {"sucesso": True, "total": {"saldo_real": (d.get("geral") or {}).get("saldo_real", 0)}},
+    }
 
 def _now_sp():
     try:
@@ -206,6 +248,13 @@ def _canon_category(cat):
 
 _BG_LIMIT = int(os.getenv("BOT_MAX_CONCURRENCY", "2") or "2")
 _bg_semaphore = asyncio.Semaphore(_BG_LIMIT if _BG_LIMIT > 0 else 1)
+def _chave_idempotencia(update):
+    # mesma mensagem do Telegram (reentrega, retry) => mesma chave na API
+    try:
+        return f"tg:{update.effective_chat.id}:{update.effective_message.message_id}"
+    except:
+        return None
+
 async def _post_json_async(url, payload=None, timeout=10):
     loop = asyncio.get_event_loop()
     def _call():
@@ -231,11 +280,16 @@ async def mini_report(cliente_id: str, cliente_nome: str = None, username: str =
         day_url = f"{API_URL}/saldo/atual?inicio={dkey}&fim={dkey}&{qs}"
         month_url = f"{API_URL}/saldo/atual?mes={mkey}&{qs}"
         geral_url = f"{API_URL}/saldo/atual?{qs}"
-        day_api, month_api, geral_api = await asyncio.gather(
-            _req_json_cached_async(day_url, f"day:{cliente_id}:{dkey}", ttl=10, timeout=4),
-            _req_json_cached_async(month_url, f"month:{cliente_id}:{mkey}", ttl=15, timeout=4),
-            _req_json_cached_async(geral_url, f"geral:{cliente_id}", ttl=20, timeout=4),
-        )
+        dash = await _dashboard_async(cliente_id, qs, include_transacoes=False)
+        if dash:
+            v = _dashboard_views(dash)
+            day_api, month_api, geral_api = v["dia"], v["mes_soma"], v["geral"]
+        else:
+            day_api, month_api, geral_api = await asyncio.gather(
+                _req_json_cached_async(day_url, f"day:{cliente_id}:{dkey}", ttl=10, timeout=4),
+                _req_json_cached_async(month_url, f"month:{cliente_id}:{mkey}", ttl=15, timeout=4),
+                _req_json_cached_async(geral_url, f"geral:{cliente_id}", ttl=20, timeout=4),
+            )
         receitas_dia = float(((day_api or {}).get("total") or {}).get("receitas", 0) or 0)
         despesas_dia = float(((day_api or {}).get("total") or {}).get("despesas", 0) or 0)
         saldo_dia = float(((day_api or {}).get("total") or {}).get("saldo", receitas_dia - despesas_dia) or (receitas_dia - despesas_dia))
@@ -1631,14 +1685,20 @@ async def resumo_financeiro(query, context):
         extrato_url = f"{API_URL}/extrato/hoje?{build_cliente_query_params(query)}"
         consistency_url = f"{API_URL}/health/consistency?{build_cliente_query_params(query)}"
         try:
-            day_api, mes_api, sum_api, cats_group_api, extrato_api, cons_api = await asyncio.gather(
-                _req_json_cached_async(day_url, f"day:{cid}:{dkey}", ttl=10, timeout=4),
-                _req_json_cached_async(month_url, f"month:{cid}:{mkey}", ttl=15, timeout=4),
-                _req_json_cached_async(sum_url, f"month-sum:{cid}:{mkey}", ttl=15, timeout=4),
-                _req_json_cached_async(cats_group_url, f"monthcatgrp:{cid}:{mkey}", ttl=15, timeout=4),
-                _req_json_cached_async(extrato_url, f"extrato:{cid}:{dkey}", ttl=10, timeout=4),
-                _req_json_cached_async(consistency_url, f"consistency:{cid}:{mkey}", ttl=10, timeout=4),
-            )
+            dash = await _dashboard_async(cid, build_cliente_query_params(query))
+            if dash:
+                v = _dashboard_views(dash)
+                day_api, mes_api, sum_api, cats_group_api, extrato_api, cons_api = v["dia"], v["mes"], v["mes_soma"], v["mes_categorias"], v["extrato"], v["consistencia"]
+            else:
+                # API sem /dashboard: chamadas separadas
+                day_api, mes_api, sum_api, cats_group_api, extrato_api, cons_api = await asyncio.gather(
+                    _req_json_cached_async(day_url, f"day:{cid}:{dkey}", ttl=10, timeout=4),
+                    _req_json_cached_async(month_url, f"month:{cid}:{mkey}", ttl=15, timeout=4),
+                    _req_json_cached_async(sum_url, f"month-sum:{cid}:{mkey}", ttl=15, timeout=4),
+                    _req_json_cached_async(cats_group_url, f"monthcatgrp:{cid}:{mkey}", ttl=15, timeout=4),
+                    _req_json_cached_async(extrato_url, f"extrato:{cid}:{dkey}", ttl=10, timeout=4),
+                    _req_json_cached_async(consistency_url, f"consistency:{cid}:{mkey}", ttl=10, timeout=4),
+                )
         except:
             day_api = {}
             mes_api = {}
@@ -2863,11 +2923,16 @@ async def extrato_detalhado(query, context):
         url_mes = f"{API_URL}/saldo/atual?mes={mk}&{qs}"
         url_geral = f"{API_URL}/saldo/atual?{qs}"
         try:
-            day_api, mes_api, geral_api = await asyncio.gather(
-                _req_json_cached_async(url_dia, f"extrato:{cid}:{_day_key_sp()}", ttl=8, timeout=4),
-                _req_json_cached_async(url_mes, f"month:{cid}:{mk}", ttl=12, timeout=4),
-                _req_json_cached_async(url_geral, f"geral:{cid}", ttl=20, timeout=4),
-            )
+            dash = await _dashboard_async(cid, qs)
+            if dash:
+                v = _dashboard_views(dash)
+                day_api, mes_api, geral_api = v["extrato"], v["mes_soma"], v["geral"]
+            else:
+                day_api, mes_api, geral_api = await asyncio.gather(
+                    _req_json_cached_async(url_dia, f"extrato:{cid}:{_day_key_sp()}", ttl=8, timeout=4),
+                    _req_json_cached_async(url_mes, f"month:{cid}:{mk}", ttl=12, timeout=4),
+                    _req_json_cached_async(url_geral, f"geral:{cid}", ttl=20, timeout=4),
+                )
         except:
             day_api = {"sucesso": False}
             mes_api = {"sucesso": False}
@@ -2903,7 +2968,7 @@ async def extrato_detalhado(query, context):
         bloco = wrap_code_block(caixa_dia) + "\n" + wrap_code_block(caixa_mes)
         lista_tx = []
         try:
-            for t in (day_api.get("matches") or [])[:10]:
+            for t in (day_api.get("matches") or day_api.get("transacoes") or [])[:10]:
                 tp = str(t.get('tipo', '')).strip().lower()
                 emoji = "🔴" if tp in ('0', 'saida', 'despesa') else ("🟢" if tp in ('1', 'entrada', 'receita') else "⚙️")
                 v = float(t.get('valor', 0) or 0)
@@ -3787,7 +3852,7 @@ async def processar_mensagem_texto(update: Update, context: CallbackContext):
         if not transacoes:
             try:
                 from app.services.finance_api import processar_mensagem
-                data2 = await asyncio.to_thread(processar_mensagem, texto, timeout=5, cliente_id=str(update.effective_chat.id))
+                data2 = await asyncio.to_thread(processar_mensagem, texto, timeout=5, cliente_id=str(update.effective_chat.id), idempotency_key=_chave_idempotencia(update))
             except:
                 data2 = {"sucesso": False}
             if data2 and data2.get("sucesso"):
@@ -4027,6 +4092,7 @@ async def processar_mensagem_imagem(update: Update, context: CallbackContext):
                     "cliente_id": str(update.effective_chat.id),
                     "cliente_nome": get_cliente_nome(update),
                     "username": get_cliente_username(update),
+                    "idempotency_key": _chave_idempotencia(update),
                 },
                 timeout=10
             )
@@ -4209,6 +4275,7 @@ async def processar_mensagem_documento(update: Update, context: CallbackContext)
                             "cliente_id": str(update.effective_chat.id),
                             "cliente_nome": get_cliente_nome(update),
                             "username": get_cliente_username(update),
+                            "idempotency_key": _chave_idempotencia(update),
                         },
                         timeout=30
                     )
@@ -4391,6 +4458,7 @@ async def processar_mensagem_documento(update: Update, context: CallbackContext)
                     "cliente_id": str(update.effective_chat.id),
                     "cliente_nome": get_cliente_nome(update),
                     "username": get_cliente_username(update),
+                    "idempotency_key": _chave_idempotencia(update),
                 },
                 timeout=10
             )
@@ -4549,6 +4617,7 @@ async def processar_mensagem_voz(update: Update, context: CallbackContext):
                     "cliente_id": str(update.effective_chat.id),
                     "cliente_nome": get_cliente_nome(update),
                     "username": get_cliente_username(update),
+                    "idempotency_key": _chave_idempotencia(update),
                 },
                 timeout=6
             )
@@ -4780,6 +4849,7 @@ async def processar_mensagem_audio(update: Update, context: CallbackContext):
                     "cliente_id": str(update.effective_chat.id),
                     "cliente_nome": get_cliente_nome(update),
                     "username": get_cliente_username(update),
+                    "idempotency_key": _chave_idempotencia(update),
                 },
                 timeout=10
             )